@@ -11,6 +11,26 @@ import subprocess
 import csv
 import requests
 import json
+import re
+import bisect
+import contextlib
+import http.server
+import shutil
+import tempfile
+import argparse
+import struct
+import heapq
+import queue
+import glob
+import itertools
+import array
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+try:
+    import fcntl  # Linux GPIO 字符设备需要; Windows 下没有该模块
+except ImportError:
+    fcntl = None
 
 # ==========================================
 # --- CONFIGURATION (配置区域) ---
@@ -37,10 +57,125 @@ DEFAULT_CONFIG = {
     # 辅助引脚 (wPi 编号)
     "PIN_AUX_13": 13,
     "PIN_ENABLE_21": 21,
+
+    # 【GPIO 后端】"auto" = 优先字符设备, 不可用时退回 gpio 命令;
+    #             "chardev" = /dev/gpiochipN 常驻句柄; "cli" = 每次调用 gpio 命令; "fake" = 内存模拟
+    "GPIO_BACKEND": "auto",
+    # 字符设备映射: wPi 编号 -> Linux 全局 GPIO 号 (按每个 gpiochip 32 线换算) 或 "gpiochipN:line"
+    # 需覆盖 GPIO_PINS / PIN_AUX_13 / PIN_ENABLE_21 的全部引脚, 否则 auto 模式退回 gpio 命令
+    "GPIO_CHARDEV_MAP": {},
+
+    # 电击脉冲: 高电平宽度 / 低电平宽度 (毫秒)
+    "PULSE_ON_MS": 200,
+    "PULSE_OFF_MS": 800,
+    # 按 Box 覆盖脉冲宽度, 例如 {"Box_1": [100, 900]}
+    "PULSE_WIDTHS": {},
     
     # Pushplus Token
     "PUSHPLUS_TOKEN": "0",
-    "PUSHPLUS_GROUP": "0"
+    "PUSHPLUS_GROUP": "0",
+
+    # 检测阈值默认值 (界面滑块初值 / 无界面模式使用)
+    "PIXEL_DIFF_THRESHOLD": 25,
+    "MOTION_AREA_THRESHOLD": 5,
+
+    # 检测区域文件 (界面中"保存区域"写入, 无界面模式读取)
+    "ROI_FILE": "rois.json",
+
+    # 【摄像头发现】设备清单缓存文件 (按 /dev/v4l/by-id 稳定路径索引) 与单个设备探测超时 (秒)
+    "CAMERA_CACHE_FILE": "camera_inventory.json",
+    "CAMERA_PROBE_TIMEOUT": 3.0,
+
+    # 【无界面模式 --no-gui】
+    # 实战模式下使用的摄像头索引 (测试模式下读取 TEST_VIDEO_PATH)
+    "CAMERA_INDICES": [0],
+    # "monitor" = 行为监测; "train" = 电击训练
+    "HEADLESS_MODE": "monitor",
+    # 会话时长 (秒)
+    "HEADLESS_DURATION": 60,
+    # 训练模式下各 Box 的电击次数目标, 为空则只按时长结束
+    "HEADLESS_TRAIN_TARGETS": {},
+    # 是否录像
+    "HEADLESS_RECORD": True,
+
+    # 【性能】True = 只对检测区域 (外扩模糊核半径) 的并集做灰度与模糊, 背景也只保存这些区域
+    "ROI_RESTRICTED_PREPROCESS": False,
+
+    # 【背景模型】"snapshot" = 静态快照 (仅按 B 重置); "running_avg" = 指数滑动平均;
+    #            "median" = 抽帧历史的逐像素近似中值; "mog2" = OpenCV MOG2 混合高斯
+    "BG_MODEL": "snapshot",
+    # 更新速率 (running_avg / mog2 的学习率; median 每次更新移动的灰度级数为 max(1, 学习率*255))
+    "BG_LEARNING_RATE": 0.01,
+    # 每隔多少帧更新一次背景 (抽帧)
+    "BG_UPDATE_INTERVAL": 1,
+    # 可选的更新掩码图片 (白色=允许更新, 黑色=永不更新), 按检测画面尺寸缩放; 空字符串表示不使用
+    "BG_UPDATE_MASK": "",
+    # MOG2 的方差阈值 (马氏距离平方)
+    "BG_MOG2_VAR_THRESHOLD": 16,
+
+    # 【录像】编码在独立线程中进行, 队列满时的策略: "block" = 阻塞等待; "drop_oldest" = 丢弃最旧帧; "drop_newest" = 丢弃新帧
+    "RECORD_QUEUE_SIZE": 30,
+    "RECORD_DROP_POLICY": "drop_oldest",
+    # True = 每个摄像头按原始分辨率与帧率单独录制一个文件 (各自独立编码线程)
+    "RECORD_PER_CAMERA": False,
+    # 分路录制时是否额外录制带标注的拼接总览
+    "RECORD_OVERVIEW": True,
+
+    # 【事件日志】会话事件发生时即追加写入该目录下的 JSONL 文件, 导出 CSV 与异常退出后的恢复都以它为准
+    "JOURNAL_DIR": "journals",
+    # 批量 flush + fsync 的间隔/秒 (断电时最多丢失这段时间内的事件)
+    "JOURNAL_FSYNC_INTERVAL": 1.0,
+
+    # 【分数序列】会话期间把每帧每个 ROI 的运动分数写入与事件日志同名的 .scores 文件 (numpy.memmap), 供事后重新设定阈值
+    "SCORE_SERIES_ENABLED": True,
+    # 文件每次预分配的行数 (一行 = 一帧)
+    "SCORE_SERIES_CHUNK_ROWS": 65536,
+
+    # 【性能探针】记录主循环各阶段与 GPIO 调用的耗时; 关闭时探针几乎没有开销
+    "METRICS_ENABLED": False,
+    # Prometheus 文本格式的 /metrics 端口 (0 = 不启动 HTTP 服务), 默认只监听本机
+    "METRICS_PORT": 9108,
+    "METRICS_BIND": "127.0.0.1",
+    # 启动时是否在画面上显示各阶段耗时 (界面中按 M 切换)
+    "METRICS_OVERLAY": False,
+
+    # 【主循环】检测帧率 (按单调时钟截止时间调度, 落后时丢弃错过的节拍) 与画面预览/状态栏刷新帧率
+    "DETECT_FPS": 30,
+    "DISPLAY_FPS": 15,
+
+    # 【多进程采集】True = 每个摄像头一个子进程完成采集、缩放与 ROI 打分, 帧与分数经共享内存传回主进程
+    # (主进程只拼接预览并运行训练/监测状态机); 此模式下不支持分路录制
+    "CAPTURE_PROCESSES": False,
+    # 每路共享内存环形缓冲区的槽数
+    "CAPTURE_RING_SLOTS": 4,
+
+    # 【检测分辨率】每个摄像头单独检测时的工作分辨率 [宽, 高], 与窗口大小无关; null = 按摄像头原始分辨率
+    # 检测区域以各摄像头在该分辨率下的坐标保存
+    "DETECT_RESOLUTION": None,
+
+    # 【灰度原生采集】True = V4L2 摄像头以 YUYV 原始格式采集 (关闭 OpenCV 的 BGR 转换), 检测直接取 Y 平面;
+    # 只有实际显示或录像的帧才转换为彩色。只对协商到 YUYV 格式的摄像头生效 (见 CAPTURE_PROFILES)
+    "CAPTURE_YUYV_GRAY": False,
+
+    # 【采集格式协商】按偏好排序的候选格式 (FOURCC / 分辨率 / 帧率 / 驱动缓冲区数)。
+    # 同一 USB 总线上的摄像头按估算带宽之和不超过 USB_BUS_BANDWIDTH (MB/s) 逐个降级, 设备不支持的格式自动跳过;
+    # 可选 "bandwidth" 字段直接给出该格式的带宽 (MB/s), 否则 YUYV 按 宽×高×2×帧率 估算, MJPG 按其 1/4 估算
+    "CAPTURE_PROFILES": [
+        {"fourcc": "MJPG", "width": 640, "height": 480, "fps": 30, "buffer_size": 2},
+        {"fourcc": "MJPG", "width": 640, "height": 480, "fps": 15, "buffer_size": 2},
+        {"fourcc": "YUYV", "width": 640, "height": 480, "fps": 30, "buffer_size": 2},
+        {"fourcc": "YUYV", "width": 640, "height": 480, "fps": 15, "buffer_size": 2},
+        {"fourcc": "YUYV", "width": 320, "height": 240, "fps": 30, "buffer_size": 2},
+        {"fourcc": "YUYV", "width": 320, "height": 240, "fps": 15, "buffer_size": 2}
+    ],
+    # 单个摄像头的候选格式, 键为摄像头序号 (如 "2") 或 /dev/v4l/by-id 路径, 未列出的摄像头使用 CAPTURE_PROFILES
+    "CAMERA_CAPTURE_PROFILES": {},
+    # 每条 USB 总线可用于视频的带宽 (MB/s)。USB 2.0 同步传输上限约 24.5, 留出余量取 20
+    "USB_BUS_BANDWIDTH": 20.0,
+
+    # 【同步采集】True = 一个采集线程先对所有摄像头依次 grab() 再逐个 retrieve(), 同一拼接帧各路的采集时刻尽量接近;
+    # 每帧记录各路采集时刻与路间偏差, 偏差统计写入会话日志。多进程采集模式下无效
+    "CAPTURE_SYNC": False
 }
 
 def load_config():
@@ -75,87 +210,617 @@ TEST_VIDEO_PATH = _cfg["TEST_VIDEO_PATH"]
 GPIO_PINS = _cfg["GPIO_PINS"]
 PIN_AUX_13 = _cfg["PIN_AUX_13"]
 PIN_ENABLE_21 = _cfg["PIN_ENABLE_21"]
+GPIO_BACKEND = _cfg["GPIO_BACKEND"]
+GPIO_CHARDEV_MAP = _cfg["GPIO_CHARDEV_MAP"]
+PULSE_ON_MS = _cfg["PULSE_ON_MS"]
+PULSE_OFF_MS = _cfg["PULSE_OFF_MS"]
+PULSE_WIDTHS = _cfg["PULSE_WIDTHS"]
 PUSHPLUS_TOKEN = _cfg["PUSHPLUS_TOKEN"]
 PUSHPLUS_GROUP = _cfg["PUSHPLUS_GROUP"]
+PIXEL_DIFF_THRESHOLD = _cfg["PIXEL_DIFF_THRESHOLD"]
+MOTION_AREA_THRESHOLD = _cfg["MOTION_AREA_THRESHOLD"]
+ROI_FILE = _cfg["ROI_FILE"]
+CAMERA_INDICES = _cfg["CAMERA_INDICES"]
+CAMERA_CACHE_FILE = _cfg["CAMERA_CACHE_FILE"]
+CAMERA_PROBE_TIMEOUT = _cfg["CAMERA_PROBE_TIMEOUT"]
+HEADLESS_MODE = _cfg["HEADLESS_MODE"]
+HEADLESS_DURATION = _cfg["HEADLESS_DURATION"]
+HEADLESS_TRAIN_TARGETS = _cfg["HEADLESS_TRAIN_TARGETS"]
+HEADLESS_RECORD = _cfg["HEADLESS_RECORD"]
+ROI_RESTRICTED_PREPROCESS = _cfg["ROI_RESTRICTED_PREPROCESS"]
+BG_MODEL = _cfg["BG_MODEL"]
+BG_LEARNING_RATE = _cfg["BG_LEARNING_RATE"]
+BG_UPDATE_INTERVAL = _cfg["BG_UPDATE_INTERVAL"]
+BG_UPDATE_MASK = _cfg["BG_UPDATE_MASK"]
+BG_MOG2_VAR_THRESHOLD = _cfg["BG_MOG2_VAR_THRESHOLD"]
+RECORD_QUEUE_SIZE = _cfg["RECORD_QUEUE_SIZE"]
+RECORD_DROP_POLICY = _cfg["RECORD_DROP_POLICY"]
+RECORD_PER_CAMERA = _cfg["RECORD_PER_CAMERA"]
+RECORD_OVERVIEW = _cfg["RECORD_OVERVIEW"]
+JOURNAL_DIR = _cfg["JOURNAL_DIR"]
+JOURNAL_FSYNC_INTERVAL = _cfg["JOURNAL_FSYNC_INTERVAL"]
+SCORE_SERIES_ENABLED = _cfg["SCORE_SERIES_ENABLED"]
+SCORE_SERIES_CHUNK_ROWS = _cfg["SCORE_SERIES_CHUNK_ROWS"]
+METRICS_ENABLED = _cfg["METRICS_ENABLED"]
+METRICS_PORT = _cfg["METRICS_PORT"]
+METRICS_BIND = _cfg["METRICS_BIND"]
+METRICS_OVERLAY = _cfg["METRICS_OVERLAY"]
+DETECT_FPS = _cfg["DETECT_FPS"]
+DISPLAY_FPS = _cfg["DISPLAY_FPS"]
+CAPTURE_PROCESSES = _cfg["CAPTURE_PROCESSES"]
+CAPTURE_RING_SLOTS = _cfg["CAPTURE_RING_SLOTS"]
+DETECT_RESOLUTION = _cfg["DETECT_RESOLUTION"]
+CAPTURE_YUYV_GRAY = _cfg["CAPTURE_YUYV_GRAY"]
+CAPTURE_PROFILES = _cfg["CAPTURE_PROFILES"]
+CAMERA_CAPTURE_PROFILES = _cfg["CAMERA_CAPTURE_PROFILES"]
+USB_BUS_BANDWIDTH = _cfg["USB_BUS_BANDWIDTH"]
+CAPTURE_SYNC = _cfg["CAPTURE_SYNC"]
+
+# 单调时钟与墙上时钟的对应关系 (启动时取一次)。事件时间一律用采集时刻的 time.monotonic()
+# 计算，再换算成日期时间显示，不受主循环延迟与系统校时影响
+_CLOCK_ANCHOR = (datetime.datetime.now(), time.monotonic())
+
+
+def mono_to_datetime(t):
+    return _CLOCK_ANCHOR[0] + datetime.timedelta(seconds=t - _CLOCK_ANCHOR[1])
+
+
+def datetime_to_mono(dt):
+    return _CLOCK_ANCHOR[1] + (dt - _CLOCK_ANCHOR[0]).total_seconds()
+
+
+# ==========================================
+# [新增] 性能探针 (各阶段耗时直方图 + Prometheus 导出)
+# ==========================================
+class _Span:
+    __slots__ = ("metrics", "name", "t0")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+class StageMetrics:
+    """
+    热路径各阶段的耗时统计。用法: with METRICS.span("blur"): ...
+    关闭时 span() 返回同一个空上下文，不计时、不加锁。每个阶段保存:
+    - 累计直方图 (固定桶，对应 Prometheus histogram)
+    - 最近 window 个样本的环形缓冲，用于画面叠加层的滚动分位数
+    """
+    BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)  # 秒
+
+    def __init__(self, enabled=False, window=512):
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._gauges = {}  # name -> (help, fn() -> [(labels dict, value)])
+        self._null = contextlib.nullcontext()
+        self._server = None
+
+    def span(self, name):
+        if not self.enabled:
+            return self._null
+        return _Span(self, name)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            st = self._stages.get(name)
+            if st is None:
+                st = self._stages[name] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0.0, 'count': 0,
+                                           'recent': np.zeros(self.window), 'pos': 0}
+            st['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            st['sum'] += seconds
+            st['count'] += 1
+            st['recent'][st['pos'] % self.window] = seconds
+            st['pos'] += 1
+
+    def add_gauge(self, name, help_text, fn):
+        """注册一个按需取值的指标，fn 返回 [(标签 dict, 数值)]"""
+        self._gauges[name] = (help_text, fn)
+
+    def summary(self):
+        """最近样本的滚动分位数 (毫秒): {stage: {'p50', 'p95', 'p99', 'count'}}"""
+        with self._lock:
+            snapshot = {name: (st['recent'][:min(st['pos'], self.window)].copy(), st['count'])
+                        for name, st in self._stages.items()}
+        out = {}
+        for name, (recent, count) in snapshot.items():
+            if not len(recent):
+                continue
+            p50, p95, p99 = np.percentile(recent, (50, 95, 99)) * 1000
+            out[name] = {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'count': count}
+        return out
+
+    def render_prometheus(self):
+        lines = ["# HELP bbc_stage_seconds Duration of hot-path stages.", "# TYPE bbc_stage_seconds histogram"]
+        with self._lock:
+            stages = {name: (list(st['buckets']), st['sum'], st['count']) for name, st in self._stages.items()}
+        for name, (buckets, total, count) in sorted(stages.items()):
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS + (float('inf'),), buckets):
+                cumulative += n
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f'bbc_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'bbc_stage_seconds_sum{{stage="{name}"}} {total:.9f}')
+            lines.append(f'bbc_stage_seconds_count{{stage="{name}"}} {count}')
+
+        for name, (help_text, fn) in sorted(self._gauges.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            try:
+                samples = fn()
+            except Exception:
+                continue
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=METRICS_PORT, bind=METRICS_BIND, log=print):
+        """在后台线程启动 HTTP 服务，GET /metrics 返回 Prometheus 文本格式"""
+        if not self.enabled or not port or self._server is not None:
+            return
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self._server = http.server.ThreadingHTTPServer((bind, port), Handler)
+        except OSError as e:
+            log(f"[警告] 性能指标端口 {bind}:{port} 启动失败: {e}")
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        log(f"[系统] 性能指标: http://{bind}:{port}/metrics")
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+METRICS = StageMetrics(METRICS_ENABLED)
+
 
 # ==========================================
-# 1. 硬件控制抽象层 (保持不变)
+# 1. 硬件控制抽象层
 # ==========================================
+def _iowr(type_, nr, size):
+    return (3 << 30) | (size << 16) | (type_ << 8) | nr
+
+
+class ChardevGpioBackend:
+    """
+    Linux GPIO 字符设备后端 (/dev/gpiochipN，与 libgpiod 相同的内核 uAPI)。
+    每个引脚启动时申请一次 line handle 并长期持有，之后每次写入只是一次 ioctl，不产生子进程。
+    """
+    name = "chardev"
+
+    _REQUEST_OUTPUT = 1 << 1
+    _REQUEST_SIZE = 364  # sizeof(struct gpiohandle_request)
+    _DATA_SIZE = 64      # sizeof(struct gpiohandle_data)
+    _GET_LINEHANDLE_IOCTL = _iowr(0xB4, 0x03, _REQUEST_SIZE)
+    _SET_LINE_VALUES_IOCTL = _iowr(0xB4, 0x09, _DATA_SIZE)
+    _VALUES = {0: bytes(_DATA_SIZE), 1: b"\x01" + bytes(_DATA_SIZE - 1)}
+
+    def __init__(self, pin_map):
+        if fcntl is None:
+            raise OSError("当前平台不支持 GPIO 字符设备")
+        self.pin_map = pin_map
+        self._fds = {}
+
+    def _resolve(self, pin):
+        spec = self.pin_map.get(str(pin))
+        if spec is None:
+            raise KeyError(f"wPi {pin} 未在 GPIO_CHARDEV_MAP 中配置")
+        if isinstance(spec, int):
+            return f"/dev/gpiochip{spec // 32}", spec % 32
+        chip, line = str(spec).split(":")
+        if not chip.startswith("/dev/"):
+            chip = f"/dev/{chip}"
+        return chip, int(line)
+
+    def setup_output(self, pin, value=0):
+        chip, line = self._resolve(pin)
+        req = bytearray(self._REQUEST_SIZE)
+        struct.pack_into("I", req, 0, line)                      # lineoffsets[0]
+        struct.pack_into("I", req, 256, self._REQUEST_OUTPUT)    # flags
+        req[260] = 1 if value else 0                             # default_values[0]
+        label = b"bio_behavior_console"
+        req[324:324 + len(label)] = label                        # consumer_label
+        struct.pack_into("I", req, 356, 1)                       # lines
+
+        chip_fd = os.open(chip, os.O_RDWR)
+        try:
+            fcntl.ioctl(chip_fd, self._GET_LINEHANDLE_IOCTL, req)
+        finally:
+            os.close(chip_fd)
+        self._fds[pin] = struct.unpack_from("i", req, 360)[0]   # fd
+
+    def write(self, pin, value):
+        fcntl.ioctl(self._fds[pin], self._SET_LINE_VALUES_IOCTL, self._VALUES[1 if value else 0])
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+
+class CliGpioBackend:
+    """wiringOP gpio 命令后端 (原有实现，作为兜底)：每次写入都会启动一个子进程"""
+    name = "cli"
+
+    def __init__(self):
+        try:
+            res = subprocess.run(["gpio", "-v"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise OSError("未找到 gpio 命令")
+        if res.returncode != 0:
+            raise OSError("gpio 命令执行失败")
+
+    def setup_output(self, pin, value=0):
+        subprocess.run(["gpio", "mode", str(pin), "out"], check=False)
+        self.write(pin, value)
+
+    def write(self, pin, value):
+        subprocess.run(["gpio", "write", str(pin), str(value)], check=False)
+
+    def close(self):
+        pass
+
+
+class FakeGpioBackend:
+    """内存模拟后端：不接触硬件，只记录每次电平变化 (time.monotonic(), pin, value)，用于测试与模拟模式"""
+    name = "fake"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.levels = {}
+        self.timeline = []
+
+    def setup_output(self, pin, value=0):
+        self.write(pin, value)
+
+    def write(self, pin, value):
+        with self._lock:
+            self.levels[pin] = value
+            self.timeline.append((time.monotonic(), pin, value))
+
+    def close(self):
+        pass
+
+
+def open_gpio_backend(kind, initial_levels):
+    """
+    按配置打开 GPIO 后端并把 initial_levels ({pin: value}) 中的引脚设为输出。
+    auto 模式依次尝试 chardev、cli；全部失败返回 None。
+    """
+    candidates = ["chardev", "cli"] if kind == "auto" else [kind]
+    for name in candidates:
+        try:
+            if name == "chardev":
+                backend = ChardevGpioBackend(GPIO_CHARDEV_MAP)
+            elif name == "cli":
+                backend = CliGpioBackend()
+            elif name == "fake":
+                backend = FakeGpioBackend()
+            else:
+                print(f"[警告] 未知的 GPIO 后端 {name}")
+                continue
+            for pin, value in initial_levels.items():
+                backend.setup_output(pin, value)
+            return backend
+        except (OSError, KeyError, ValueError) as e:
+            print(f"[警告] GPIO 后端 {name} 不可用: {e}")
+    return None
+
+
+class RunningStat:
+    """流式统计：样本数、均值、总体标准差、最大值、最大绝对值，内存占用与样本数无关"""
+    __slots__ = ("n", "total", "total_sq", "max", "max_abs")
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.max = float('-inf')
+        self.max_abs = 0.0
+
+    def add(self, x):
+        self.n += 1
+        self.total += x
+        self.total_sq += x * x
+        self.max = max(self.max, x)
+        self.max_abs = max(self.max_abs, abs(x))
+
+    def mean(self):
+        return self.total / self.n if self.n else float('nan')
+
+    def std(self):
+        if not self.n:
+            return float('nan')
+        mean = self.total / self.n
+        return max(self.total_sq / self.n - mean * mean, 0.0) ** 0.5
+
+
+class PulseScheduler(threading.Thread):
+    """
+    单线程脉冲调度器：所有 Box 的脉冲串都由一个按 time.monotonic() 截止时间排序的堆驱动。
+    下一个边沿的计划时间由上一个计划时间推算，不受调度延迟累积影响；
+    每个边沿的计划时间与实际时间累加进按 Box 的流式统计 (脉宽与周期抖动)，不保留逐个边沿，长时间会话内存不增长。
+    """
+    def __init__(self, write_fn):
+        super().__init__(name="pulse-scheduler", daemon=True)
+        self.write_fn = write_fn
+        self._cond = threading.Condition()
+        self._heap = []                 # (deadline, seq, box_id, pin, value, generation)
+        self._seq = itertools.count()
+        self._trains = {}               # box_id -> {'pin', 'on', 'off', 'gen'}
+        self._last_rise = {}            # box_id -> 上一次上升沿的计划时间
+        self._generation = itertools.count(1)
+        self._running = True
+        self._jitter = {}               # box_id -> {统计项: RunningStat}，见 _record_edge
+        self._last_edge = {}            # box_id -> {1: 上一个上升沿 (计划, 实际), 0: 未配对的上升沿}
+        self._pulses = {}               # box_id -> 已写出的上升沿数
+
+    def start_train(self, box_id, pin, on_s, off_s, on_first_edge=None):
+        """on_first_edge(计划时间, 实际时间): 该脉冲串第一个上升沿写出后在调度线程中回调一次"""
+        with self._cond:
+            gen = next(self._generation)
+            self._trains[box_id] = {'pin': pin, 'on': on_s, 'off': off_s, 'gen': gen, 'on_first_edge': on_first_edge}
+            # 重新激活时仍保证与上一个脉冲间隔至少一个周期
+            now = time.monotonic()
+            first = max(now, self._last_rise.get(box_id, now - on_s - off_s) + on_s + off_s)
+            heapq.heappush(self._heap, (first, next(self._seq), box_id, pin, 1, gen))
+            self._cond.notify()
+
+    def stop_train(self, box_id):
+        """停止后续脉冲；正在输出的高电平仍按计划宽度结束"""
+        with self._cond:
+            self._trains.pop(box_id, None)
+
+    def stop_all(self):
+        with self._cond:
+            self._trains.clear()
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._trains.clear()
+            self._cond.notify()
+        if self.is_alive():
+            self.join(1.0)
+
+    def clear_log(self):
+        with self._cond:
+            self._jitter = {}
+            self._last_edge = {}
+            self._pulses = {}
+
+    def _record_edge(self, box_id, value, intended, actual):
+        """累加一个边沿：上升沿与上一个上升沿构成周期，下降沿与未配对的上升沿构成脉宽 (调用方持锁)"""
+        stats = self._jitter.get(box_id)
+        if stats is None:
+            stats = self._jitter[box_id] = {k: RunningStat() for k in
+                                            ('width', 'width_err', 'period', 'period_err', 'delay')}
+            self._last_edge[box_id] = {}
+            self._pulses[box_id] = 0
+        last = self._last_edge[box_id]
+        stats['delay'].add(actual - intended)
+        if value == 1:
+            self._pulses[box_id] += 1
+            prev = last.get(1)
+            if prev is not None:
+                stats['period'].add(actual - prev[1])
+                stats['period_err'].add((actual - prev[1]) - (intended - prev[0]))
+            last[1] = last[0] = (intended, actual)
+        elif last.get(0) is not None:
+            rise_intended, rise_actual = last.pop(0)
+            stats['width'].add(actual - rise_actual)
+            stats['width_err'].add((actual - rise_actual) - (intended - rise_intended))
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if not self._running:
+                    return
+
+                deadline, _, box_id, pin, value, gen = heapq.heappop(self._heap)
+                first_edge_cb = None
+                if value == 1:
+                    train = self._trains.get(box_id)
+                    if train is None or train['gen'] != gen:
+                        continue  # 该脉冲串已停止或被新的激活取代
+                    first_edge_cb = train.pop('on_first_edge', None)
+                    self._last_rise[box_id] = deadline
+                    heapq.heappush(self._heap, (deadline + train['on'], next(self._seq), box_id, pin, 0, gen))
+                    next_rise = deadline + train['on'] + train['off']
+                    if next_rise < time.monotonic():
+                        next_rise = time.monotonic()  # 落后超过一个周期时重新对齐，避免补发成串脉冲
+                    heapq.heappush(self._heap, (next_rise, next(self._seq), box_id, pin, 1, gen))
+
+            # 写 GPIO 时不持锁，避免慢速后端阻塞 set_active 调用方。
+            # 后端或回调出错只记录并跳过本边沿，调度线程必须继续运行，否则之后的电击会全部丢失
+            try:
+                self.write_fn(pin, value)
+            except Exception as e:
+                print(f"[错误] {box_id} GPIO {pin} 写{'高' if value else '低'}电平失败: {e}")
+                if value:
+                    try:
+                        self.write_fn(pin, 0)  # 上升沿失败时确保引脚处于低电平
+                    except Exception as e2:
+                        print(f"[错误] {box_id} GPIO {pin} 拉低失败: {e2}")
+                if first_edge_cb is not None:
+                    # 首个上升沿没写出去，留给下一个上升沿回调 (电击延迟按实际写出的边沿计)
+                    with self._cond:
+                        train = self._trains.get(box_id)
+                        if train is not None and train['gen'] == gen:
+                            train.setdefault('on_first_edge', first_edge_cb)
+                continue
+            actual = time.monotonic()
+            with self._cond:
+                self._record_edge(box_id, value, deadline, actual)
+            if first_edge_cb is not None:
+                try:
+                    first_edge_cb(deadline, actual)
+                except Exception as e:
+                    print(f"[错误] {box_id} 首个脉冲边沿回调失败: {e}")
+
+    def jitter_report(self):
+        """
+        按 Box 统计脉宽与周期抖动 (毫秒)：
+        {box_id: {'pulses', 'width_mean', 'width_std', 'width_max_err', 'period_mean', 'period_std',
+                  'period_max_err', 'edge_delay_mean', 'edge_delay_max'}}
+        """
+        with self._cond:
+            return {box_id: self._jitter_row(self._pulses[box_id], st) for box_id, st in self._jitter.items()}
+
+    @staticmethod
+    def _jitter_row(pulses, st):
+        return {
+            'pulses': pulses,
+            'width_mean': st['width'].mean() * 1000,
+            'width_std': st['width_err'].std() * 1000,
+            'width_max_err': st['width_err'].max_abs * 1000 if st['width_err'].n else float('nan'),
+            'period_mean': st['period'].mean() * 1000,
+            'period_std': st['period_err'].std() * 1000,
+            'period_max_err': st['period_err'].max_abs * 1000 if st['period_err'].n else float('nan'),
+            'edge_delay_mean': st['delay'].mean() * 1000,
+            'edge_delay_max': st['delay'].max * 1000,
+        }
+
+
 class Stimulator:
     def __init__(self, is_test_mode):
         self.is_test_mode = is_test_mode
         self.active_flags = {}
         self.shock_counts = {k: 0 for k in GPIO_PINS.keys()} 
         self.shock_history = [] 
+        self.on_shock = None  # 设置后电击记录交给回调 (写入事件日志)，不再留在内存
+        self.on_shock_edge = None  # 电击的第一个 GPIO 上升沿写出后回调 (调度线程中)，参数为补全延迟后的记录
         self.running = True
         self.gpio_available = False
         self.log_callback = None
 
+        # 模拟模式下使用内存后端，电平变化同样有时间线可查
+        self.backend = FakeGpioBackend()
+
         if not self.is_test_mode:
-            try:
-                res = subprocess.run(["gpio", "-v"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if res.returncode == 0:
-                    self.gpio_available = True
-                    print("[系统] 检测到 wiringOP (gpio 命令可用)")
-                    for pin in GPIO_PINS.values():
-                        self._gpio_mode(pin, "out")
-                        self._gpio_write(pin, 0)
-                    self._gpio_mode(PIN_AUX_13, "out")
-                    self._gpio_write(PIN_AUX_13, 0)
-                    self._gpio_mode(PIN_ENABLE_21, "out")
-                    self._gpio_write(PIN_ENABLE_21, 1) # Enable HIGH
-                    print("[系统] GPIO 初始化成功")
-                else:
-                    print("[警告] gpio 命令执行失败，降级为模拟模式")
-                    self.is_test_mode = True
-            except FileNotFoundError:
-                print("[警告] 未找到 gpio 命令，降级为模拟模式")
-                self.is_test_mode = True 
+            initial_levels = {pin: 0 for pin in GPIO_PINS.values()}
+            initial_levels[PIN_AUX_13] = 0
+            initial_levels[PIN_ENABLE_21] = 1  # Enable HIGH
+            backend = open_gpio_backend(GPIO_BACKEND, initial_levels)
+            if backend is not None and backend.name != "fake":
+                self.backend = backend
+                self.gpio_available = True
+                print(f"[系统] GPIO 初始化成功 (后端: {backend.name})")
+            else:
+                print("[警告] 没有可用的 GPIO 后端，降级为模拟模式")
+                self.is_test_mode = True
 
-    def _gpio_mode(self, pin, mode):
-        subprocess.run(["gpio", "mode", str(pin), mode], check=False)
+        self.scheduler = PulseScheduler(self._gpio_write)
+        self.scheduler.start()
 
     def _gpio_write(self, pin, value):
-        subprocess.run(["gpio", "write", str(pin), str(value)], check=False)
+        with METRICS.span("gpio_write"):
+            self.backend.write(pin, value)
+
+    def pulse_widths(self, box_id):
+        """返回 (高电平秒数, 低电平秒数)"""
+        on_ms, off_ms = PULSE_WIDTHS.get(box_id, (PULSE_ON_MS, PULSE_OFF_MS))
+        return on_ms / 1000.0, off_ms / 1000.0
 
     def set_log_callback(self, callback):
         self.log_callback = callback
 
-    def set_active(self, box_id, should_active):
+    def set_active(self, box_id, should_active, capture_ts=None, frame_index=None, detect_ts=None):
+        """
+        capture_ts: 触发该动作的画面的采集时刻 (time.monotonic)，手动电击时为 None (取当前时刻)
+        detect_ts: 该帧分数越过阈值 (判定激活) 的时刻，与 capture_ts 一起用于计算运动→电击延迟
+        """
         if self.active_flags.get(box_id) == should_active:
             return
+        set_active_ts = time.monotonic()
+        with METRICS.span("set_active"):
+            self._set_active(box_id, should_active, capture_ts, frame_index, detect_ts, set_active_ts)
 
+    def _set_active(self, box_id, should_active, capture_ts, frame_index, detect_ts, set_active_ts):
         self.active_flags[box_id] = should_active
-        now_dt = datetime.datetime.now()
+        if capture_ts is None:
+            capture_ts = set_active_ts
+        now_dt = mono_to_datetime(capture_ts)
         time_str = now_dt.strftime("%H:%M:%S")
 
         if should_active:
             if box_id in self.shock_counts:
                 self.shock_counts[box_id] += 1
-                self.shock_history.append({
+                record = {
                     'timestamp': now_dt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+                    'capture_ts': capture_ts,
+                    'frame_index': frame_index,
                     'box_id': box_id,
-                    'count_index': self.shock_counts[box_id]
-                })
+                    'count_index': self.shock_counts[box_id],
+                    # 运动→电击延迟 (毫秒): 采集→判定、判定→调用 set_active、set_active→第一个高电平 (边沿写出后补全)
+                    'detect_ms': (detect_ts - capture_ts) * 1000 if detect_ts is not None else None,
+                    'dispatch_ms': (set_active_ts - detect_ts) * 1000 if detect_ts is not None else None,
+                    'edge_ms': None,
+                    'total_ms': None
+                }
+                if self.on_shock:
+                    self.on_shock(record)
+                else:
+                    self.shock_history.append(record)
+                on_first_edge = lambda intended, actual, r=record: self._on_first_edge(r, set_active_ts, actual)
+            else:
+                on_first_edge = None
             
-            t = threading.Thread(target=self._pulse_logic, args=(box_id,))
-            t.daemon = True
-            t.start()
+            pin = GPIO_PINS.get(box_id)
+            if pin is not None and self.running:
+                self.scheduler.start_train(box_id, pin, *self.pulse_widths(box_id), on_first_edge=on_first_edge)
             self._log(f"[{time_str}] ⚡ START -> {box_id} (第{self.shock_counts.get(box_id, 0)}次)")
         else:
+            self.scheduler.stop_train(box_id)
             self._log(f"[{time_str}] ⏹ STOP  -> {box_id}")
 
-    def _pulse_logic(self, box_id):
-        while self.active_flags.get(box_id, False) and self.running:
-            if not self.is_test_mode and self.gpio_available:
-                pin = GPIO_PINS.get(box_id)
-                if pin is not None:
-                    self._gpio_write(pin, 1) # HIGH
-                    time.sleep(0.2)
-                    self._gpio_write(pin, 0) # LOW
-                    time.sleep(0.8)
-            else:
-                time.sleep(1.0) 
+    def _on_first_edge(self, record, set_active_ts, edge_ts):
+        record['edge_ms'] = (edge_ts - set_active_ts) * 1000
+        if record['frame_index'] is not None:  # 手动电击没有对应画面，只记录触发→高电平
+            record['total_ms'] = (edge_ts - record['capture_ts']) * 1000
+        if self.on_shock_edge:
+            self.on_shock_edge(record)
 
     def _log(self, msg):
         print(f"[硬件] {msg}")
@@ -165,23 +830,2638 @@ class Stimulator:
     def reset_counts(self):
         self.shock_counts = {k: 0 for k in GPIO_PINS.keys()}
         self.shock_history = [] 
+        self.scheduler.clear_log()
 
     def stop_all(self):
         for box_id in self.active_flags:
             self.active_flags[box_id] = False
-        if not self.is_test_mode and self.gpio_available:
-            for pin in GPIO_PINS.values():
-                self._gpio_write(pin, 0)
-            self._gpio_write(PIN_AUX_13, 0)
+        self.scheduler.stop_all()
+        for pin in GPIO_PINS.values():
+            self._gpio_write(pin, 0)
+        self._gpio_write(PIN_AUX_13, 0)
 
     def cleanup(self):
         self.running = False
-        if not self.is_test_mode and self.gpio_available:
-            for pin in GPIO_PINS.values():
-                self._gpio_write(pin, 0)
-            self._gpio_write(PIN_AUX_13, 0)
-            self._gpio_write(PIN_ENABLE_21, 0)
-            print("[系统] GPIO 已通过命令行复位")
+        self.scheduler.shutdown()
+        for pin in GPIO_PINS.values():
+            self._gpio_write(pin, 0)
+        self._gpio_write(PIN_AUX_13, 0)
+        self._gpio_write(PIN_ENABLE_21, 0)
+        self.backend.close()
+        if self.gpio_available:
+            print(f"[系统] GPIO 已复位 (后端: {self.backend.name})")
+
+# ==========================================
+# [新增] 灰度原生采集 (YUYV 原始帧直接取 Y 平面做检测)
+# ==========================================
+YUYV_FOURCC = cv2.VideoWriter_fourcc(*'YUYV')
+
+
+def fourcc_str(code):
+    """CAP_PROP_FOURCC 的数值 → 四字符字符串 (如 "MJPG")"""
+    code = int(code)
+    return "".join(chr((code >> (8 * i)) & 0xFF) for i in range(4))
+
+
+def enable_yuyv_capture(cap, log=print):
+    """格式已协商为 YUYV 的设备关闭 OpenCV 的 BGR 转换；其他格式 (如 MJPG) 保持普通采集，返回是否启用"""
+    if int(cap.get(cv2.CAP_PROP_FOURCC)) == YUYV_FOURCC and cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+        return True
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+    log(f"采集格式为 {fourcc_str(cap.get(cv2.CAP_PROP_FOURCC))}，不是 YUYV，使用普通 BGR 采集")
+    return False
+
+
+def raw_yuyv_size(cap):
+    """已启用 YUYV 原始采集的 V4L2 设备返回 (宽, 高)，否则返回 None"""
+    try:
+        if cap.getBackendName() != "V4L2" or cap.get(cv2.CAP_PROP_CONVERT_RGB) != 0:
+            return None
+    except (AttributeError, cv2.error):  # 模拟摄像头 / 未打开的设备
+        return None
+    if int(cap.get(cv2.CAP_PROP_FOURCC)) != YUYV_FOURCC:
+        return None
+    return int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+
+def as_yuyv(frame, size):
+    """把关闭转换后后端返回的原始缓冲区 (1×N、高×2宽 或 高×宽×2) 统一视为 高×宽×2，长度不符返回 None"""
+    w, h = size
+    if frame.ndim == 3 and frame.shape[2] == 2:
+        return frame
+    if frame.size != w * h * 2:
+        return None
+    return frame.reshape(h, w, 2)
+
+
+def frame_to_luma(frame, dst=None):
+    """检测用的灰度图：YUYV 直接取 Y 通道 (无颜色换算)，灰度原样返回，BGR 才做一次转换"""
+    if frame.ndim == 2:
+        return frame
+    if frame.shape[2] == 2:
+        return cv2.extractChannel(frame, 0, dst=dst)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+
+
+def frame_to_bgr(frame, dst=None):
+    """显示 / 录像用的彩色图：只在真正需要画面时调用，BGR 原样返回"""
+    if frame.ndim == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, dst=dst)
+    if frame.shape[2] == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV, dst=dst)
+    return frame
+
+# ==========================================
+# [新增] 多线程采集层 (每个摄像头一个采集线程)
+# ==========================================
+class LatestFrameSlot:
+    """最新帧槽位：采集线程只覆盖写入最新一帧，消费端只取最新一帧，双方互不阻塞"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self._seq = 0            # 采集序号 (每成功读取一帧 +1)
+        self._timestamp = 0.0    # 采集时刻 (time.monotonic)
+        self._consumed_seq = 0   # 消费端最后取走的序号
+        self.dropped = 0         # 未被消费就被新帧覆盖的帧数
+        self.duplicates = 0      # 消费端重复取到同一帧的次数
+
+    def put(self, frame, timestamp):
+        with self._lock:
+            if self._seq > self._consumed_seq:
+                self.dropped += 1
+            self._frame = frame
+            self._seq += 1
+            self._timestamp = timestamp
+
+    def peek(self):
+        """只查看当前帧，不计入消费统计"""
+        with self._lock:
+            return self._frame, self._seq, self._timestamp
+
+    def get(self):
+        """返回 (frame, seq, timestamp)，没有帧时 frame 为 None"""
+        with self._lock:
+            if self._seq > 0 and self._seq == self._consumed_seq:
+                self.duplicates += 1
+            self._consumed_seq = self._seq
+            return self._frame, self._seq, self._timestamp
+
+
+class CaptureWorker(threading.Thread):
+    """持有一个 cv2.VideoCapture，在独立线程中循环 read()，结果写入 LatestFrameSlot"""
+    LOST_THRESHOLD = 30  # 连续读取失败次数达到该值视为掉线
+
+    def __init__(self, cap, source_name, loop_file=False):
+        super().__init__(name=f"capture-{source_name}", daemon=True)
+        self.cap = cap
+        self.source_name = source_name
+        self.loop_file = loop_file
+        self.slot = LatestFrameSlot()
+        self.record_sink = None  # 分路录制时为 AsyncVideoWriter，每个采集到的帧都会送入
+        self.fail_count = 0
+        self._stop_event = threading.Event()
+        self.group = None  # 同步采集时为驱动本路的 SyncCaptureGroup (本线程不启动)
+        # [新增] YUYV 原始采集时槽位里放的是 高×宽×2 的原始帧，检测取 Y 平面，显示/录像时才转彩色
+        self.yuyv_size = raw_yuyv_size(cap)
+
+        # 文件源按原始帧率节流，否则线程会全速解码
+        self.frame_interval = 0.0
+        if loop_file:
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            self.frame_interval = 1.0 / fps if fps and fps > 0 else 1.0 / 30
+
+    @property
+    def signal_lost(self):
+        return self.fail_count >= self.LOST_THRESHOLD
+
+    def run(self):
+        next_due = time.monotonic()
+        while not self._stop_event.is_set():
+            ret, frame = self.cap.read()
+            if not (ret and self.deliver(frame, buffer_timestamp(self.cap, time.monotonic()))):
+                self.read_failed()
+                self._stop_event.wait(0.01)
+                continue
+
+            if self.frame_interval:
+                next_due += self.frame_interval
+                delay = next_due - time.monotonic()
+                if delay > 0:
+                    self._stop_event.wait(delay)
+                else:
+                    next_due = time.monotonic()
+
+    def deliver(self, frame, timestamp):
+        """把读到的一帧写入槽位 (及分路录像)；YUYV 原始帧长度不符时返回 False"""
+        if self.yuyv_size is not None:
+            frame = as_yuyv(frame, self.yuyv_size)
+            if frame is None:
+                return False
+        self.fail_count = 0
+        self.slot.put(frame, timestamp)
+        sink = self.record_sink
+        if sink is not None:
+            sink.write(frame_to_bgr(frame))
+        return True
+
+    def read_failed(self):
+        self.fail_count += 1
+        if self.loop_file:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)  # 循环播放
+
+    def latest(self):
+        return self.slot.get()
+
+    def native_format(self):
+        """返回 (宽, 高, 帧率)，优先取已采集帧的实际尺寸"""
+        frame, _, _ = self.slot.peek()
+        if frame is not None:
+            h, w = frame.shape[:2]
+        else:
+            w = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        return w, h, (fps if fps and fps > 0 else 30.0)
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.group is not None:
+            self.group.stop(timeout)  # 同步采集线程可能仍在使用本路设备，先停下再释放
+        if self.is_alive():
+            self.join(timeout)
+        self.cap.release()
+
+
+class SyncCaptureGroup(threading.Thread):
+    """
+    [新增] 同步采集：一个线程先对所有摄像头紧接着依次 grab() (只从驱动取出缓冲帧，不解码)，
+    再逐个 retrieve() 解码，一轮的各路帧在 lock 下一起写入各自 CaptureWorker 的槽位
+    (这些 CaptureWorker 不再各自起线程)，collect_latest_frames 持同一把锁取帧，拼接帧总是来自同一轮。
+    每路时间戳取驱动缓冲区时间戳 (取不到时为 grab() 返回的时刻)，同一轮内各路时刻之差即拼接帧的采集偏差。
+    """
+    def __init__(self, workers):
+        super().__init__(name="capture-sync", daemon=True)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # 落后于最新一路超过半帧的摄像头本轮再 grab 一次，避免各路之间固定错开一帧
+        self.half_periods = [0.5 / fps if fps and fps > 0 else 1 / 60
+                             for fps in (w.cap.get(cv2.CAP_PROP_FPS) for w in workers)]
+        self.regrabs = 0
+        # 文件源按最慢一路的帧率节流
+        self.frame_interval = max(w.frame_interval for w in workers)
+        for worker in workers:
+            worker.group = self
+
+    def run(self):
+        grabbed = [None] * len(self.workers)
+        frames = [None] * len(self.workers)
+        next_due = time.monotonic()
+        while not self._stop_event.is_set():
+            for i, worker in enumerate(self.workers):
+                grabbed[i] = time.monotonic() if worker.cap.grab() else None
+            for i, worker in enumerate(self.workers):
+                if grabbed[i] is not None:
+                    grabbed[i] = buffer_timestamp(worker.cap, grabbed[i])
+            valid = [t for t in grabbed if t is not None]
+            newest = max(valid) if valid else None
+            for i, worker in enumerate(self.workers):
+                if grabbed[i] is not None and newest - grabbed[i] > self.half_periods[i]:
+                    self.regrabs += 1
+                    grabbed[i] = buffer_timestamp(worker.cap, time.monotonic()) if worker.cap.grab() else None
+            for i, worker in enumerate(self.workers):
+                ret, frames[i] = worker.cap.retrieve() if grabbed[i] is not None else (False, None)
+                if not ret:
+                    frames[i] = None
+
+            delivered = False
+            with self.lock:
+                for worker, frame, t in zip(self.workers, frames, grabbed):
+                    if frame is not None and worker.deliver(frame, t):
+                        delivered = True
+                    else:
+                        worker.read_failed()
+            if not delivered:
+                self._stop_event.wait(0.01)
+                continue
+
+            if self.frame_interval:
+                next_due += self.frame_interval
+                delay = next_due - time.monotonic()
+                if delay > 0:
+                    self._stop_event.wait(delay)
+                else:
+                    next_due = time.monotonic()
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+def buffer_timestamp(cap, fallback):
+    """
+    帧的驱动缓冲区时间戳 (V4L2 为 CLOCK_MONOTONIC，与 time.monotonic 同一时钟)，比读取返回的时刻更接近曝光时刻；
+    取不到或明显不符 (如视频文件返回的是播放位置) 时返回 fallback。
+    """
+    t = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+    return t if 0 < fallback - t < 1.0 else fallback
+
+
+def capture_mode_label(workers=(), pool=None):
+    """实际使用的采集方式 (写入日志的路间偏差统计)"""
+    if pool is not None:
+        return "多进程逐路采集"
+    if any(w.group is not None for w in workers):
+        return "同步 grab/retrieve"
+    return "逐路独立采集"
+
+
+def start_capture_threads(workers, sync=CAPTURE_SYNC):
+    """启动采集：默认每路一个 CaptureWorker 线程；sync 时由一个 SyncCaptureGroup 线程驱动所有路"""
+    if sync and len(workers) > 1:
+        SyncCaptureGroup(workers).start()
+        return
+    for worker in workers:
+        worker.start()
+
+
+# ==========================================
+# [新增] 摄像头发现 (V4L2 能力查询 + 并行探测 + 设备清单缓存)
+# ==========================================
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_VIDEO_CAPTURE_MPLANE = 0x00001000
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+_V4L2_CAPABILITY_SIZE = 104  # sizeof(struct v4l2_capability)
+VIDIOC_QUERYCAP = (2 << 30) | (_V4L2_CAPABILITY_SIZE << 16) | (ord('V') << 8) | 0
+
+
+def v4l2_query_capture(devnode):
+    """用 VIDIOC_QUERYCAP 查询设备，是视频采集节点则返回设备名 (card)，否则返回 None (不打开视频流，很快)"""
+    if fcntl is None:
+        return None
+    try:
+        fd = os.open(devnode, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        buf = bytearray(_V4L2_CAPABILITY_SIZE)
+        fcntl.ioctl(fd, VIDIOC_QUERYCAP, buf)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+    capabilities, device_caps = struct.unpack_from("II", buf, 84)
+    caps = device_caps if capabilities & V4L2_CAP_DEVICE_CAPS else capabilities
+    if not caps & (V4L2_CAP_VIDEO_CAPTURE | V4L2_CAP_VIDEO_CAPTURE_MPLANE):
+        return None  # 元数据节点 / 输出节点等
+    return bytes(buf[16:48]).split(b"\0", 1)[0].decode("utf-8", "replace")
+
+
+def list_capture_devices():
+    """枚举 /dev/video*，只保留采集节点。返回 [{'device', 'index', 'stable_id', 'card'}]"""
+    stable = {}
+    for link_dir in ("/dev/v4l/by-path", "/dev/v4l/by-id"):  # by-id 优先，后写覆盖
+        for link in glob.glob(os.path.join(link_dir, "*")):
+            stable[os.path.realpath(link)] = link
+
+    devices = []
+    for devnode in sorted(glob.glob("/dev/video*"), key=lambda d: int("".join(filter(str.isdigit, d)) or 0)):
+        card = v4l2_query_capture(devnode)
+        if card is None:
+            continue
+        devices.append({
+            'device': devnode,
+            'index': int("".join(filter(str.isdigit, os.path.basename(devnode)))),
+            'stable_id': stable.get(os.path.realpath(devnode), devnode),
+            'card': card
+        })
+    return devices
+
+
+# 仍在进行的探测：index -> threading.Event (探测结束、设备已释放时置位)。
+# 卡在 cap.read() 里的探测线程仍占着设备，结束前不再探测或打开同一设备
+_probes_in_flight = {}
+_probes_lock = threading.Lock()
+
+
+def wait_probe_finished(index, timeout=0.0):
+    """等待该设备上仍在进行的探测结束，返回设备是否已空闲"""
+    with _probes_lock:
+        finished = _probes_in_flight.get(index)
+    return finished is None or finished.wait(timeout)
+
+
+def _start_probe(index, results):
+    """在守护线程中探测设备 (卡死的 USB 设备不会阻止程序退出)，返回探测结束时置位的 Event"""
+    finished = threading.Event()
+    with _probes_lock:
+        _probes_in_flight[index] = finished
+
+    def run():
+        try:
+            results[index] = _probe_camera(index)
+        except Exception as e:
+            print(f"[警告] 探测 /dev/video{index} 出错: {e}")
+            results[index] = None
+        finally:
+            with _probes_lock:
+                _probes_in_flight.pop(index, None)
+            finished.set()
+
+    threading.Thread(target=run, name=f"camera-probe-{index}", daemon=True).start()
+    return finished
+
+
+def _probe_camera(index):
+    """打开设备并读一帧，成功返回 "宽x高"，否则返回 None"""
+    cap = cv2.VideoCapture(index, cv2.CAP_V4L2)
+    try:
+        if cap.isOpened():
+            ret, frame = cap.read()
+            if ret:
+                h, w = frame.shape[:2]
+                return f"{w}x{h}"
+        return None
+    finally:
+        cap.release()
+
+
+def discover_cameras(use_cache=True, timeout=CAMERA_PROBE_TIMEOUT, cache_file=CAMERA_CACHE_FILE, log=print):
+    """
+    发现可用摄像头，返回 [(index, info_str)]。
+    先用 V4L2 能力查询筛出采集节点；若节点集合 (稳定路径 -> 设备节点) 与缓存一致则直接返回缓存，
+    否则并行探测所有候选设备 (每个设备最多等待 timeout 秒) 并更新缓存。
+    非 Linux 平台退回到并行探测 0-20 号索引。
+    """
+    devices = list_capture_devices()
+    if devices:
+        fingerprint = sorted([d['stable_id'], d['device']] for d in devices)
+        if use_cache and cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+                if cache.get('fingerprint') == fingerprint:
+                    log(f"设备未变化，使用缓存的设备清单 ({len(cache['cameras'])} 个)")
+                    return [(c['index'], c['info']) for c in cache['cameras']]
+            except Exception as e:
+                log(f"设备清单缓存无效: {e}")
+        candidates = {d['index']: d for d in devices}
+    else:
+        fingerprint = None
+        candidates = {i: None for i in range(21)}
+
+    # 并行探测 (守护线程)，共用一个截止时间；超时的设备放弃，探测线程结束 (释放设备) 前不再探测它
+    results = {}
+    probes = {}
+    not_done = []
+    for idx in candidates:
+        if not wait_probe_finished(idx):
+            log(f"/dev/video{idx} 上次的探测尚未结束，跳过")
+            not_done.append(idx)
+        else:
+            probes[idx] = _start_probe(idx, results)
+    deadline = time.monotonic() + timeout
+    for idx, finished in probes.items():
+        if not finished.wait(max(0.0, deadline - time.monotonic())):
+            log(f"探测超时: /dev/video{idx}")
+            not_done.append(idx)
+
+    cameras = []
+    for idx in probes:
+        info = results.get(idx) if idx not in not_done else None
+        if info is None:
+            continue
+        dev = candidates[idx]
+        if dev is not None:
+            info = f"{info} {dev['card']} ({os.path.basename(dev['stable_id'])})"
+        cameras.append({'index': idx, 'info': info, 'stable_id': dev['stable_id'] if dev else None})
+    cameras.sort(key=lambda c: c['index'])
+
+    if fingerprint is not None and cache_file and not not_done:
+        # 有设备探测超时时不写缓存，否则之后同样的设备组合会一直缺这台摄像头
+        try:
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'fingerprint': fingerprint, 'cameras': cameras}, f, indent=4, ensure_ascii=False)
+        except Exception as e:
+            log(f"无法写入设备清单缓存: {e}")
+    return [(c['index'], c['info']) for c in cameras]
+
+
+# ==========================================
+# [新增] 采集格式协商 (按 USB 总线带宽为每路选择 FOURCC / 分辨率 / 帧率)
+# ==========================================
+MJPEG_BANDWIDTH_RATIO = 0.25  # MJPG 相对同分辨率 YUYV 的带宽估算比例
+
+
+def profile_bandwidth(profile):
+    """估算某个采集格式占用的 USB 带宽 (MB/s)，格式里给出 bandwidth 时直接使用"""
+    if profile.get('bandwidth'):
+        return float(profile['bandwidth'])
+    raw = profile['width'] * profile['height'] * 2 * (profile.get('fps') or 30) / 1e6
+    return raw * MJPEG_BANDWIDTH_RATIO if profile['fourcc'].upper() == "MJPG" else raw
+
+
+def format_label(fmt):
+    return f"{fmt['fourcc']} {fmt['width']}x{fmt['height']}@{fmt['fps']:g}"
+
+
+def v4l2_usb_bus(index):
+    """返回 /dev/video<index> 所在的 USB 总线 (如 "usb1")，非 USB 设备或非 Linux 返回 None"""
+    path = os.path.realpath(f"/sys/class/video4linux/video{index}/device")
+    for part in path.split(os.sep):
+        if re.fullmatch(r"usb\d+", part):
+            return part
+    return None
+
+
+def camera_profiles(index, stable_id=None):
+    """某个摄像头的候选格式列表：CAMERA_CAPTURE_PROFILES 中按序号或稳定路径单独配置的优先"""
+    for key in (str(index), stable_id):
+        if key and key in CAMERA_CAPTURE_PROFILES:
+            return CAMERA_CAPTURE_PROFILES[key]
+    return CAPTURE_PROFILES
+
+
+def capture_format(cap):
+    """读回设备当前的采集格式"""
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    return {
+        'fourcc': fourcc_str(cap.get(cv2.CAP_PROP_FOURCC)),
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        'fps': round(fps, 2) if fps and fps > 0 else 30.0,
+        'buffer_size': int(cap.get(cv2.CAP_PROP_BUFFERSIZE))
+    }
+
+
+def apply_capture_profile(cap, profile):
+    """
+    按候选格式设置设备 (只做格式协商，不启动视频流) 并读回实际格式。
+    驱动接受了 FOURCC 与分辨率时返回实际格式 (帧率以驱动读回为准)，否则返回 None。
+    """
+    fourcc = profile['fourcc'].upper()
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, profile['width'])
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, profile['height'])
+    if profile.get('fps'):
+        cap.set(cv2.CAP_PROP_FPS, profile['fps'])
+    if profile.get('buffer_size'):
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, profile['buffer_size'])
+    fmt = capture_format(cap)
+    if fmt['fourcc'] != fourcc or (fmt['width'], fmt['height']) != (profile['width'], profile['height']):
+        return None
+    if profile.get('bandwidth'):
+        fmt['bandwidth'] = profile['bandwidth']
+    return fmt
+
+
+def plan_capture_profiles(cameras, probe, budget=USB_BUS_BANDWIDTH):
+    """
+    为每路选择候选格式。cameras: [(总线, 候选数)]；probe(i, k) 返回第 i 路第 k 个候选的实际格式，不支持时为 None。
+    每路先取第一个支持的候选；某条总线估算带宽超出 budget 时，把该总线上占用最大、且还有更省带宽候选的一路
+    降到其后第一个更省带宽的候选，直到不超预算或无法再降 (总线为 None 的设备不参与分配)。
+    返回 (每路选中的候选序号 (都不支持时为 None), {总线: 估算带宽})。
+    """
+    choice = [next((k for k in range(n) if probe(i, k)), None) for i, (_, n) in enumerate(cameras)]
+
+    def usage(i):
+        return profile_bandwidth(probe(i, choice[i])) if choice[i] is not None else 0.0
+
+    def cheaper(i):
+        if choice[i] is None:
+            return None
+        current = usage(i)
+        return next((k for k in range(choice[i] + 1, cameras[i][1])
+                     if probe(i, k) and profile_bandwidth(probe(i, k)) < current), None)
+
+    buses = {}
+    for i, (bus, _) in enumerate(cameras):
+        if bus is not None:
+            buses.setdefault(bus, []).append(i)
+    totals = {}
+    for bus, members in buses.items():
+        while sum(usage(i) for i in members) > budget:
+            movable = [i for i in members if cheaper(i) is not None]
+            if not movable:
+                break
+            worst = max(movable, key=usage)
+            choice[worst] = cheaper(worst)
+        totals[bus] = sum(usage(i) for i in members)
+    return choice, totals
+
+
+def open_sources(sources, is_file=False, log=print, profiles=None, formats=None):
+    """
+    打开视频源，返回 (caps, names)。文件模式下 sources[0] 是路径，摄像头模式下是索引列表。
+    [修改] 摄像头按候选格式与所在 USB 总线的带宽协商采集格式；profiles 可直接给出每路候选
+    (多进程子进程沿用主进程的协商结果)，formats 为列表时追加每路实际格式 (含 camera / bus / bandwidth)。
+    """
+    caps = []
+    names = []
+    if is_file:
+        cap = cv2.VideoCapture(sources[0])
+        if cap.isOpened():
+            caps.append(cap)
+            names.append(os.path.basename(sources[0]))
+        else:
+            log("无法打开视频文件")
+        return caps, names
+
+    stable = {}
+    if profiles is None:
+        stable = {d['index']: d['stable_id'] for d in list_capture_devices()}
+    opened = []
+    for i, idx in enumerate(sources):
+        if not wait_probe_finished(idx, CAMERA_PROBE_TIMEOUT):
+            log(f"警告: 摄像头 {idx} 的探测仍未结束 (设备无响应)，暂不打开")
+            continue
+        cap = cv2.VideoCapture(idx, cv2.CAP_V4L2)
+        if cap.isOpened():
+            candidates = profiles[i] if profiles is not None else camera_profiles(idx, stable.get(idx))
+            opened.append((idx, cap, candidates))
+        else:
+            log(f"警告: 无法打开选中摄像头 {idx}")
+
+    # 每个候选只在第一次用到时向驱动协商一次
+    probed = {}
+    def probe(i, k):
+        if (i, k) not in probed:
+            probed[i, k] = apply_capture_profile(opened[i][1], opened[i][2][k])
+        return probed[i, k]
+
+    choice, totals = plan_capture_profiles([(v4l2_usb_bus(idx), len(c)) for idx, _, c in opened], probe)
+    for bus, total in sorted(totals.items()):
+        log(f"USB 总线 {bus}: 估算带宽 {total:.1f}/{USB_BUS_BANDWIDTH:g} MB/s")
+        if total > USB_BUS_BANDWIDTH:
+            log(f"警告: 总线 {bus} 上的摄像头已无法再降级，可能掉帧或无法启动，请把部分摄像头接到其他总线")
+
+    for i, (idx, cap, candidates) in enumerate(opened):
+        if choice[i] is None:
+            log(f"警告: 摄像头 {idx} 不支持任何候选格式，使用驱动默认格式")
+            fmt = capture_format(cap)
+        else:
+            # 协商过程中设备最后停留在别的候选上，重新应用选中的格式
+            fmt = apply_capture_profile(cap, probe(i, choice[i])) or capture_format(cap)
+        fmt.update(camera=idx, bus=v4l2_usb_bus(idx), bandwidth=round(profile_bandwidth(fmt), 2))
+        log(f"摄像头 {idx}: {format_label(fmt)} (约 {fmt['bandwidth']:g} MB/s)")
+        if CAPTURE_YUYV_GRAY:
+            enable_yuyv_capture(cap, log)
+
+        caps.append(cap)
+        names.append(str(idx))
+        if formats is not None:
+            formats.append(fmt)
+    return caps, names
+
+
+def start_capture_workers(caps, names, is_file=False):
+    """读取每路首帧并创建采集线程 (尚未 start)，返回 (workers, first_frames)"""
+    workers = []
+    frames = []
+    for cap, name in zip(caps, names):
+        worker = CaptureWorker(cap, name, loop_file=is_file)
+        ret, f = cap.read()
+        if ret and worker.yuyv_size is not None:
+            f = as_yuyv(f, worker.yuyv_size)
+            ret = f is not None
+        if not ret:
+            # 假如某个坏了，给个黑帧
+            f = np.zeros((480, 640, 3), dtype=np.uint8)
+        frames.append(f)
+
+        # 首帧预先放入槽位，主循环启动后立即有画面
+        if ret:
+            worker.slot.put(f, time.monotonic())
+        workers.append(worker)
+    return workers, frames
+
+
+_BLACK_FRAME = np.zeros((480, 640, 3), dtype=np.uint8)
+_BLACK_FRAME.flags.writeable = False
+
+
+def collect_latest_frames(workers):
+    """
+    从各采集线程取最新帧，返回 (frames, stamp)。掉线或尚未出帧的摄像头补黑帧。
+    stamp = {'t': 拼接帧的采集时刻 (各路中最晚一路的 time.monotonic), 'camera_ts': [...], 'camera_seq': [...],
+             'skew': 路间采集偏差 (秒)}，见 capture_stamp
+    """
+    frames = []
+    camera_ts = []
+    camera_seq = []
+    group = workers[0].group if workers else None
+    with group.lock if group is not None else contextlib.nullcontext():
+        latest = [worker.latest() for worker in workers]
+    for worker, (frame, seq, ts) in zip(workers, latest):
+        if frame is None or worker.signal_lost:
+            # 尚未出帧或摄像头掉线，补黑帧 (共用一块只读黑帧)
+            frame = _BLACK_FRAME
+            seq, ts = None, None
+        frames.append(frame)
+        camera_ts.append(ts)
+        camera_seq.append(seq)
+
+    return frames, capture_stamp(camera_ts, camera_seq)
+
+
+def capture_stamp(camera_ts, camera_seq):
+    """
+    拼接帧的时间戳：t 取各路中最晚一路的采集时刻；skew 为各路采集时刻的最大差 (秒，不足两路有效时为 None)。
+    """
+    valid_ts = [t for t in camera_ts if t is not None]
+    return {
+        't': max(valid_ts) if valid_ts else time.monotonic(),
+        'camera_ts': camera_ts,
+        'camera_seq': camera_seq,
+        'skew': max(valid_ts) - min(valid_ts) if len(valid_ts) > 1 else None
+    }
+
+
+def next_deadline(deadline, period, now):
+    """
+    截止时间按固定周期推进 (不随处理耗时漂移)；已经错过的节拍直接跳过、不补跑。
+    返回 (下一个截止时间, 跳过的节拍数)。
+    """
+    deadline += period
+    if deadline <= now:
+        skipped = int((now - deadline) // period) + 1
+        return deadline + skipped * period, skipped
+    return deadline, 0
+
+
+def camera_part_widths(native_sizes, frame_w):
+    """按各路统一高度后的宽度比例把拼接画面宽度 frame_w 分给各路，返回每路宽度 (之和恰为 frame_w)"""
+    base_h = native_sizes[0][1]
+    widths = [w * base_h / h for w, h in native_sizes]
+    total = sum(widths)
+    edges = [int(round(frame_w * s / total)) for s in itertools.accumulate(widths)]
+    return [b - a for a, b in zip([0] + edges[:-1], edges)]
+
+
+class CameraLayout:
+    """
+    [新增] 拼接画面与各摄像头坐标之间的映射。检测在每路的检测分辨率上单独进行，ROI 也以该坐标保存；
+    拼接画面只用于预览与总览录像。
+    native_sizes:  各路原始 (宽, 高)，决定各路在拼接画面中的分块宽度 (统一高度、保持比例)
+    working_sizes: 各路检测分辨率 (宽, 高)，为 None 时与 native_sizes 相同
+    display_size:  拼接画面 (宽, 高)，为 None 时取以第一路高度拼接的原始尺寸
+    """
+    def __init__(self, native_sizes, working_sizes=None, display_size=None):
+        self.native_sizes = [tuple(s) for s in native_sizes]
+        self.working_sizes = [tuple(s) for s in (working_sizes or native_sizes)]
+        if display_size is None:
+            display_size = self.natural_size(self.native_sizes)
+        self.display_size = tuple(display_size)
+        self.tile_widths = camera_part_widths(self.native_sizes, self.display_size[0])
+        self.offsets = [0] + list(itertools.accumulate(self.tile_widths))
+        # [新增] 拼接画面与各路检测分辨率画面只分配一次，之后每帧用 dst= 直接写入 (不再 hstack / 二次缩放)
+        w, h = self.display_size
+        self.frame = np.zeros((h, w, 3), dtype=np.uint8)
+        self.tiles = [self.frame[:, x0:x1] for x0, x1 in zip(self.offsets, self.offsets[1:])]
+        self._work = [np.empty((wh, ww, 3), dtype=np.uint8) for ww, wh in self.working_sizes]
+        self._work_gray = [np.empty((wh, ww), dtype=np.uint8) for ww, wh in self.working_sizes]
+        self._luma = [None] * len(self.native_sizes)  # YUYV 原始帧的 Y 平面 (首次用到时按原始尺寸分配)
+        self._bgr = [None] * len(self.native_sizes)   # YUYV 原始帧转出的彩色图 (只在合成预览/录像时用)
+
+    @staticmethod
+    def natural_size(native_sizes):
+        base_h = native_sizes[0][1]
+        return sum(int(w * base_h / h) for w, h in native_sizes), base_h
+
+    @staticmethod
+    def working_sizes_for(native_sizes, detect_resolution=DETECT_RESOLUTION):
+        if detect_resolution:
+            return [tuple(detect_resolution)] * len(native_sizes)
+        return list(native_sizes)
+
+    def _scale(self, cam):
+        ww, wh = self.working_sizes[cam]
+        return self.tile_widths[cam] / ww, self.display_size[1] / wh
+
+    def to_display(self, cam, rect):
+        """某路检测坐标 → 拼接画面坐标"""
+        sx, sy = self._scale(cam)
+        x, y, w, h = rect
+        return (int(round(self.offsets[cam] + x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy)))
+
+    def from_display(self, rect):
+        """拼接画面坐标 → (摄像头序号, 该路检测坐标)。按区域中心所在的一路，跨到相邻一路的部分裁掉"""
+        x, y, w, h = rect
+        cam = min(max(bisect.bisect_right(self.offsets, x + w / 2) - 1, 0), len(self.tile_widths) - 1)
+        x0, x1 = max(x, self.offsets[cam]), min(x + w, self.offsets[cam + 1])
+        sx, sy = self._scale(cam)
+        return cam, (int(round((x0 - self.offsets[cam]) / sx)), int(round(y / sy)),
+                     int(round((x1 - x0) / sx)), int(round(h / sy)))
+
+    def rois_to_display(self, rois, roi_cameras):
+        return {name: self.to_display(roi_cameras.get(name, 0), rect) for name, rect in rois.items()}
+
+    def import_rois(self, rois, roi_cameras, camera_sizes, frame_size):
+        """
+        把 load_rois 读出的区域换算到本布局，返回 (rois, roi_cameras)。
+        新格式按保存时各路检测分辨率缩放；旧格式 (拼接画面坐标) 先缩放到当前拼接画面再分到各路。
+        """
+        out, cameras = {}, {}
+        if camera_sizes is None:
+            sx = self.display_size[0] / frame_size[0]
+            sy = self.display_size[1] / frame_size[1]
+            for name, (x, y, w, h) in rois.items():
+                cameras[name], out[name] = self.from_display((int(x*sx), int(y*sy), int(w*sx), int(h*sy)))
+            return out, cameras
+        for name, (x, y, w, h) in rois.items():
+            cam = roi_cameras.get(name, 0)
+            if cam >= len(self.working_sizes):
+                print(f"[警告] 区域 {name} 属于摄像头 {cam}，当前只有 {len(self.working_sizes)} 路，已忽略")
+                continue
+            sw, sh = camera_sizes[cam]
+            ww, wh = self.working_sizes[cam]
+            sx, sy = ww / sw, wh / sh
+            out[name] = (int(x*sx), int(y*sy), int(w*sx), int(h*sy))
+            cameras[name] = cam
+        return out, cameras
+
+    def crop_tile(self, image, cam):
+        """把拼接画面尺度的图片 (如背景更新掩码) 缩放到拼接画面后裁出某一路的分块"""
+        image = cv2.resize(image, self.display_size, interpolation=cv2.INTER_NEAREST)
+        return np.ascontiguousarray(image[:, self.offsets[cam]:self.offsets[cam + 1]])
+
+    @staticmethod
+    def _reuse(buf, shape):
+        return buf if buf is not None and buf.shape == shape else np.empty(shape, dtype=np.uint8)
+
+    def to_working(self, cam, frame):
+        """
+        把某路画面缩放到检测分辨率 (尺寸相同时原样返回，否则写入该路的预分配缓冲区)。
+        YUYV 原始帧先取出 Y 平面，之后只缩放灰度图，不做颜色转换。
+        """
+        size = self.working_sizes[cam]
+        if frame.ndim == 3 and frame.shape[2] == 2:
+            self._luma[cam] = self._reuse(self._luma[cam], frame.shape[:2])
+            frame = frame_to_luma(frame, dst=self._luma[cam])
+        if (frame.shape[1], frame.shape[0]) == size:
+            return frame
+        return cv2.resize(frame, size, dst=self._work_gray[cam] if frame.ndim == 2 else self._work[cam])
+
+    def compose(self, frames):
+        """
+        把各路画面缩放 (或原样复制) 进拼接画面中各自的分块视图，返回拼接画面 (每次复用同一块缓冲区)。
+        非 BGR 画面在这里才转为彩色，因此只应对要显示或录像的帧调用。
+        """
+        for cam, (frame, tile) in enumerate(zip(frames, self.tiles)):
+            if frame.ndim == 2 or frame.shape[2] != 3:
+                self._bgr[cam] = self._reuse(self._bgr[cam], frame.shape[:2] + (3,))
+                frame = frame_to_bgr(frame, dst=self._bgr[cam])
+            if frame.shape == tile.shape:
+                np.copyto(tile, frame)
+            else:
+                cv2.resize(frame, (tile.shape[1], tile.shape[0]), dst=tile)
+        return self.frame
+
+
+def save_rois(path, rois, roi_cameras, camera_sizes):
+    """保存检测区域：每个区域记录所属摄像头及该路检测分辨率下的坐标，camera_sizes 为各路检测分辨率"""
+    data = {
+        'camera_sizes': [list(s) for s in camera_sizes],
+        'rois': {name: {'camera': roi_cameras.get(name, 0), 'rect': list(rect)} for name, rect in rois.items()}
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+
+
+def load_rois(path):
+    """
+    读取检测区域，返回 (rois, roi_cameras, camera_sizes, frame_size)，用 CameraLayout.import_rois 换算到当前画面。
+    旧格式 (拼接画面坐标 + frame_size) 的 camera_sizes 为 None、roi_cameras 为空；新格式的 frame_size 为 None。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    rois, roi_cameras = {}, {}
+    for name, entry in data.get('rois', {}).items():
+        if isinstance(entry, dict):
+            roi_cameras[name] = int(entry.get('camera', 0))
+            entry = entry['rect']
+        rois[name] = tuple(int(v) for v in entry)
+    if 'camera_sizes' in data:
+        return rois, roi_cameras, [tuple(s) for s in data['camera_sizes']], None
+    return rois, roi_cameras, None, tuple(data.get('frame_size', (800, 600)))
+
+
+# 每种 ROI 状态对应的 (颜色BGR, 线宽, 标签后缀)
+ROI_STATE_STYLES = {
+    'preview':      ((0, 255, 0),   2, ""),
+    'preview_act':  ((0, 0, 255),   2, " (Preview)"),
+    'train':        ((0, 140, 255), 2, " (TRAIN)"),
+    'shock':        ((0, 0, 255),   3, " (SHOCK)"),
+    'done':         ((0, 255, 0),   2, ""),
+    'monitor':      ((255, 255, 0), 2, " (MONITOR)"),
+    'rec':          ((255, 0, 0),   3, " (REC)"),
+}
+
+
+def annotate_frame(frame, roi_results, timestamp_str=None, layout=None):
+    """在画面上绘制各检测区域及全局时间戳 (原地修改)。给出 layout 时区域坐标按所属摄像头换算到拼接画面"""
+    for r in roi_results:
+        x, y, w, h = layout.to_display(r.get('camera', 0), r['rect']) if layout is not None else r['rect']
+        color, thickness, suffix = ROI_STATE_STYLES[r['state']]
+        if r['state'] == 'done':
+            label_text = f"{r['name']}: DONE"
+        else:
+            label_text = f"{r['name']}:{int(r['score'])}%{suffix}"
+        cv2.rectangle(frame, (x, y), (x+w, y+h), color, thickness)
+        cv2.putText(frame, label_text, (x, y-5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+
+    # 绘制全局时间戳
+    if timestamp_str is None:
+        timestamp_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ts_pos = (20, 40)
+    cv2.putText(frame, timestamp_str, ts_pos, cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 4)
+    cv2.putText(frame, timestamp_str, ts_pos, cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    return frame
+
+
+class AsyncVideoWriter:
+    """
+    单个视频文件的异步编码器：调用方只把帧放入有界队列，编码 (VideoWriter.write) 在独立线程中完成。
+    队列满时按 drop_policy 处理："block" 阻塞调用方，"drop_oldest" 丢弃队列中最旧的帧，"drop_newest" 丢弃当前帧。
+    放入队列的帧归编码线程所有，调用方之后不能再修改它。
+    给出 times_path 时，每编码一帧就向该文件追加一个 float64 (小端) 采集时刻 (Unix 秒，未知为 NaN)，
+    与视频帧一一对应 (被丢弃的帧不写)，离线分析据此还原真实时间轴。
+    """
+    def __init__(self, filename, fourcc, fps, frame_size, queue_size=RECORD_QUEUE_SIZE, drop_policy=RECORD_DROP_POLICY,
+                 times_path=None):
+        self.filename = filename
+        self.frame_size = tuple(frame_size)
+        self.drop_policy = drop_policy
+        self.writer = cv2.VideoWriter(filename, fourcc, fps, self.frame_size)
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.encode_ms_avg = 0.0
+        self.encode_ms_max = 0.0
+        self._thread = None
+        self._times = None
+        if self.writer.isOpened():
+            if times_path:
+                self._times = open(times_path, 'wb')
+            self._thread = threading.Thread(target=self._encode_loop, name=f"encoder-{os.path.basename(filename)}", daemon=True)
+            self._thread.start()
+
+    def isOpened(self):
+        return self._thread is not None
+
+    def write(self, frame, t=None):
+        item = (frame, t)
+        if self.drop_policy == "block":
+            self._queue.put(item)
+        elif self.drop_policy == "drop_newest":
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.frames_dropped += 1
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.frames_dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def _encode_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            frame, t = item
+            t0 = time.perf_counter()
+            try:
+                self.writer.write(frame)
+                if self._times is not None:
+                    self._times.write(struct.pack('<d', float('nan') if t is None else t))
+            except Exception as e:
+                print(f"写入帧错误: {e}")
+            cost = (time.perf_counter() - t0) * 1000
+            METRICS.observe("encode", cost / 1000)
+            self.frames_written += 1
+            self.encode_ms_avg = cost if self.frames_written == 1 else self.encode_ms_avg * 0.95 + cost * 0.05
+            self.encode_ms_max = max(self.encode_ms_max, cost)
+        self.writer.release()
+        if self._times is not None:
+            self._times.close()
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'written': self.frames_written,
+            'dropped': self.frames_dropped,
+            'encode_ms_avg': self.encode_ms_avg,
+            'encode_ms_max': self.encode_ms_max,
+        }
+
+    def release(self):
+        """等待队列中剩余帧编码完成后关闭文件"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        else:
+            self.writer.release()
+
+
+def frame_times_path(video_path):
+    """总览录像的逐帧采集时刻文件 (与视频同名，扩展名 .times)"""
+    return os.path.splitext(video_path)[0] + ".times"
+
+
+def load_frame_times(video_path):
+    """读取录像的逐帧采集时刻 (Unix 秒，float64 数组)；没有 .times 文件时返回 None"""
+    path = frame_times_path(video_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return np.frombuffer(raw[:len(raw) // 8 * 8], dtype='<f8')
+
+
+def overview_record_fps(camera_fps=()):
+    """总览流的容器帧率：主循环只在有新帧的检测节拍写一帧，实际写入速率为 min(DETECT_FPS, 摄像头帧率)"""
+    rates = [f for f in camera_fps if f and f > 0]
+    return float(min(DETECT_FPS, max(rates))) if rates else float(DETECT_FPS)
+
+
+class VideoRecorder:
+    """
+    录像封装：
+    - 总览流：检测画面按 scale_factor 缩放后 (带标注) 交给 AsyncVideoWriter 异步编码；
+      传入采集时间戳时按容器帧率定速 (漏拍补写上一帧、超速的帧丢弃)，回放速度与真实时间一致
+    - 分路流 (RECORD_PER_CAMERA)：每个采集线程把原始分辨率的帧直接送入各自的 AsyncVideoWriter，多路并行编码
+    """
+    def __init__(self, log_callback=print):
+        self.video_writer = None
+        self.recording_filename = None
+        self.camera_writers = []  # [(CaptureWorker, AsyncVideoWriter)]
+        self.record_w = 0
+        self.record_h = 0
+        self.fps = 0.0
+        self._t0 = None             # 总览流首帧的采集时刻
+        self._overview_frames = 0   # 已送入总览流的帧数
+        self._epoch_offset = 0.0
+        self.log = log_callback
+
+    @property
+    def is_recording(self):
+        return self.video_writer is not None or bool(self.camera_writers)
+
+    def start(self, prefix_name, frame_size, fps=None, scale_factor=0.5, workers=None,
+              per_camera=RECORD_PER_CAMERA, overview=RECORD_OVERVIEW):
+        """fps 为 None 时按 overview_record_fps 取各采集线程的帧率 (无采集线程时为 DETECT_FPS)"""
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        per_camera = per_camera and bool(workers)
+
+        if per_camera:
+            for worker in workers:
+                w, h, cam_fps = worker.native_format()
+                safe_name = "".join(c if c.isalnum() else "_" for c in str(worker.source_name))
+                filename = f"{prefix_name}_{timestamp}_cam{safe_name}.mp4"
+                try:
+                    writer = AsyncVideoWriter(filename, fourcc, cam_fps, (w, h))
+                except Exception as e:
+                    self.log(f"❌ 分路录像错误 ({worker.source_name}): {str(e)}")
+                    continue
+                if writer.isOpened():
+                    worker.record_sink = writer
+                    self.camera_writers.append((worker, writer))
+                    self.log(f"🎥 分路录像开始 (Res: {w}x{h} @ {cam_fps:.1f}fps): {filename}")
+                else:
+                    self.log(f"❌ 分路录像初始化失败: {filename}")
+
+        if per_camera and not overview:
+            return
+
+        try:
+            filename = f"{prefix_name}_{timestamp}.mp4"
+            self.record_w = int(frame_size[0] * scale_factor)
+            self.record_h = int(frame_size[1] * scale_factor)
+            if fps is None:
+                fps = overview_record_fps([w.native_format()[2] for w in workers or []])
+            self.fps = fps
+            self._t0 = None
+            self._overview_frames = 0
+            self._epoch_offset = mono_to_datetime(0.0).timestamp()  # 单调时钟 → Unix 秒
+            self.video_writer = AsyncVideoWriter(filename, fourcc, fps, (self.record_w, self.record_h),
+                                                 times_path=frame_times_path(filename))
+
+            if self.video_writer.isOpened():
+                self.recording_filename = filename
+                self.log(f"🎥 录像开始 (Res: {self.record_w}x{self.record_h} @ {fps:g}fps): {filename}")
+            else:
+                self.log("❌ 录像初始化失败！")
+                self.video_writer = None
+        except Exception as e:
+            self.log(f"❌ 录像错误: {str(e)}")
+            self.video_writer = None
+
+    def write(self, frame, t=None):
+        """
+        写入总览流 (分路流由采集线程直接送帧)。t 为该帧的采集时刻 (秒)：给出时按容器帧率定速，
+        容器时间轴上还没到下一帧的位置就丢弃本帧，漏掉的位置用本帧补齐 (单次最多补 1 秒，再长的停顿直接跳过)。
+        """
+        if self.video_writer is None:
+            return
+        copies = 1
+        if t is not None:
+            if self._t0 is None:
+                self._t0 = t
+            due = int((t - self._t0) * self.fps) + 1  # 到 t 为止容器中应有的帧数
+            copies = min(due - self._overview_frames, max(1, int(self.fps)))
+            if copies <= 0:
+                return
+            self._overview_frames = max(due - copies, self._overview_frames)
+        # 缩放在调用线程完成 (得到一份新数组，之后归编码线程所有)，编码在编码线程完成；补写的帧共用这份只读数组
+        frame = cv2.resize(frame, (self.record_w, self.record_h))
+        epoch = None if t is None else t + self._epoch_offset
+        for _ in range(copies):
+            self.video_writer.write(frame, epoch)
+        self._overview_frames += copies
+
+    def stats(self):
+        """汇总所有录像流：最大队列深度、最大平均编码耗时、丢帧总数"""
+        writers = [w for _, w in self.camera_writers]
+        if self.video_writer:
+            writers.append(self.video_writer)
+        if not writers:
+            return None
+        all_stats = [w.stats() for w in writers]
+        return {
+            'streams': len(all_stats),
+            'queue_depth': max(st['queue_depth'] for st in all_stats),
+            'queue_size': all_stats[0]['queue_size'],
+            'written': sum(st['written'] for st in all_stats),
+            'dropped': sum(st['dropped'] for st in all_stats),
+            'encode_ms_avg': max(st['encode_ms_avg'] for st in all_stats),
+            'encode_ms_max': max(st['encode_ms_max'] for st in all_stats),
+        }
+
+    def stop(self):
+        for worker, writer in self.camera_writers:
+            worker.record_sink = None
+        for worker, writer in self.camera_writers:
+            stats = writer.stats()
+            writer.release()
+            self.log(f"💾 分路录像已保存: {writer.filename} (编码 {stats['written']} 帧, 丢弃 {stats['dropped']} 帧)")
+        self.camera_writers = []
+
+        if self.video_writer:
+            stats = self.video_writer.stats()
+            self.video_writer.release()
+            self.video_writer = None
+            self.log(f"💾 录像已保存: {self.recording_filename} "
+                     f"(编码 {stats['written']} 帧, 丢弃 {stats['dropped']} 帧, 平均编码 {stats['encode_ms_avg']:.1f}ms)")
+            self.recording_filename = None
+
+
+# --- 事件日志 ---
+class EventJournal:
+    """
+    只追加的会话事件日志 (每行一个 JSON)。append() 只进内存缓冲，
+    后台线程每隔 fsync_interval 秒批量写入并 fsync，关闭时写完剩余部分。
+    """
+    def __init__(self, path, fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self._file = open(path, 'a', encoding='utf-8')
+        self._pending = []
+        self._lock = threading.Lock()        # 保护缓冲区
+        self._write_lock = threading.Lock()  # 保证批次按顺序写入
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._pending.append(line)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+            if lines and not self._file.closed:
+                self._file.write("\n".join(lines) + "\n")
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def _flush_loop(self):
+        while not self._closing.wait(self.fsync_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[错误] 事件日志写入失败: {e}")
+
+    def close(self):
+        if self._closing.is_set():
+            return
+        self._closing.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+
+def read_journal(path):
+    """逐行读取事件日志；断电造成的末尾半行直接忽略"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def replay_journal(records):
+    """
+    把事件日志回放成会话数据:
+    {'mode', 'start', 'end', 'reason', 'cfg', 'rois', 'roi_cameras', 'shock_counts', 'shock_history', 'dwells': {box: [...]}}
+    'start'/'end' 为 datetime，'end' 在会话未正常结束时为 None。
+    """
+    session = {'mode': None, 'start': None, 'end': None, 'reason': None, 'cfg': {}, 'rois': {}, 'roi_cameras': {},
+               'shock_counts': {k: 0 for k in GPIO_PINS.keys()}, 'shock_history': [],
+               'dwells': {k: [] for k in GPIO_PINS.keys()}}
+    shocks = {}  # (box_id, count_index) -> shock_history 中的记录
+    for r in records:
+        kind = r.get('type')
+        if kind == 'session_start':
+            session.update(mode=r['mode'], start=datetime.datetime.fromisoformat(r['time']),
+                           cfg=r.get('cfg', {}), rois=r.get('rois', {}), roi_cameras=r.get('roi_cameras', {}))
+        elif kind == 'shock':
+            session['shock_counts'][r['box_id']] = r['count_index']
+            session['shock_history'].append(dict(r))
+            shocks[(r['box_id'], r['count_index'])] = session['shock_history'][-1]
+        elif kind == 'shock_edge':
+            shock = shocks.get((r['box_id'], r['count_index']))
+            if shock is not None:
+                shock.update(edge_ms=r['edge_ms'], total_ms=r['total_ms'])
+        elif kind == 'dwell':
+            session['dwells'].setdefault(r['box'], []).append({
+                **r,
+                'start': datetime.datetime.fromisoformat(r['start']),
+                'end': datetime.datetime.fromisoformat(r['end'])
+            })
+        elif kind == 'session_end':
+            session.update(end=datetime.datetime.fromisoformat(r['time']), reason=r.get('reason'))
+    return session
+
+
+def find_unfinished_journal(journal_dir=JOURNAL_DIR):
+    """返回最近一个没有 session_end 记录 (异常退出) 的事件日志路径，没有则返回 None"""
+    paths = sorted(glob.glob(os.path.join(journal_dir, "*.jsonl")), key=os.path.getmtime, reverse=True)
+    for path in paths[:1]:
+        records = read_journal(path)
+        if records and records[0].get('type') == 'session_start' and records[-1].get('type') != 'session_end':
+            return path
+    return None
+
+
+# --- 分数序列 ---
+SCORE_HEADER_SIZE = 4096  # 文件头: JSON (ROI 名称与行格式)，不足部分补 0
+
+
+def score_series_dtype(n_rois, n_cameras=0):
+    """
+    一行一帧: 采集时刻 (Unix 秒)、检测帧序号、各 ROI 分数 (越界为 NaN)；
+    [新增] 多摄像头时另有各路采集时刻相对 t 的偏移 camera_dt (毫秒，≤ 0，该路无帧为 NaN)
+    """
+    fields = [('t', '<f8'), ('frame', '<u4'), ('scores', '<f4', (n_rois,))]
+    if n_cameras:
+        fields.append(('camera_dt', '<f4', (n_cameras,)))
+    return np.dtype(fields)
+
+
+class ScoreSeries:
+    """
+    每帧 ROI 分数的定长二进制序列，通过 numpy.memmap 写入。
+    文件按 chunk_rows 行整块预分配，写满再扩展并重新映射，内存占用与会话长度无关。
+    已存在的文件 (异常退出后恢复) 从最后一条有效行之后继续追加。
+    """
+    def __init__(self, path, roi_names, n_cameras=0, chunk_rows=SCORE_SERIES_CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = max(1, int(chunk_rows))
+        if os.path.exists(path):
+            header, rows = open_score_series(path)
+            self.roi_names = header['roi_names']
+            self.n_cameras = header.get('cameras', 0)
+            self.count = len(rows)
+            del rows
+        else:
+            self.roi_names = list(roi_names)
+            self.n_cameras = n_cameras
+            header = {'format': 'bio_behavior_console.scores', 'version': 2, 'roi_names': self.roi_names,
+                      'cameras': n_cameras}
+            raw = json.dumps(header, ensure_ascii=False).encode('utf-8')
+            if len(raw) > SCORE_HEADER_SIZE:
+                raise ValueError("ROI 数量过多，分数文件头放不下")
+            with open(path, 'wb') as f:
+                f.write(raw.ljust(SCORE_HEADER_SIZE, b'\0'))
+            self.count = 0
+        self.dtype = score_series_dtype(len(self.roi_names), self.n_cameras)
+        self._columns = {}  # 引擎 ROI 顺序 -> 文件列下标，ROI 变化时重建
+        self._mm = None
+        self._map(max(self.count, 1))
+
+    def _map(self, min_rows):
+        capacity = -(-min_rows // self.chunk_rows) * self.chunk_rows
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        size = SCORE_HEADER_SIZE + capacity * self.dtype.itemsize
+        with open(self.path, 'r+b') as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+        self._mm = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=SCORE_HEADER_SIZE, shape=(capacity,))
+
+    def append(self, t, frame_index, roi_names, scores, camera_dt=None):
+        if self.count >= len(self._mm):
+            self._map(self.count + 1)
+        key = tuple(roi_names)
+        cols = self._columns.get(key)
+        if cols is None:
+            # 会话中新增的 ROI 不在文件头里，不记录
+            pos = {name: i for i, name in enumerate(self.roi_names)}
+            src = [i for i, name in enumerate(roi_names) if name in pos]
+            cols = self._columns[key] = (np.array(src, dtype=np.int64),
+                                         np.array([pos[roi_names[i]] for i in src], dtype=np.int64))
+        row = self._mm[self.count]
+        row['t'] = t
+        row['frame'] = frame_index
+        values = np.full(len(self.roi_names), np.nan, dtype=np.float32)
+        values[cols[1]] = scores[cols[0]]
+        row['scores'] = values
+        if self.n_cameras:
+            # 会话中摄像头路数变化 (重新打开采集) 时多余的路不记录，缺少的路为 NaN
+            dt = np.full(self.n_cameras, np.nan, dtype=np.float32)
+            if camera_dt is not None:
+                n = min(len(camera_dt), self.n_cameras)
+                dt[:n] = camera_dt[:n]
+            row['camera_dt'] = dt
+        self.count += 1
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        # 去掉尚未用到的预分配部分
+        with open(self.path, 'r+b') as f:
+            f.truncate(SCORE_HEADER_SIZE + self.count * self.dtype.itemsize)
+
+
+def open_score_series(path, mode='r'):
+    """
+    零拷贝打开分数文件，返回 (header, rows)。rows 是结构化 memmap，
+    字段 't' / 'frame' / 'scores' (形状 [帧数, ROI 数]，列顺序为 header['roi_names'])，
+    多摄像头会话另有 'camera_dt' (形状 [帧数, header['cameras']])。
+    """
+    with open(path, 'rb') as f:
+        header = json.loads(f.read(SCORE_HEADER_SIZE).rstrip(b'\0').decode('utf-8'))
+    dtype = score_series_dtype(len(header['roi_names']), header.get('cameras', 0))
+    n = (os.path.getsize(path) - SCORE_HEADER_SIZE) // dtype.itemsize
+    if n <= 0:
+        return header, np.zeros(0, dtype=dtype)
+    rows = np.memmap(path, dtype=dtype, mode=mode, offset=SCORE_HEADER_SIZE, shape=(n,))
+    # 异常退出时文件末尾是预分配的空行 (t == 0)
+    valid = np.flatnonzero(rows['t'] != 0)
+    return header, rows[:valid[-1] + 1] if len(valid) else rows[:0]
+
+
+def score_series_skew(rows, chunk_rows=SCORE_SERIES_CHUNK_ROWS):
+    """分数文件各帧的路间采集偏差 (毫秒，float32)：camera_dt 中至少两路有效的行取 最大 - 最小，按块读取"""
+    if 'camera_dt' not in rows.dtype.names or rows.dtype['camera_dt'].shape[0] < 2:
+        return np.zeros(0, dtype=np.float32)
+    parts = [np.zeros(0, dtype=np.float32)]
+    for i in range(0, len(rows), chunk_rows):
+        dt = np.asarray(rows['camera_dt'][i:i + chunk_rows])
+        dt = dt[np.isfinite(dt).sum(axis=1) >= 2]
+        parts.append(np.nanmax(dt, axis=1) - np.nanmin(dt, axis=1))
+    return np.concatenate(parts)
+
+
+BLUR_KSIZE = 21  # 预处理高斯模糊核尺寸
+
+
+def merge_regions(boxes):
+    """把互相重叠的矩形 (x0, y0, x1, y1) 合并为外接矩形，直到两两不重叠"""
+    regions = [list(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for b in regions:
+            for r in out:
+                if b[0] < r[2] and r[0] < b[2] and b[1] < r[3] and r[1] < b[3]:
+                    r[0], r[1] = min(r[0], b[0]), min(r[1], b[1])
+                    r[2], r[3] = max(r[2], b[2]), max(r[3], b[3])
+                    merged = True
+                    break
+            else:
+                out.append(b)
+        regions = out
+    return [tuple(r) for r in regions]
+
+
+class SnapshotBackground:
+    """静态快照背景 (原有行为)：首帧即背景，只有按 B 重置时才更新。所有状态按预处理区域分别保存"""
+    adaptive = False
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.backgrounds = None
+
+    @property
+    def initialized(self):
+        return self.backgrounds is not None
+
+    def initialize(self, grays):
+        self.backgrounds = [g.copy() for g in grays]
+
+    def difference(self, k, gray, dst=None):
+        """区域 k 与背景的逐像素差值 (uint8)，多个像素阈值可共用；给出 dst 时直接写入"""
+        return cv2.absdiff(gray, self.backgrounds[k], dst=dst)
+
+    def foreground(self, k, gray, threshold):
+        """返回区域 k 的前景二值图 (0/1)"""
+        _, fg = cv2.threshold(self.difference(k, gray), threshold, 1, cv2.THRESH_BINARY)
+        return fg
+
+    def update(self, k, gray, mask=None):
+        pass
+
+
+class RunningAverageBackground(SnapshotBackground):
+    """指数滑动平均背景 (cv2.accumulateWeighted)，每次更新开销恒定"""
+    adaptive = True
+
+    def __init__(self, learning_rate):
+        self.learning_rate = learning_rate
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self.accumulators = None
+
+    def initialize(self, grays):
+        super().initialize(grays)
+        self.accumulators = [g.astype(np.float32) for g in grays]
+
+    def update(self, k, gray, mask=None):
+        cv2.accumulateWeighted(gray, self.accumulators[k], self.learning_rate, mask=mask)
+        cv2.convertScaleAbs(self.accumulators[k], dst=self.backgrounds[k])
+
+
+class ApproxMedianBackground(SnapshotBackground):
+    """
+    抽帧历史的逐像素近似中值：每次更新每个像素向当前帧移动固定步长，
+    收敛到 (抽帧后) 历史序列的中值。无需保存历史帧，开销与历史长度无关。
+    """
+    adaptive = True
+
+    def __init__(self, learning_rate):
+        self.step = max(1, int(round(learning_rate * 255)))
+        super().__init__()
+
+    def update(self, k, gray, mask=None):
+        bg = self.backgrounds[k]
+        up = cv2.compare(gray, bg, cv2.CMP_GT)
+        down = cv2.compare(gray, bg, cv2.CMP_LT)
+        if mask is not None:
+            cv2.bitwise_and(up, mask, dst=up)
+            cv2.bitwise_and(down, mask, dst=down)
+        cv2.add(bg, self.step, dst=bg, mask=up)
+        cv2.subtract(bg, self.step, dst=bg, mask=down)
+
+
+class MOG2Background:
+    """OpenCV MOG2 混合高斯背景；带掩码更新时，被冻结的像素用模型当前背景图代替输入"""
+    adaptive = True
+
+    def __init__(self, learning_rate, var_threshold):
+        self.learning_rate = learning_rate
+        self.var_threshold = var_threshold
+        self.reset()
+
+    def reset(self):
+        self.subtractors = None
+
+    @property
+    def initialized(self):
+        return self.subtractors is not None
+
+    def initialize(self, grays):
+        self.subtractors = []
+        for g in grays:
+            sub = cv2.createBackgroundSubtractorMOG2(varThreshold=self.var_threshold, detectShadows=False)
+            sub.apply(g, learningRate=1.0)
+            self.subtractors.append(sub)
+
+    def difference(self, k, gray, dst=None):
+        # 检测时不学习 (learningRate=0)，更新统一在 update 中按掩码进行。
+        # MOG2 自带判定，输出 0/255 前景图，像素阈值不起作用
+        return self.subtractors[k].apply(gray, fgmask=dst, learningRate=0)
+
+    def foreground(self, k, gray, threshold):
+        _, fg = cv2.threshold(self.difference(k, gray), 0, 1, cv2.THRESH_BINARY)
+        return fg
+
+    def update(self, k, gray, mask=None):
+        sub = self.subtractors[k]
+        if mask is not None:
+            frozen = sub.getBackgroundImage()
+            cv2.copyTo(gray, mask, frozen)
+            gray = frozen
+        sub.apply(gray, learningRate=self.learning_rate)
+
+
+def create_background_model(kind=BG_MODEL, learning_rate=BG_LEARNING_RATE, var_threshold=BG_MOG2_VAR_THRESHOLD):
+    if kind == "running_avg":
+        return RunningAverageBackground(learning_rate)
+    if kind == "median":
+        return ApproxMedianBackground(learning_rate)
+    if kind == "mog2":
+        return MOG2Background(learning_rate, var_threshold)
+    if kind != "snapshot":
+        print(f"[警告] 未知的背景模型 {kind}，使用 snapshot")
+    return SnapshotBackground()
+
+
+class MotionEngine:
+    """
+    与界面无关的运动检测引擎：背景差分、ROI 打分、训练/监测状态机。
+    输入一帧 (检测分辨率的 BGR 图像)，输出每个 ROI 的分数与进出事件。
+    GUI 与无界面模式 (--no-gui) 都只是它的调用方。
+    """
+    def __init__(self, stimulator, pixel_diff_threshold=25, motion_area_threshold=5,
+                 roi_restricted=ROI_RESTRICTED_PREPROCESS, background_model=None,
+                 bg_update_interval=BG_UPDATE_INTERVAL, bg_update_mask=BG_UPDATE_MASK, journal_dir=JOURNAL_DIR):
+        self.stimulator = stimulator
+        self.rois = {}
+        self.roi_names = []                                 # 与分数数组下标对齐的 ROI 名称
+        self.roi_rects = np.zeros((0, 4), dtype=np.int64)   # 每行 (x, y, w, h)
+        self.roi_cameras = {}   # ROI 名称 -> 所属摄像头序号 (坐标为该路检测分辨率下的坐标)
+        self.roi_version = 0    # ROI 每次变化 +1 (多进程模式据此向子进程下发)
+        self.detectors = None   # 多摄像头检测时每路一个只做检测的 MotionEngine (见 score_cameras)
+        self._detectors_layout = None
+
+        # 预处理区域: 全帧模式下只有一个覆盖整帧的区域；ROI 限定模式下为外扩后 ROI 的并集
+        self.roi_restricted = roi_restricted
+        self.regions = []          # [(x0, y0, x1, y1)]
+        self.region_rois = []      # 每个区域内 ROI 的下标数组
+        self.roi_local_rects = np.zeros((0, 4), dtype=np.int64)  # ROI 相对所在区域的坐标
+        self._regions_shape = None  # 区域对应的帧尺寸，None 表示需要重建
+
+        # 背景模型 (按区域保存状态)；激活中的 ROI 内冻结更新
+        self.background = background_model or create_background_model()
+        self.bg_update_interval = max(1, int(bg_update_interval))
+        self.bg_mask_image = None
+        if bg_update_mask:
+            self.bg_mask_image = cv2.imread(bg_update_mask, cv2.IMREAD_GRAYSCALE)
+            if self.bg_mask_image is None:
+                print(f"[警告] 无法读取背景更新掩码 {bg_update_mask}，忽略")
+        self.region_masks = []  # 与 self.regions 对齐的静态更新掩码 (None 表示全部允许)
+        self._buffers = []      # 与 self.regions 对齐的预分配中间结果 (见 _rebuild_regions)
+        self.bg_generation = 0  # 手动重置背景的次数
+
+        # 当前检测帧序号与采集时刻 (事件的开始/结束都取自这里)
+        self.frame_index = 0
+        self.last_stamp = None
+        self.pixel_diff_threshold = pixel_diff_threshold  # 控制对光线/颜色变化的敏感度
+        self.motion_area_threshold = motion_area_threshold  # 控制对运动面积大小的敏感度
+
+        # --- 训练相关变量 ---
+        self.is_training = False
+        self.train_cfg = {}
+        self.train_end_ts = 0
+        self.train_start_dt = None
+        self.actual_train_end_dt = None
+        self.boxes_finished = set()
+
+        # --- 监测相关变量 ---
+        self.is_monitoring = False
+        self.monitor_cfg = {}
+        self.monitor_end_ts = 0
+        self.monitor_start_dt = None
+        self.actual_monitor_end_dt = None
+
+        self.monitor_active_events = {}
+        self.train_active_events = {}
+
+        # --- 事件日志 ---
+        # 进出与电击记录不再累积在内存，而是实时写入 journal_dir；目录不可写或为 None 时退回内存列表
+        self.journal_dir = journal_dir
+        self.journal = None
+        # 电击边沿记录由脉冲调度线程写入，与主线程的开关日志互斥 (可重入：关闭时还要写 session_end)
+        self._journal_lock = threading.RLock()
+        self.journal_paths = {'training': None, 'monitoring': None}
+        self.memory_journals = {'training': [], 'monitoring': []}
+        self._journal_mode = None
+        if stimulator is not None:  # 多进程模式的子进程只用检测部分，没有刺激器
+            self.stimulator.on_shock = self._on_shock
+            self.stimulator.on_shock_edge = self._on_shock_edge
+        self.score_series = None  # 会话期间每帧 ROI 分数 (ScoreSeries)
+        self._score_series_path = None  # 分数文件在会话第一帧才创建 (此时才知道摄像头路数)
+        self.skew_samples = array.array('f')  # [新增] 本次会话每帧的路间采集偏差 (毫秒)
+        self.capture_mode = capture_mode_label()  # 由界面/无界面模式在启动采集后设置
+
+    # --- 检测区域 ---
+    def add_roi(self, name, rect, camera=0):
+        self.rois[name] = tuple(rect)
+        self.roi_cameras[name] = camera
+        self._rebuild_roi_index()
+
+    def set_rois(self, rois, roi_cameras=None):
+        self.rois = {name: tuple(rect) for name, rect in rois.items()}
+        self.roi_cameras = {name: (roi_cameras or {}).get(name, 0) for name in self.rois}
+        self._rebuild_roi_index()
+
+    def clear_rois(self):
+        self.rois = {}
+        self.roi_cameras = {}
+        self._rebuild_roi_index()
+
+    def camera_rois(self, camera):
+        """某一路摄像头的区域 {名称: 坐标}"""
+        return {name: rect for name, rect in self.rois.items() if self.roi_cameras.get(name, 0) == camera}
+
+    def _rebuild_roi_index(self):
+        """ROI 变化时重建名称列表与坐标数组，打分时直接向量化查表"""
+        self.roi_names = list(self.rois.keys())
+        self.roi_rects = np.array([self.rois[n] for n in self.roi_names], dtype=np.int64).reshape(-1, 4)
+        self._regions_shape = None
+        self.detectors = None
+        self.roi_version += 1
+
+    def _rebuild_regions(self, frame_shape):
+        """按帧尺寸重建预处理区域及每个 ROI 的区域内坐标；区域变化后背景需重新建立"""
+        frame_h, frame_w = frame_shape[:2]
+        x, y, w, h = self.roi_rects.T
+        valid = (x >= 0) & (y >= 0) & (x + w <= frame_w) & (y + h <= frame_h) & (w > 0) & (h > 0)
+
+        if self.roi_restricted:
+            # 外扩模糊核半径，保证 ROI 内每个像素的模糊结果与整帧模糊完全一致
+            pad = BLUR_KSIZE // 2
+            boxes = [(max(0, bx - pad), max(0, by - pad), min(frame_w, bx + bw + pad), min(frame_h, by + bh + pad))
+                     for (bx, by, bw, bh) in self.roi_rects[valid].tolist()]
+            regions = merge_regions(boxes)
+        else:
+            regions = [(0, 0, frame_w, frame_h)]
+
+        region_rois = [[] for _ in regions]
+        local = np.zeros_like(self.roi_rects)
+        for i in np.flatnonzero(valid):
+            bx, by, bw, bh = self.roi_rects[i].tolist()
+            for k, (x0, y0, x1, y1) in enumerate(regions):
+                if x0 <= bx and y0 <= by and bx + bw <= x1 and by + bh <= y1:
+                    region_rois[k].append(i)
+                    local[i] = (bx - x0, by - y0, bw, bh)
+                    break
+
+        if regions != self.regions:
+            self.background.reset()
+        self.region_masks = [None] * len(regions)
+        if self.bg_mask_image is not None:
+            mask = cv2.resize(self.bg_mask_image, (frame_w, frame_h), interpolation=cv2.INTER_NEAREST)
+            _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+            self.region_masks = [np.ascontiguousarray(mask[y0:y1, x0:x1]) for x0, y0, x1, y1 in regions]
+        self.regions = regions
+        self.region_rois = [np.array(idx, dtype=np.int64) for idx in region_rois]
+        self.roi_local_rects = local
+        self._regions_shape = tuple(frame_shape[:2])
+        # [新增] 每个区域的中间结果缓冲区只在这里分配一次，之后逐帧用 dst= 原地写入
+        self._buffers = []
+        for x0, y0, x1, y1 in regions:
+            shape = (y1 - y0, x1 - x0)
+            self._buffers.append({
+                'gray': np.empty(shape, dtype=np.uint8),
+                'blur': np.empty(shape, dtype=np.uint8),
+                'diff': np.empty(shape, dtype=np.uint8),
+                'binary': np.empty(shape, dtype=np.uint8),
+                'sat': np.empty((shape[0] + 1, shape[1] + 1), dtype=np.int32),
+                'mask': np.empty(shape, dtype=np.uint8)
+            })
+
+    def reset_background(self):
+        self.background.reset()
+        for det in self.detectors or []:
+            det.background.reset()
+        self.bg_generation += 1
+
+    # --- 训练 ---
+    def start_training(self, cfg):
+        self.is_training = True
+        self.train_cfg = cfg
+        self.reset_counts()
+        self.train_active_events = {}
+        self.boxes_finished = set()
+        self.train_start_dt = cfg.get('click_time_dt', datetime.datetime.now())
+        self.actual_train_end_dt = None
+
+        if cfg['use_time']:
+            start_epoch = cfg.get('click_time_epoch', time.time())
+            self.train_end_ts = start_epoch + cfg['duration']
+        self._open_journal('training', cfg, self.train_start_dt)
+
+    def _session_end_stamp(self):
+        """会话结束时仍未离开的事件以最后一帧的采集时刻结算"""
+        if self.last_stamp is not None:
+            return self.last_stamp
+        return {'t': time.monotonic(), 'frame_index': self.frame_index}
+
+    def stop_training(self, reason=None):
+        self.actual_train_end_dt = datetime.datetime.now()
+        self.is_training = False
+
+        end = self._session_end_stamp()
+        for box in list(self.train_active_events):
+            self._close_train_event(box, end, [])
+        self.train_active_events.clear()
+
+        self.stimulator.stop_all()
+        self._close_journal(self.actual_train_end_dt, reason)
+
+    # --- 监测 ---
+    def start_monitoring(self, cfg):
+        self.is_monitoring = True
+        self.monitor_cfg = cfg
+        self.monitor_active_events = {}
+        self.monitor_start_dt = cfg.get('click_time_dt', datetime.datetime.now())
+        self.actual_monitor_end_dt = None
+
+        start_epoch = cfg.get('click_time_epoch', time.time())
+        self.monitor_end_ts = start_epoch + cfg['duration']
+        self._open_journal('monitoring', cfg, self.monitor_start_dt)
+
+    def stop_monitoring(self, reason=None, end_dt=None):
+        self.actual_monitor_end_dt = end_dt or datetime.datetime.now()
+        self.is_monitoring = False
+
+        end = self._session_end_stamp()
+        for box in list(self.monitor_active_events):
+            self._close_monitor_event(box, end, [])
+        self.monitor_active_events.clear()
+        self._close_journal(self.actual_monitor_end_dt, reason)
+
+    def reset_counts(self):
+        self.stimulator.reset_counts()
+        self.boxes_finished = set()
+        self.train_start_dt = None
+        self.monitor_start_dt = None
+        for mode in ('training', 'monitoring'):
+            if mode != self._journal_mode:  # 进行中的会话日志保持不动
+                self.journal_paths[mode] = None
+                self.memory_journals[mode] = []
+
+    # --- 事件日志 ---
+    def _open_journal(self, mode, cfg, start_dt):
+        self._close_journal(start_dt, "被新会话覆盖")
+        path = None
+        journal = None
+        if self.journal_dir is not None:
+            path = os.path.join(self.journal_dir, f"{mode}_{start_dt.strftime('%Y%m%d_%H%M%S')}.jsonl")
+            try:
+                os.makedirs(self.journal_dir, exist_ok=True)
+                journal = EventJournal(path)
+            except OSError as e:
+                print(f"[警告] 无法创建事件日志 {path}: {e}，本次会话记录仅保存在内存中")
+                path = None
+        with self._journal_lock:
+            self._journal_mode = mode
+            self.memory_journals[mode] = []
+            self.journal = journal
+            self.journal_paths[mode] = path
+
+        self._open_score_series(path)
+
+        self._journal_write({
+            'type': 'session_start',
+            'mode': mode,
+            'time': start_dt.isoformat(timespec='milliseconds'),
+            'cfg': {k: v for k, v in cfg.items() if k != 'click_time_dt'},
+            'rois': {name: list(rect) for name, rect in self.rois.items()},
+            'roi_cameras': dict(self.roi_cameras)
+        })
+
+    def _open_score_series(self, journal_path):
+        self.skew_samples = array.array('f')
+        if not SCORE_SERIES_ENABLED or not journal_path:
+            return
+        self._score_series_path = os.path.splitext(journal_path)[0] + ".scores"
+
+    def _record_frame(self, scores, stamp):
+        """会话期间记录每帧的 ROI 分数、各路采集时刻偏移与路间偏差"""
+        if stamp.get('skew') is not None:
+            self.skew_samples.append(stamp['skew'] * 1000)
+        if self.score_series is None:
+            if self._score_series_path is None:
+                return
+            path, self._score_series_path = self._score_series_path, None
+            try:
+                self.score_series = ScoreSeries(path, self.roi_names, len(stamp.get('camera_ts') or ()))
+            except (OSError, ValueError) as e:
+                print(f"[警告] 无法创建分数文件 {path}: {e}")
+                return
+        camera_dt = [(ts - stamp['t']) * 1000 if ts is not None else np.nan for ts in stamp.get('camera_ts') or ()]
+        self.score_series.append(mono_to_datetime(stamp['t']).timestamp(), self.frame_index, self.roi_names, scores,
+                                 camera_dt)
+
+    def _close_journal(self, end_dt, reason):
+        self._score_series_path = None
+        if self.score_series is not None:
+            self.score_series.close()
+            self.score_series = None
+        with self._journal_lock:
+            if self._journal_mode is None:
+                return
+            self._journal_write({'type': 'session_end', 'time': end_dt.isoformat(timespec='milliseconds'),
+                                 'reason': reason})
+            journal, self.journal = self.journal, None
+            self._journal_mode = None
+        if journal is not None:
+            journal.close()  # 之后到达的记录 (如迟到的电击边沿) 已看不到这个日志，不会写进已关闭的文件
+
+    def _journal_write(self, record):
+        with self._journal_lock:
+            if self._journal_mode is None:
+                return
+            if self.journal is not None:
+                self.journal.append(record)
+            else:
+                self.memory_journals[self._journal_mode].append(record)
+
+    def _on_shock(self, record):
+        self._journal_write({'type': 'shock', **record})
+
+    def _on_shock_edge(self, record):
+        # 日志只追加: 高电平延迟作为单独一条记录，回放时并回对应的电击记录
+        self._journal_write({'type': 'shock_edge', 'box_id': record['box_id'], 'count_index': record['count_index'],
+                             'edge_ms': record['edge_ms'], 'total_ms': record['total_ms']})
+
+    def load_session(self, mode):
+        """从事件日志 (或内存退回列表) 回放指定类型的最近一次会话"""
+        path = self.journal_paths.get(mode)
+        with self._journal_lock:
+            journal = self.journal
+        if path and journal is not None and journal.path == path:
+            journal.flush()  # 会话进行中导出，先把缓冲写入文件
+        records = read_journal(path) if path else self.memory_journals.get(mode, [])
+        return replay_journal(records)
+
+    def resume_session(self, path):
+        """
+        从异常退出留下的事件日志恢复会话：计数、起止时间与配置按日志重建，
+        之后的事件继续追加到同一个文件。崩溃时仍在区域内的那次停留无法结算，会被丢弃。
+        返回恢复的会话类型 'training' | 'monitoring'。
+        """
+        session = replay_journal(read_journal(path))
+        mode, cfg = session['mode'], dict(session['cfg'])
+        cfg['click_time_dt'] = session['start']
+        if session['rois']:
+            self.set_rois(session['rois'], session['roi_cameras'])
+
+        if mode == 'training':
+            self.is_training = True
+            self.train_cfg = cfg
+            self.reset_counts()
+            self.stimulator.shock_counts.update(session['shock_counts'])
+            self.train_start_dt = session['start']
+            self.actual_train_end_dt = None
+            if cfg.get('use_time'):
+                self.train_end_ts = cfg['click_time_epoch'] + cfg['duration']
+        else:
+            self.is_monitoring = True
+            self.monitor_cfg = cfg
+            self.monitor_start_dt = session['start']
+            self.actual_monitor_end_dt = None
+            self.monitor_end_ts = cfg['click_time_epoch'] + cfg['duration']
+
+        journal = EventJournal(path)
+        with self._journal_lock:
+            self.journal = journal
+            self.journal_paths[mode] = path
+            self._journal_mode = mode
+        self._open_score_series(path)
+        self._journal_write({'type': 'resume', 'time': datetime.datetime.now().isoformat(timespec='milliseconds')})
+        return mode
+
+    def close_unfinished(self, path, reason="异常中断"):
+        """不恢复异常退出的会话，只补写结束记录 (以最后一条记录的时间为准)，日志仍可导出"""
+        records = read_journal(path)
+        session = replay_journal(records)
+        last_time = session['start']
+        for r in records:
+            for key in ('time', 'end'):
+                if key in r:
+                    last_time = max(last_time, datetime.datetime.fromisoformat(r[key]))
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'type': 'session_end', 'time': last_time.isoformat(timespec='milliseconds'),
+                                'reason': reason}, ensure_ascii=False) + "\n")
+
+        mode = session['mode']
+        self.journal_paths[mode] = path
+        if mode == 'training':
+            self.train_start_dt, self.actual_train_end_dt = session['start'], last_time
+        else:
+            self.monitor_start_dt, self.actual_monitor_end_dt = session['start'], last_time
+        return mode
+
+    def check_session(self, current_time=None):
+        """
+        检查训练/监测的结束条件。
+        返回 {'mode': 'training'|'monitoring'|'idle', 'remaining': 秒或None, 'stop_reason': 原因或None}
+        调用方在 stop_reason 不为空时负责结束会话。
+        """
+        if current_time is None:
+            current_time = time.time()
+        status = {'mode': 'idle', 'remaining': None, 'stop_reason': None}
+
+        # 1. 监测模式倒计时
+        if self.is_monitoring:
+            status['mode'] = 'monitoring'
+            remaining = self.monitor_end_ts - current_time
+            if remaining <= 0:
+                status['stop_reason'] = "时间到"
+            else:
+                status['remaining'] = remaining
+
+        # 2. 训练模式倒计时 & 计数
+        elif self.is_training:
+            status['mode'] = 'training'
+            if self.train_cfg['use_time']:
+                remaining = self.train_end_ts - current_time
+                if remaining <= 0:
+                    status['stop_reason'] = "时间到"
+                else:
+                    status['remaining'] = remaining
+
+            if self.train_cfg['use_count']:
+                all_finished = True
+                if not self.rois: all_finished = False
+                for name in self.rois:
+                    curr = self.stimulator.shock_counts.get(name, 0)
+                    target = self.train_cfg['targets'].get(name, 9999)
+                    if curr >= target:
+                        if name not in self.boxes_finished:
+                            self.boxes_finished.add(name)
+                            self.stimulator.set_active(name, False)
+                    else:
+                        all_finished = False
+                if all_finished and len(self.rois) > 0:
+                    status['stop_reason'] = "所有区域达到次数"
+
+        return status
+
+    # --- 检测 ---
+    def preprocess(self, frame):
+        """
+        对每个预处理区域转灰度 + 高斯模糊，返回与 self.regions 对齐的灰度图列表。
+        frame 可以是 BGR、灰度或 YUYV 原始帧 (后两者不做颜色转换)。
+        返回的是预分配缓冲区，下一次 preprocess 会覆盖 (背景模型初始化时自行复制)。
+        """
+        if self._regions_shape != frame.shape[:2]:
+            self._rebuild_regions(frame.shape)
+
+        grays = []
+        for (x0, y0, x1, y1), buf in zip(self.regions, self._buffers):
+            gray = frame_to_luma(frame[y0:y1, x0:x1], dst=buf['gray'])
+            grays.append(cv2.GaussianBlur(gray, (BLUR_KSIZE, BLUR_KSIZE), 0, dst=buf['blur']))
+        return grays
+
+    def score_rois(self, grays):
+        """
+        每个区域只做一次差分与二值化，再用积分图 (summed-area table) 对每个 ROI 做四次查表求变化像素数。
+        返回与 self.roi_names 对齐的分数数组 (变化像素百分比)，越界的 ROI 为 NaN。
+        """
+        return self.score_rois_multi(grays, [self.pixel_diff_threshold])[0]
+
+    def score_rois_multi(self, grays, thresholds):
+        """同 score_rois，但对多个像素阈值共用同一张差分图，返回 [阈值数, ROI 数] 的分数矩阵"""
+        scores = np.full((len(thresholds), len(self.roi_names)), np.nan)
+        for k, (gray, idx) in enumerate(zip(grays, self.region_rois)):
+            if not len(idx): continue
+            buf = self._buffers[k]
+            diff = self.background.difference(k, gray, dst=buf['diff'])
+            x, y, w, h = self.roi_local_rects[idx].T
+            for j, threshold in enumerate(thresholds):
+                cv2.threshold(diff, threshold, 1, cv2.THRESH_BINARY, dst=buf['binary'])
+                sat = cv2.integral(buf['binary'], sum=buf['sat'], sdepth=cv2.CV_32S)  # 尺寸 (h+1, w+1)
+                counts = sat[y + h, x + w] - sat[y, x + w] - sat[y + h, x] + sat[y, x]
+                scores[j, idx] = counts * 100.0 / (w * h)
+        return scores
+
+    def process(self, frame, stamp=None):
+        """
+        处理一帧，返回 (roi_results, events)。
+        stamp: 采集时间戳 {'t': time.monotonic() 采集时刻, ...}，为 None 时取当前时刻；
+               引擎会写入本帧的检测帧序号 stamp['frame_index']。
+        roi_results: [{'name', 'rect', 'score', 'active', 'state'}]
+        events: [{'type': 'enter'|'exit', 'mode', 'box', 'time', 'frame_index', ...}]
+        """
+        stamp = self.advance(stamp)
+
+        with METRICS.span("preprocess"):
+            grays = self.preprocess(frame)
+            if not self.background.initialized:
+                self.background.initialize(grays)
+
+        with METRICS.span("score"):
+            scores = self.score_rois(grays)
+        with METRICS.span("state"):
+            results, events, active = self.apply_scores(scores, stamp)
+        with METRICS.span("bg_update"):
+            self._update_background(grays, active)
+        return results, events
+
+    def _build_detectors(self, layout):
+        """
+        每路摄像头一个只做检测的 MotionEngine (各自的预处理区域与背景模型)。
+        parent_index 把每路的分数写回本引擎 roi_names 的对应下标；背景更新掩码按该路在拼接画面中的分块裁切。
+        """
+        name_index = {name: i for i, name in enumerate(self.roi_names)}
+        self.detectors = []
+        for cam in range(len(layout.tile_widths)):
+            det = MotionEngine(None, self.pixel_diff_threshold, self.motion_area_threshold, self.roi_restricted,
+                               background_model=create_background_model(), bg_update_interval=self.bg_update_interval,
+                               bg_update_mask="", journal_dir=None)
+            if self.bg_mask_image is not None:
+                det.bg_mask_image = layout.crop_tile(self.bg_mask_image, cam)
+            det.set_rois(self.camera_rois(cam))
+            det.parent_index = np.array([name_index[n] for n in det.roi_names], dtype=np.int64)
+            self.detectors.append(det)
+        self._detectors_layout = layout
+
+    def score_cameras(self, frames, layout):
+        """各路缩放到检测分辨率后分别预处理与打分，返回 (与 roi_names 对齐的分数, 每路灰度图列表)"""
+        if self.detectors is None or self._detectors_layout is not layout:
+            self._build_detectors(layout)
+        scores = np.full(len(self.roi_names), np.nan)
+        grays_list = []
+        t_pre = t_score = 0.0
+        for cam, (det, frame) in enumerate(zip(self.detectors, frames)):
+            if not det.roi_names:
+                grays_list.append(None)
+                continue
+            det.pixel_diff_threshold = self.pixel_diff_threshold
+            det.motion_area_threshold = self.motion_area_threshold
+            t0 = time.perf_counter()
+            grays = det.preprocess(layout.to_working(cam, frame))
+            if not det.background.initialized:
+                det.background.initialize(grays)
+            t1 = time.perf_counter()
+            scores[det.parent_index] = det.score_rois(grays)
+            t_pre += t1 - t0
+            t_score += time.perf_counter() - t1
+            grays_list.append(grays)
+        METRICS.observe("preprocess", t_pre)
+        METRICS.observe("score", t_score)
+        return scores, grays_list
+
+    def update_camera_backgrounds(self, grays_list, active):
+        for det, grays in zip(self.detectors, grays_list):
+            if grays is not None:
+                det.frame_index = self.frame_index
+                det._update_background(grays, active[det.parent_index])
+
+    def process_cameras(self, frames, stamp, layout):
+        """
+        [新增] 多摄像头检测：每路在自己的检测分辨率上打分 (不受拼接与窗口大小影响)，再统一推进状态机。
+        frames 为各路原始画面，返回值同 process；ROI 坐标为所属摄像头的检测坐标。
+        """
+        stamp = self.advance(stamp)
+        scores, grays_list = self.score_cameras(frames, layout)
+        with METRICS.span("state"):
+            results, events, active = self.apply_scores(scores, stamp)
+        with METRICS.span("bg_update"):
+            self.update_camera_backgrounds(grays_list, active)
+        return results, events
+
+    def advance(self, stamp=None):
+        """进入下一检测帧：分配帧序号并记录采集时间戳"""
+        self.frame_index += 1
+        stamp = dict(stamp) if stamp else {'t': time.monotonic()}
+        stamp['frame_index'] = self.frame_index
+        self.last_stamp = stamp
+        return stamp
+
+    def apply_scores(self, scores, stamp):
+        """按面积阈值判定并推进各 ROI 的状态机，返回 (roi_results, events, active)"""
+        if self._journal_mode is not None:
+            self._record_frame(scores, stamp)
+        active = scores > self.motion_area_threshold  # NaN 比较结果为 False
+        stamp['detect_t'] = time.monotonic()  # 判定时刻，用于运动→电击延迟
+        results = []
+        events = []
+        for i, (name, score) in enumerate(zip(self.roi_names, scores.tolist())):
+            if score != score: continue  # NaN: ROI 越界，不参与
+            is_active = bool(active[i])
+            state = self._update_roi_state(name, is_active, events, stamp)
+            results.append({
+                'name': name,
+                'camera': self.roi_cameras.get(name, 0),
+                'rect': self.rois[name],
+                'score': score,
+                'active': is_active,
+                'state': state
+            })
+        return results, events, active
+
+    def _update_background(self, grays, active):
+        """按抽帧间隔增量更新背景；静态掩码之外及当前激活的 ROI 内不更新"""
+        if not self.background.adaptive:
+            return
+        if self.frame_index % self.bg_update_interval:
+            return
+
+        for k, gray in enumerate(grays):
+            mask = self.region_masks[k]
+            frozen = [i for i in self.region_rois[k].tolist() if active[i]]
+            if frozen:
+                buf = self._buffers[k]['mask']
+                if mask is not None:
+                    np.copyto(buf, mask)
+                else:
+                    buf.fill(255)
+                mask = buf
+                for i in frozen:
+                    x, y, w, h = self.roi_local_rects[i].tolist()
+                    mask[y:y+h, x:x+w] = 0
+            self.background.update(k, gray, mask)
+
+    def _update_roi_state(self, name, is_active, events, stamp):
+        """推进单个 ROI 的训练/监测状态机，返回用于显示的状态名。进出时刻取自本帧的采集时间戳"""
+        t, fi = stamp['t'], stamp['frame_index']
+
+        if self.is_training:
+            if self.train_cfg['use_count'] and name in self.boxes_finished:
+                self.stimulator.set_active(name, False, t, fi)
+
+                # 如果完成了，也要结算时间（视为离开）
+                if name in self.train_active_events:
+                    self._close_train_event(name, stamp, events)
+                return 'done'
+
+            if is_active:
+                # --- 激活状态 (进入) ---
+                self.stimulator.set_active(name, True, t, fi, stamp.get('detect_t'))
+                if name not in self.train_active_events:
+                    self.train_active_events[name] = (t, fi)
+                    events.append({'type': 'enter', 'mode': 'training', 'box': name,
+                                   'time': mono_to_datetime(t), 'ts': t, 'frame_index': fi})
+                return 'shock'
+
+            # --- 非激活状态 (离开/静止) ---
+            self.stimulator.set_active(name, False, t, fi)
+            if name in self.train_active_events:
+                self._close_train_event(name, stamp, events)
+            return 'train'
+
+        if self.is_monitoring:
+            if is_active:
+                if name not in self.monitor_active_events:
+                    self.monitor_active_events[name] = (t, fi)
+                    events.append({'type': 'enter', 'mode': 'monitoring', 'box': name,
+                                   'time': mono_to_datetime(t), 'ts': t, 'frame_index': fi})
+                return 'rec'
+
+            if name in self.monitor_active_events:
+                self._close_monitor_event(name, stamp, events)
+            return 'monitor'
+
+        self.stimulator.set_active(name, False, t, fi)
+        return 'preview_act' if is_active else 'preview'
+
+    def _make_record(self, start, stamp):
+        (start_t, start_fi), end_t = start, stamp['t']
+        return {
+            'start': mono_to_datetime(start_t).isoformat(timespec='milliseconds'),
+            'end': mono_to_datetime(end_t).isoformat(timespec='milliseconds'),
+            'duration': end_t - start_t,
+            'start_ts': start_t,
+            'end_ts': end_t,
+            'start_frame': start_fi,
+            'end_frame': stamp['frame_index']
+        }
+
+    def _close_monitor_event(self, name, stamp, events):
+        record = self._make_record(self.monitor_active_events.pop(name), stamp)
+        self._journal_write({'type': 'dwell', 'mode': 'monitoring', 'box': name, **record})
+        events.append({**record, 'type': 'exit', 'mode': 'monitoring', 'box': name,
+                       'time': mono_to_datetime(record['end_ts']), 'ts': record['end_ts'],
+                       'frame_index': record['end_frame']})
+
+    def _close_train_event(self, name, stamp, events):
+        record = self._make_record(self.train_active_events.pop(name), stamp)
+        self._journal_write({'type': 'dwell', 'mode': 'training', 'box': name, **record})
+        events.append({**record, 'type': 'exit', 'mode': 'training', 'box': name,
+                       'time': mono_to_datetime(record['end_ts']), 'ts': record['end_ts'],
+                       'frame_index': record['end_frame']})
+
+    # --- 日志导出 ---
+    def write_train_log(self, filepath):
+        session = self.load_session('training')
+        start_dt = session['start'] or self.train_start_dt
+        with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(["=== 电击训练日志 ==="])
+            start_str = start_dt.strftime("%Y-%m-%d %H:%M:%S") if start_dt else "N/A"
+            end_dt = session['end'] or self.actual_train_end_dt or datetime.datetime.now()
+            end_str = end_dt.strftime("%Y-%m-%d %H:%M:%S")
+            duration = str(end_dt - start_dt).split('.')[0] if start_dt else "N/A"
+
+            writer.writerow(["开始时间", start_str])
+            writer.writerow(["结束时间", end_str])
+            writer.writerow(["训练时长", duration])
+            writer.writerow([])
+
+            writer.writerow(["=== 统计数据 ==="])
+            writer.writerow(["Box名称", "电击次数"])
+            for box, count in session['shock_counts'].items():
+                writer.writerow([box, count])
+            writer.writerow([])
+
+            writer.writerow(["=== 详细事件记录 ==="])
+            writer.writerow(["时间戳", "Box名称", "次数序号", "检测帧序号",
+                             "采集→判定(ms)", "判定→触发(ms)", "触发→GPIO高电平(ms)", "运动→电击总延迟(ms)"])
+
+            def fmt(v):
+                return f"{v:.2f}" if v is not None else ""
+
+            for record in session['shock_history']:
+                frame_index = record.get('frame_index')
+                writer.writerow([record['timestamp'], record['box_id'], record['count_index'],
+                                 frame_index if frame_index is not None else "手动",
+                                 fmt(record.get('detect_ms')), fmt(record.get('dispatch_ms')),
+                                 fmt(record.get('edge_ms')), fmt(record.get('total_ms'))])
+            writer.writerow([])
+
+            writer.writerow(["=== 运动→电击延迟 (毫秒，不含手动电击) ==="])
+            writer.writerow(["阶段", "样本数", "p50", "p95", "p99", "最大"])
+            steps = [("采集→判定", 'detect_ms'), ("判定→触发", 'dispatch_ms'),
+                     ("触发→GPIO高电平", 'edge_ms'), ("运动→电击总延迟", 'total_ms')]
+            for label, key in steps:
+                values = np.array([r[key] for r in session['shock_history']
+                                   if r.get(key) is not None and r.get('frame_index') is not None])
+                if len(values):
+                    p50, p95, p99 = np.percentile(values, (50, 95, 99))
+                    writer.writerow([label, len(values), f"{p50:.2f}", f"{p95:.2f}", f"{p99:.2f}", f"{values.max():.2f}"])
+                else:
+                    writer.writerow([label, 0, "", "", "", ""])
+            writer.writerow([])
+
+            writer.writerow(["=== 脉冲时序抖动 (毫秒) ==="])
+            writer.writerow(["Box名称", "脉冲数", "设定脉宽", "实际脉宽均值", "脉宽抖动(std)", "脉宽最大误差",
+                             "设定周期", "实际周期均值", "周期抖动(std)", "周期最大误差", "边沿平均延迟", "边沿最大延迟"])
+            for box, r in sorted(self.stimulator.scheduler.jitter_report().items()):
+                on_s, off_s = self.stimulator.pulse_widths(box)
+                writer.writerow([box, r['pulses'], f"{on_s*1000:.0f}", f"{r['width_mean']:.3f}", f"{r['width_std']:.3f}",
+                                 f"{r['width_max_err']:.3f}", f"{(on_s+off_s)*1000:.0f}", f"{r['period_mean']:.3f}",
+                                 f"{r['period_std']:.3f}", f"{r['period_max_err']:.3f}", f"{r['edge_delay_mean']:.3f}",
+                                 f"{r['edge_delay_max']:.3f}"])
+            writer.writerow([])
+            self._write_skew_section(writer, 'training')
+
+    def write_monitor_log(self, filepath):
+        session = self.load_session('monitoring')
+        start_dt = session['start'] or self.monitor_start_dt
+        with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(["=== 行为监测日志 (无电击) ==="])
+
+            start_str = start_dt.strftime("%Y-%m-%d %H:%M:%S") if start_dt else "N/A"
+            end_dt = session['end'] or self.actual_monitor_end_dt or datetime.datetime.now()
+            end_str = end_dt.strftime("%Y-%m-%d %H:%M:%S")
+            duration = str(end_dt - start_dt).split('.')[0] if start_dt else "N/A"
+
+            writer.writerow(["监测开始", start_str])
+            writer.writerow(["监测结束", end_str])
+            writer.writerow(["总监测时长", duration])
+            writer.writerow([])
+
+            writer.writerow(["=== 停留时长统计 (Summary) ==="])
+            writer.writerow(["Box名称", "总停留时间(秒)", "进入次数"])
+            for box in sorted(GPIO_PINS.keys()):
+                records = session['dwells'].get(box, [])
+                total_dur = sum([r['duration'] for r in records])
+                count = len(records)
+                writer.writerow([box, f"{total_dur:.2f}", count])
+            writer.writerow([])
+
+            writer.writerow(["=== 详细进出记录 (Details) ==="])
+            writer.writerow(["Box名称", "进入时间", "离开时间", "单次停留时长(秒)", "进入帧", "离开帧"])
+
+            all_records = []
+            for box, recs in session['dwells'].items():
+                for r in recs:
+                    all_records.append({**r, 'box': box})
+            all_records.sort(key=lambda x: x['start'])
+
+            for r in all_records:
+                s_str = r['start'].strftime("%H:%M:%S.%f")[:-3]
+                e_str = r['end'].strftime("%H:%M:%S.%f")[:-3]
+                writer.writerow([r['box'], s_str, e_str, f"{r['duration']:.3f}", r['start_frame'], r['end_frame']])
+            writer.writerow([])
+            self._write_skew_section(writer, 'monitoring')
+
+    def skew_summary(self, mode=None):
+        """
+        路间采集偏差 (毫秒) 的统计。mode 类型的会话有分数文件时从其 camera_dt 计算 (恢复的会话也包含崩溃前的帧)，
+        否则用本次运行内存中的样本；单摄像头或尚无样本时返回 None。
+        """
+        path = self.journal_paths.get(mode) if mode else None
+        scores_path = os.path.splitext(path)[0] + ".scores" if path else None
+        if scores_path and os.path.exists(scores_path):
+            _, rows = open_score_series(scores_path)
+            values = score_series_skew(rows)
+            del rows
+        else:
+            values = np.frombuffer(self.skew_samples, dtype=np.float32)
+        if not len(values):
+            return None
+        p50, p95, p99 = np.percentile(values, (50, 95, 99))
+        return {'frames': len(values), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+                'max': float(values.max())}
+
+    def _write_skew_section(self, writer, mode):
+        """没有测到路间偏差 (单摄像头、离线分析) 时不写这一节"""
+        st = self.skew_summary(mode)
+        if not st:
+            return
+        writer.writerow(["=== 多摄像头采集偏差 (毫秒，同一拼接帧内各路采集时刻的最大差) ==="])
+        writer.writerow(["采集方式", "帧数", "p50", "p95", "p99", "最大"])
+        writer.writerow([self.capture_mode, st['frames'], f"{st['p50']:.2f}", f"{st['p95']:.2f}", f"{st['p99']:.2f}",
+                         f"{st['max']:.2f}"])
+
+
+# ==========================================
+# [新增] 多进程采集与打分 (每个摄像头一个子进程，共享内存环形缓冲区)
+# ==========================================
+RING_MAX_ROIS = 64  # 每路子进程最多打分的 ROI 数 (共享内存中分数数组的长度)
+RING_SLOT_DTYPE = np.dtype([('seq', '<i8'), ('t', '<f8'), ('version', '<i8'), ('scores', '<f4', (RING_MAX_ROIS,))])
+RING_HEADER_FIELDS = 8  # int64: [0] 最新已发布序号, [1] 连续读取失败次数
+
+
+class SharedFrameRing:
+    """
+    单写者/单读者的共享内存环形缓冲区：slots 个帧槽，每槽附带 (序号, 采集时刻, ROI 版本, 分数)。
+    写者先把槽序号置 -1，再写帧与分数，最后写槽序号并发布 latest；
+    读者复制完成后复核槽序号，期间被覆盖则重读 (seqlock)，双方都不加锁、不经过 pickle。
+    """
+    def __init__(self, frame_shape, slots=CAPTURE_RING_SLOTS, names=None):
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots
+        self.owner = names is None
+        frame_bytes = slots * int(np.prod(self.frame_shape))
+        meta_bytes = RING_HEADER_FIELDS * 8 + slots * RING_SLOT_DTYPE.itemsize
+        if self.owner:
+            self._frame_shm = shared_memory.SharedMemory(create=True, size=frame_bytes)
+            self._meta_shm = shared_memory.SharedMemory(create=True, size=meta_bytes)
+        else:
+            self._frame_shm = shared_memory.SharedMemory(name=names[0])
+            self._meta_shm = shared_memory.SharedMemory(name=names[1])
+        self.frames = np.ndarray((slots,) + self.frame_shape, dtype=np.uint8, buffer=self._frame_shm.buf)
+        self.header = np.ndarray((RING_HEADER_FIELDS,), dtype=np.int64, buffer=self._meta_shm.buf)
+        self.meta = np.ndarray((slots,), dtype=RING_SLOT_DTYPE, buffer=self._meta_shm.buf, offset=RING_HEADER_FIELDS * 8)
+        if self.owner:
+            self.header[:] = 0
+            self.meta['seq'] = 0
+        self._write_seq = int(self.header[0])
+
+    def spec(self):
+        """子进程附着所需的参数 (可 pickle)"""
+        return self.frame_shape, self.slots, (self._frame_shm.name, self._meta_shm.name)
+
+    @classmethod
+    def attach(cls, spec):
+        frame_shape, slots, names = spec
+        return cls(frame_shape, slots, names)
+
+    def begin_write(self):
+        """写者: 返回下一个槽的帧缓冲 (直接写入共享内存)，该槽在 publish 之前对读者无效"""
+        slot = (self._write_seq + 1) % self.slots
+        self.meta['seq'][slot] = -1
+        return self.frames[slot]
+
+    def publish(self, t, version, scores):
+        self._write_seq += 1
+        slot = self._write_seq % self.slots
+        n = min(len(scores), RING_MAX_ROIS)
+        self.meta['t'][slot] = t
+        self.meta['version'][slot] = version
+        self.meta['scores'][slot, :n] = scores[:n]
+        self.meta['seq'][slot] = self._write_seq
+        self.header[0] = self._write_seq
+
+    def read_into(self, out, retries=3):
+        """读者: 把最新一帧复制进 out，返回 (seq, t, version, scores)；尚无帧或连续被覆盖时返回 None"""
+        for _ in range(retries):
+            seq = int(self.header[0])
+            if seq <= 0:
+                return None
+            slot = seq % self.slots
+            np.copyto(out, self.frames[slot])
+            t = float(self.meta['t'][slot])
+            version = int(self.meta['version'][slot])
+            scores = self.meta['scores'][slot].copy()
+            if int(self.meta['seq'][slot]) == seq:
+                return seq, t, version, scores
+        return None
+
+    def close(self):
+        # 先释放对共享内存的 numpy 视图，否则 close() 会因仍有导出的缓冲区而报错
+        self.frames = self.header = self.meta = None
+        self._frame_shm.close()
+        self._meta_shm.close()
+        if self.owner:
+            self._frame_shm.unlink()
+            self._meta_shm.unlink()
+
+
+def _camera_process_main(source, loop_file, part_size, working_size, bg_mask, ring_spec, control, profile=None):
+    """
+    子进程入口：采集一路画面 → 缩放到该路在拼接画面中的尺寸 (直接写入共享内存) 供预览，
+    同时在检测分辨率 working_size 上预处理与 ROI 打分 → 发布。
+    背景模型在子进程内维护；ROI / 阈值 / 背景重置由主进程经 control 队列下发 (只有控制消息走 pickle)。
+    profile 为主进程协商出的采集格式 (子进程不再单独做带宽协商)。
+    """
+    ring = SharedFrameRing.attach(ring_spec)
+    caps, _ = open_sources([source], loop_file, lambda msg: print(f"[采集进程 {source}] {msg}"),
+                           profiles=[[profile]] if profile else None)
+    if not caps:
+        ring.header[1] = CaptureWorker.LOST_THRESHOLD
+        ring.close()
+        return
+    cap = caps[0]
+    engine = MotionEngine(None, PIXEL_DIFF_THRESHOLD, MOTION_AREA_THRESHOLD, bg_update_mask="", journal_dir=None)
+    engine.bg_mask_image = bg_mask
+    version = 0
+    work = None  # 检测分辨率画面 (与原始分辨率不同时才分配，之后复用)
+    yuyv_size = raw_yuyv_size(cap)
+    if yuyv_size is not None:
+        bgr = np.empty((yuyv_size[1], yuyv_size[0], 3), dtype=np.uint8)
+        luma = np.empty((yuyv_size[1], yuyv_size[0]), dtype=np.uint8)
+
+    frame_interval = 0.0
+    if loop_file:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_interval = 1.0 / fps if fps and fps > 0 else 1.0 / 30
+    next_due = time.monotonic()
+    try:
+        while True:
+            while True:
+                try:
+                    msg = control.get_nowait()
+                except queue.Empty:
+                    break
+                if msg[0] == 'stop':
+                    return
+                if msg[0] == 'rois':
+                    version = msg[1]
+                    engine.set_rois(msg[2])
+                elif msg[0] == 'thresholds':
+                    engine.pixel_diff_threshold, engine.motion_area_threshold = msg[1], msg[2]
+                elif msg[0] == 'reset_bg':
+                    engine.reset_background()
+
+            ret, frame = cap.read()
+            if not ret:
+                ring.header[1] += 1
+                if loop_file:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)  # 循环播放
+                time.sleep(0.01)
+                continue
+            if yuyv_size is not None:
+                frame = as_yuyv(frame, yuyv_size)
+                if frame is None:
+                    ring.header[1] += 1
+                    continue
+            ring.header[1] = 0
+            t = time.monotonic()
+
+            part = ring.begin_write()
+            if yuyv_size is not None:
+                # 共享内存中的分块用于预览，只能是彩色；检测仍然只用 Y 平面
+                cv2.resize(frame_to_bgr(frame, dst=bgr), part_size, dst=part)
+                frame = frame_to_luma(frame, dst=luma)
+            else:
+                cv2.resize(frame, part_size, dst=part)
+            if (frame.shape[1], frame.shape[0]) != working_size:
+                if work is None:
+                    work = np.empty((working_size[1], working_size[0]) + frame.shape[2:], dtype=np.uint8)
+                frame = cv2.resize(frame, working_size, dst=work)
+            engine.frame_index += 1  # 背景抽帧更新按本路帧序号
+            grays = engine.preprocess(frame)
+            if not engine.background.initialized:
+                engine.background.initialize(grays)
+            scores = engine.score_rois(grays)
+            ring.publish(t, version, scores)
+            engine._update_background(grays, scores > engine.motion_area_threshold)
+
+            if frame_interval:
+                next_due += frame_interval
+                delay = next_due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_due = time.monotonic()
+    finally:
+        cap.release()
+        ring.close()
+
+
+class CameraProcess:
+    """主进程一侧的句柄：一个采集+打分子进程及其共享内存环形缓冲区"""
+    def __init__(self, source, source_name, part_size, working_size, bg_mask=None, loop_file=False,
+                 slots=CAPTURE_RING_SLOTS, profile=None):
+        self.source_name = source_name
+        self.part_size = tuple(part_size)  # (宽, 高)
+        self.ring = SharedFrameRing((part_size[1], part_size[0], 3), slots)
+        # spawn: 不继承主进程的 Tk / 线程状态，Windows 与 Linux 行为一致
+        ctx = multiprocessing.get_context("spawn")
+        self.control = ctx.Queue()
+        self.process = ctx.Process(target=_camera_process_main, name=f"camera-{source_name}", daemon=True,
+                                   args=(source, loop_file, self.part_size, tuple(working_size), bg_mask,
+                                         self.ring.spec(), self.control, profile))
+        self.roi_index = np.zeros(0, dtype=np.int64)  # 子进程分数下标 → 引擎 roi_names 下标
+        self.roi_version = 0
+        self._consumed_seq = 0
+        self.dropped = 0      # 未被主进程取走就被覆盖的帧数
+        self.duplicates = 0   # 主进程重复取到同一帧的次数
+
+    def start(self):
+        self.process.start()
+
+    @property
+    def signal_lost(self):
+        return self.ring.header[1] >= CaptureWorker.LOST_THRESHOLD or not self.process.is_alive()
+
+    def send(self, *msg):
+        self.control.put(msg)
+
+    def read_into(self, out):
+        res = self.ring.read_into(out)
+        if res is not None:
+            seq = res[0]
+            if seq == self._consumed_seq:
+                self.duplicates += 1
+            elif self._consumed_seq:
+                self.dropped += seq - self._consumed_seq - 1
+            self._consumed_seq = seq
+        return res
+
+    def stop(self, timeout=2.0):
+        if self.process.is_alive():
+            self.send('stop')
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(timeout)
+        self.control.close()
+        self.ring.close()
+
+
+class CameraProcessPool:
+    """
+    多进程模式下替代 CaptureWorker：每路摄像头在子进程中完成采集、缩放与 ROI 打分，
+    主进程只把各路分块拼成预览帧，并把分数交给 MotionEngine.apply_scores 推进状态机。
+    """
+    def __init__(self, sources, names, layout, loop_file=False, slots=CAPTURE_RING_SLOTS, formats=None):
+        frame_h = layout.display_size[1]
+        self.offsets = layout.offsets
+        self.frame = layout.frame  # 拼接帧 (各路分块直接从共享内存复制到对应列)
+        mask = cv2.imread(BG_UPDATE_MASK, cv2.IMREAD_GRAYSCALE) if BG_UPDATE_MASK else None
+        formats = formats or [None] * len(sources)
+        self.cameras = [CameraProcess(src, name, (w, frame_h), layout.working_sizes[i],
+                                      layout.crop_tile(mask, i) if mask is not None else None, loop_file, slots,
+                                      formats[i])
+                        for i, (src, name, w) in enumerate(zip(sources, names, layout.tile_widths))]
+        self._synced = None  # 最近一次下发时的 (roi_version, 阈值, 背景代数)
+
+    def start(self):
+        for cam in self.cameras:
+            cam.start()
+
+    def sync(self, engine):
+        """引擎的 ROI / 阈值 / 背景重置有变化时下发给各子进程"""
+        key = (engine.roi_version, engine.pixel_diff_threshold, engine.motion_area_threshold, engine.bg_generation)
+        if key == self._synced:
+            return
+        last = self._synced or (None, None, None, 0)
+        if key[0] != last[0]:
+            name_index = {name: i for i, name in enumerate(engine.roi_names)}
+            for i, cam in enumerate(self.cameras):
+                rois = engine.camera_rois(i)
+                if len(rois) > RING_MAX_ROIS:
+                    print(f"[警告] 摄像头 {cam.source_name} 的区域超过 {RING_MAX_ROIS} 个，多余的不参与检测")
+                    rois = dict(list(rois.items())[:RING_MAX_ROIS])
+                cam.roi_version = engine.roi_version
+                cam.roi_index = np.array([name_index[n] for n in rois], dtype=np.int64)
+                cam.send('rois', engine.roi_version, rois)
+        if key[1:3] != last[1:3]:
+            for cam in self.cameras:
+                cam.send('thresholds', key[1], key[2])
+        if key[3] != last[3]:
+            for cam in self.cameras:
+                cam.send('reset_bg')
+        self._synced = key
+
+    def collect(self, engine):
+        """
+        取各路最新的分块与分数，返回 (拼接帧, 与 engine.roi_names 对齐的分数, stamp)。stamp 格式同 collect_latest_frames。
+        ROI 刚变更、子进程尚未按新 ROI 出分时，对应分数为 NaN (本帧不参与判定)。
+        """
+        self.sync(engine)
+        scores = np.full(len(engine.roi_names), np.nan)
+        camera_ts = []
+        camera_seq = []
+        for cam, x0, x1 in zip(self.cameras, self.offsets, self.offsets[1:]):
+            part = self.frame[:, x0:x1]
+            res = None if cam.signal_lost else cam.read_into(part)
+            if res is None:
+                part[:] = 0  # 尚未出帧或掉线，补黑
+                camera_ts.append(None)
+                camera_seq.append(None)
+                continue
+            seq, t, version, cam_scores = res
+            if version == cam.roi_version and len(cam.roi_index):
+                scores[cam.roi_index] = cam_scores[:len(cam.roi_index)]
+            camera_ts.append(t)
+            camera_seq.append(seq)
+
+        return self.frame, scores, capture_stamp(camera_ts, camera_seq)
+
+    def stop(self):
+        for cam in self.cameras:
+            cam.stop()
+
+
+def probe_native_sizes(caps):
+    """读取每路首帧的尺寸后释放设备 (多进程模式下由子进程重新打开)，读取失败的按 640x480"""
+    sizes = []
+    for cap in caps:
+        ret, f = cap.read()
+        yuyv_size = raw_yuyv_size(cap)
+        if ret and yuyv_size is not None:
+            sizes.append(yuyv_size)
+        else:
+            sizes.append((f.shape[1], f.shape[0]) if ret else (640, 480))
+        cap.release()
+    return sizes
+
 
 # ==========================================
 # 训练设置弹窗 (保持不变)
@@ -413,17 +3693,33 @@ class UnifiedGUI:
 
         self.stimulator = Stimulator(IS_TEST_MODE)
         
-        # [修改] 改为列表存储多摄
-        self.caps = [] 
+        # [修改] 每个摄像头一个采集线程 (CaptureWorker 持有 VideoCapture)
+        self.capture_workers = []
+        self.camera_pool = None  # [新增] CAPTURE_PROCESSES 时为 CameraProcessPool (替代采集线程)
+        self.layout = None       # [新增] 拼接画面与各摄像头检测坐标的映射 (CameraLayout)
+        self.capture_formats = []  # [新增] 各路协商出的采集格式 (见 open_sources)
+        self._loop_job = None
+        self._last_stats_ts = 0
+        # [新增] 主循环按截止时间调度: 检测 DETECT_FPS，预览 DISPLAY_FPS
+        self.detect_period = 1.0 / max(1, DETECT_FPS)
+        self.display_period = 1.0 / max(1, min(DISPLAY_FPS, DETECT_FPS))
+        self._detect_deadline = 0.0
+        self._display_deadline = 0.0
+        self._last_camera_seq = None
+        self.loop_counters = {'detect': 0, 'display': 0, 'late': 0, 'stale': 0}
+        self._last_loop_counters = dict(self.loop_counters)
+        # [新增] 预览复用的缓冲区 / PhotoImage / 画布图像项 (见 _render_preview)
+        self._preview_rgba = None
+        self._preview_image = None
+        self._preview_photo = None
+        self._preview_item = None
+        self.show_metrics = METRICS.enabled and METRICS_OVERLAY
         
         self.stop_event = threading.Event()
         self.is_playing = False
-        self.background_frame = None
-        self.rois = {}
+        # [修改] 背景差分 / ROI 打分 / 训练与监测状态机都在 MotionEngine 中，GUI 只负责显示与交互
+        self.engine = MotionEngine(self.stimulator, PIXEL_DIFF_THRESHOLD, MOTION_AREA_THRESHOLD)
         self.roi_counter = 1
-        # self.threshold = 5
-        self.pixel_diff_threshold = 25  # 控制对光线/颜色变化的敏感度 (越小越灵敏，但也越容易受噪点干扰)
-        self.motion_area_threshold = 5  # 控制对运动面积大小的敏感度 (即原本的 self.threshold) 
         self.start_x = None
         self.start_y = None
         self.current_rect = None
@@ -431,45 +3727,52 @@ class UnifiedGUI:
         self.display_w = 800
         self.display_h = 600
         
-        # --- 训练相关变量 ---
-        self.is_training = False     
-        self.train_cfg = {}          
-        self.train_end_ts = 0
-        self.train_start_dt = None       
-        self.actual_train_end_dt = None
-        self.boxes_finished = set()  
-        
-        # --- 监测相关变量 ---
-        self.is_monitoring = False  
-        self.monitor_cfg = {}    
-        self.monitor_end_ts = 0         
-        self.monitor_start_dt = None    
-        self.actual_monitor_end_dt = None
-        
-        self.monitor_records = {k: [] for k in GPIO_PINS.keys()}
-        self.monitor_active_events = {} 
-
-        self.train_records = {k: [] for k in GPIO_PINS.keys()}
-        self.train_active_events = {}
-        
-        # --- 视频录制相关变量 ---
-        self.video_writer = None
-        self.recording_filename = None
-        
         self.count_labels = {} 
         self.hw_labels = {}
         
         self._setup_ui()
         self._init_hw_info()
 
+        # --- 视频录制 ---
+        self.recorder = VideoRecorder(self.log_system)
+
         self.stimulator.set_log_callback(self.update_shock_log_from_thread)
 
+        # [新增] 性能指标 (METRICS_ENABLED 时)
+        self._register_metrics()
+        METRICS.serve(log=self.log_system)
+
         # [修改] 启动逻辑分支
         if not IS_TEST_MODE:
             self.scan_and_load_cameras()
         elif IS_TEST_MODE and TEST_VIDEO_PATH and os.path.exists(TEST_VIDEO_PATH):
             self.load_video_file(TEST_VIDEO_PATH)
 
+        # [新增] 上次异常退出时留下的会话日志
+        self.root.after(1000, self._check_unfinished_session)
+
+    def _check_unfinished_session(self):
+        path = find_unfinished_journal()
+        if not path:
+            return
+        msg = (f"检测到未正常结束的会话:\n{os.path.basename(path)}\n\n"
+               "点击【是】继续该会话 (计数与剩余时间按日志恢复)\n"
+               "点击【否】将其标记为中断 (数据仍可导出)")
+        try:
+            if messagebox.askyesno("恢复会话", msg):
+                mode = self.engine.resume_session(path)
+                indices = [int(n.split('_')[-1]) for n in self.engine.rois if n.split('_')[-1].isdigit()]
+                self.roi_counter = max(indices, default=0) + 1
+                if mode == 'training':
+                    self.start_training(self.engine.train_cfg, resumed=True)
+                else:
+                    self.start_monitoring(self.engine.monitor_cfg, resumed=True)
+            else:
+                self.engine.close_unfinished(path)
+                self.log_system(f"已将未结束的会话标记为中断: {os.path.basename(path)}")
+        except Exception as e:
+            messagebox.showerror("错误", f"无法读取会话日志 {path}: {e}")
+
     def _setup_ui(self):
         control_frame = tk.Frame(self.root, pady=10, bg="#f0f0f0")
         control_frame.pack(side=tk.TOP, fill=tk.X)
@@ -477,10 +3780,15 @@ class UnifiedGUI:
         if IS_TEST_MODE:
             tk.Button(control_frame, text="打开视频文件", command=self.browse_video).pack(side=tk.LEFT, padx=5)
         else:
-            tk.Button(control_frame, text="重新扫描摄像头", command=self.scan_and_load_cameras, bg="#FFD700").pack(side=tk.LEFT, padx=5)
+            btn_scan = tk.Button(control_frame, text="重新扫描摄像头", command=self.scan_and_load_cameras, bg="#FFD700")
+            btn_scan.pack(side=tk.LEFT, padx=5)
+            # Shift+点击: 忽略设备清单缓存，强制重新探测
+            btn_scan.bind("<Shift-Button-1>", lambda e: (self.scan_and_load_cameras(use_cache=False), "break")[1])
 
         tk.Button(control_frame, text="重置背景(B)", command=self.reset_background).pack(side=tk.LEFT, padx=5)
         tk.Button(control_frame, text="清空区域", command=self.clear_rois).pack(side=tk.LEFT, padx=5)
+        tk.Button(control_frame, text="保存区域", command=self.save_rois).pack(side=tk.LEFT, padx=5)
+        tk.Button(control_frame, text="载入区域", command=self.load_rois).pack(side=tk.LEFT, padx=5)
         tk.Button(control_frame, text="重置计数", command=self.reset_counts).pack(side=tk.LEFT, padx=5)
         
         # 训练按钮
@@ -500,12 +3808,12 @@ class UnifiedGUI:
 
         tk.Label(control_frame, text="抗噪阈值:", bg="#f0f0f0").pack(side=tk.LEFT, padx=10)
         self.pixel_diff_scale = tk.Scale(control_frame, from_=1, to=100, orient=tk.HORIZONTAL, command=self.update_pixel_diff_threshold)
-        self.pixel_diff_scale.set(25) 
+        self.pixel_diff_scale.set(PIXEL_DIFF_THRESHOLD) 
         self.pixel_diff_scale.pack(side=tk.LEFT, padx=5)
 
         tk.Label(control_frame, text="运动面积阈值:", bg="#f0f0f0").pack(side=tk.LEFT, padx=10)
         self.motion_area_scale = tk.Scale(control_frame, from_=1, to=50, orient=tk.HORIZONTAL, command=self.update_motion_area_threshold)
-        self.motion_area_scale.set(5) 
+        self.motion_area_scale.set(MOTION_AREA_THRESHOLD) 
         self.motion_area_scale.pack(side=tk.LEFT, padx=5)
 
         self.pause_btn = tk.Button(control_frame, text="暂停 (Space)", command=self.toggle_pause)
@@ -534,23 +3842,27 @@ class UnifiedGUI:
             btn.bind("<ButtonPress-1>", lambda event, b=box_name, widget=btn: self.manual_shock_start(b, widget))
             btn.bind("<ButtonRelease-1>", lambda event, b=box_name, widget=btn: self.manual_shock_stop(b, widget))
 
-        # 底部三栏
-        bottom_container = tk.Frame(self.root, height=180, bg="#f0f0f0")
+        # 底部三栏 [修改] 高度不再固定：由"系统状态"的行数 (及多摄像头时换行的格式/丢帧行) 与日志框行数决定，不会裁掉末尾几行
+        bottom_container = tk.Frame(self.root, bg="#f0f0f0")
         bottom_container.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=10)
-        bottom_container.pack_propagate(False)
 
-        hw_frame = tk.LabelFrame(bottom_container, text="系统状态", width=200, bg="#f0f0f0")
+        hw_frame = tk.LabelFrame(bottom_container, text="系统状态", bg="#f0f0f0")
         hw_frame.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=5)
-        hw_frame.pack_propagate(False)
+        tk.Frame(hw_frame, width=190, height=0, bg="#f0f0f0").pack()  # 撑住栏宽 (值较短时不收窄)
         self._create_hw_label(hw_frame, "Mode", "模式")
         self._create_hw_label(hw_frame, "GPIO", "GPIO")
         self._create_hw_label(hw_frame, "Source", "源")
         self._create_hw_label(hw_frame, "Res", "分辨率")
+        self._create_hw_label(hw_frame, "Format", "格式")
+        self._create_hw_label(hw_frame, "Frames", "丢/重")
+        self._create_hw_label(hw_frame, "Rec", "录像")
+        self._create_hw_label(hw_frame, "Loop", "帧率")
 
         shock_log_frame = tk.LabelFrame(bottom_container, text="⚡ 电击事件记录", width=400, bg="#fff0f0") 
         shock_log_frame.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=5)
         shock_log_frame.pack_propagate(False)
-        self.shock_log_text = tk.Text(shock_log_frame, state=tk.DISABLED, bg="#2b2b2b", fg="#ff4444", font=("Consolas", 10))
+        self.shock_log_text = tk.Text(shock_log_frame, state=tk.DISABLED, bg="#2b2b2b", fg="#ff4444", font=("Consolas", 10),
+                                      height=9)
         shock_scroll = tk.Scrollbar(shock_log_frame, command=self.shock_log_text.yview)
         shock_scroll.pack(side=tk.RIGHT, fill=tk.Y)
         self.shock_log_text.config(yscrollcommand=shock_scroll.set)
@@ -558,7 +3870,8 @@ class UnifiedGUI:
 
         sys_log_frame = tk.LabelFrame(bottom_container, text="ℹ️ 系统运行日志", bg="#f0f0f0")
         sys_log_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
-        self.sys_log_text = tk.Text(sys_log_frame, state=tk.DISABLED, bg="black", fg="#00FF00", font=("Consolas", 9))
+        self.sys_log_text = tk.Text(sys_log_frame, state=tk.DISABLED, bg="black", fg="#00FF00", font=("Consolas", 9),
+                                    height=9)
         sys_scroll = tk.Scrollbar(sys_log_frame, command=self.sys_log_text.yview)
         sys_scroll.pack(side=tk.RIGHT, fill=tk.Y)
         self.sys_log_text.config(yscrollcommand=sys_scroll.set)
@@ -574,97 +3887,61 @@ class UnifiedGUI:
         self.canvas.bind("<ButtonRelease-1>", self.on_mouse_up)
         self.root.bind('<space>', lambda e: self.toggle_pause())
         self.root.bind('b', lambda e: self.reset_background())
+        self.root.bind('m', lambda e: self.toggle_metrics_overlay())
 
     # ==========================
     # 视频录制辅助函数
     # ==========================
     def _start_recording(self, prefix_name):
-        try:
-            timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{prefix_name}_{timestamp}.mp4"
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            fps = 20.0
-            scale_factor = 0.5 
-            self.record_w = int(self.display_w * scale_factor)
-            self.record_h = int(self.display_h * scale_factor)
-            self.video_writer = cv2.VideoWriter(filename, fourcc, fps, (self.record_w, self.record_h))
-            
-            if self.video_writer.isOpened():
-                self.recording_filename = filename
-                self.log_system(f"🎥 录像开始 (Res: {self.record_w}x{self.record_h}): {filename}")
-            else:
-                self.log_system("❌ 录像初始化失败！")
-                self.video_writer = None
-        except Exception as e:
-            self.log_system(f"❌ 录像错误: {str(e)}")
-            self.video_writer = None
+        fps = None
+        if self.camera_pool is not None:
+            fps = overview_record_fps([fmt.get('fps') for fmt in self.capture_formats])
+        self.recorder.start(prefix_name, (self.display_w, self.display_h), fps=fps, workers=self.capture_workers)
 
     def _stop_recording(self):
-        if self.video_writer:
-            self.video_writer.release()
-            self.video_writer = None
-            self.log_system(f"💾 录像已保存: {self.recording_filename}")
-            self.recording_filename = None
+        self.recorder.stop()
 
     # ==========================
     # 逻辑控制: 训练 (保持不变)
     # ==========================
     def ask_start_training(self):
-        if self.is_monitoring:
+        if self.engine.is_monitoring:
             messagebox.showwarning("冲突", "请先停止行为监测！")
             return
-        if self.is_training:
+        if self.engine.is_training:
             if messagebox.askyesno("停止", "确定要中断当前训练吗？"):
                 self.stop_training("手动中断")
             return
-        if not self.rois:
+        if not self.engine.rois:
             messagebox.showwarning("警告", "请先在画面上画出检测区域！")
             return
-        dialog = TrainingDialog(self.root, self.rois)
+        dialog = TrainingDialog(self.root, self.engine.rois)
         self.root.wait_window(dialog)
         if dialog.result:
             self.start_training(dialog.result)
 
-    def start_training(self, cfg):
-        self.is_training = True
-        self.train_cfg = cfg
-        self.reset_counts() 
-        self.train_records = {k: [] for k in GPIO_PINS.keys()}
-        self.train_active_events = {}
-        self.boxes_finished = set()
-        self.train_start_dt = cfg.get('click_time_dt', datetime.datetime.now())
-        self.actual_train_end_dt = None
-
-        if cfg['use_time']:
-            start_epoch = cfg.get('click_time_epoch', time.time())
-            self.train_end_ts = start_epoch + cfg['duration']
+    def start_training(self, cfg, resumed=False):
+        if not resumed:
+            self.engine.start_training(cfg)
         
         self.btn_train.config(text="⏹ 停止训练", bg="#FF6347")
         self.btn_monitor.config(state=tk.DISABLED) 
-        self.log_system("=== 训练开始 (电击模式) ===")
+        self.log_system("=== 训练恢复 (电击模式) ===" if resumed else "=== 训练开始 (电击模式) ===")
         self._start_recording("Train_Record")
-        if cfg.get('enable_push'):
+        if cfg.get('enable_push') and not resumed:
             msg = f"训练模式已启动。<br>时间: {datetime.datetime.now()}<br>配置: {cfg}"
             self._send_push("实验开始提醒 (训练)", msg)
         self.update_stats_display()
 
     def stop_training(self, reason):
-        self.actual_train_end_dt = datetime.datetime.now()
-        self.is_training = False
+        self.engine.stop_training(reason)
         self._stop_recording()
         
-        for box, start_time in list(self.train_active_events.items()):
-            duration = (self.actual_train_end_dt - start_time).total_seconds()
-            if box in self.train_records:
-                self.train_records[box].append(duration)
-        self.train_active_events.clear()
-        
-        self.stimulator.stop_all()
         self.btn_train.config(text="▶ 设定训练", bg="#90EE90")
         self.btn_monitor.config(state=tk.NORMAL)
         self.lbl_timer.config(text="空闲", fg="blue")
         self.log_system(f"=== 训练结束: {reason} ===")
-        if self.train_cfg.get('enable_push'):
+        if self.engine.train_cfg.get('enable_push'):
             msg = f"训练模式已结束。<br>原因: {reason}<br>结束时间: {datetime.datetime.now()}"
             self._send_push("实验结束提醒 (训练)", msg)
 
@@ -675,14 +3952,14 @@ class UnifiedGUI:
     # 逻辑控制: 行为监测 (保持不变)
     # ==========================
     def ask_start_monitoring(self):
-        if self.is_training:
+        if self.engine.is_training:
             messagebox.showwarning("冲突", "请先停止训练！")
             return
-        if self.is_monitoring:
+        if self.engine.is_monitoring:
             if messagebox.askyesno("停止", "确定要停止当前监测吗？"):
                 self.stop_monitoring("手动停止")
             return
-        if not self.rois:
+        if not self.engine.rois:
             messagebox.showwarning("警告", "请先在画面上画出检测区域！")
             return
 
@@ -692,45 +3969,28 @@ class UnifiedGUI:
         if dialog.result:
             self.start_monitoring(dialog.result)
 
-    def start_monitoring(self, cfg):
-        self.is_monitoring = True
-        self.monitor_cfg = cfg
-        self.monitor_records = {k: [] for k in GPIO_PINS.keys()}
-        self.monitor_active_events = {}
-        self.monitor_start_dt = cfg.get('click_time_dt', datetime.datetime.now())
-        self.actual_monitor_end_dt = None
-        
-        start_epoch = cfg.get('click_time_epoch', time.time())
-        self.monitor_end_ts = start_epoch + cfg['duration']
+    def start_monitoring(self, cfg, resumed=False):
+        if not resumed:
+            self.engine.start_monitoring(cfg)
         
         self.btn_monitor.config(text="⏹ 停止监测", bg="#FF6347")
         self.btn_train.config(state=tk.DISABLED) 
-        self.log_system("=== 行为监测开始 (无电击) ===")
+        self.log_system("=== 行为监测恢复 (无电击) ===" if resumed else "=== 行为监测开始 (无电击) ===")
         self.log_system(f"时长: {cfg['duration']}秒")
         self._start_recording("Monitor_Record")
-        if cfg.get('enable_push'):
+        if cfg.get('enable_push') and not resumed:
             msg = f"监测模式已启动。<br>时间: {datetime.datetime.now()}<br>计划时长: {cfg['duration']}秒"
             self._send_push("实验开始提醒 (监测)", msg)
 
     def stop_monitoring(self, reason):
-        self.actual_monitor_end_dt = datetime.datetime.now()
-        self.is_monitoring = False
+        self.engine.stop_monitoring(reason)
         self._stop_recording()
         
-        for box, start_time in list(self.monitor_active_events.items()):
-            duration = (self.actual_monitor_end_dt - start_time).total_seconds()
-            self.monitor_records[box].append({
-                'start': start_time,
-                'end': self.actual_monitor_end_dt,
-                'duration': duration
-            })
-        self.monitor_active_events.clear()
-        
         self.btn_monitor.config(text="👁 行为监测", bg="#87CEEB")
         self.btn_train.config(state=tk.NORMAL)
         self.lbl_timer.config(text="空闲", fg="blue")
         self.log_system(f"=== 监测结束: {reason} ===")
-        if self.monitor_cfg.get('enable_push'):
+        if self.engine.monitor_cfg.get('enable_push'):
             msg = f"监测模式已结束。<br>原因: {reason}<br>结束时间: {datetime.datetime.now()}"
             self._send_push("实验结束提醒 (监测)", msg)
         messagebox.showinfo("监测结束", f"行为监测已完成\n原因: {reason}\n您可以点击“导出日志”保存监测数据。\n视频已保存。")
@@ -739,8 +3999,8 @@ class UnifiedGUI:
     # 导出日志路由 (保持不变)
     # ==========================
     def export_log_router(self):
-        has_train_run = self.train_start_dt is not None
-        has_monitor_run = self.monitor_start_dt is not None
+        has_train_run = self.engine.train_start_dt is not None
+        has_monitor_run = self.engine.monitor_start_dt is not None
 
         if has_monitor_run and not has_train_run:
             self.export_monitor_log()
@@ -761,29 +4021,7 @@ class UnifiedGUI:
         if not filepath: return
 
         try:
-            with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
-                writer = csv.writer(f)
-                writer.writerow(["=== 电击训练日志 ==="])
-                start_str = self.train_start_dt.strftime("%Y-%m-%d %H:%M:%S") if self.train_start_dt else "N/A"
-                end_dt = self.actual_train_end_dt if self.actual_train_end_dt else datetime.datetime.now()
-                end_str = end_dt.strftime("%Y-%m-%d %H:%M:%S")
-                duration = str(end_dt - self.train_start_dt).split('.')[0] if self.train_start_dt else "N/A"
-                
-                writer.writerow(["开始时间", start_str])
-                writer.writerow(["结束时间", end_str])
-                writer.writerow(["训练时长", duration])
-                writer.writerow([]) 
-
-                writer.writerow(["=== 统计数据 ==="])
-                writer.writerow(["Box名称", "电击次数"])
-                for box, count in self.stimulator.shock_counts.items():
-                    writer.writerow([box, count])
-                writer.writerow([]) 
-
-                writer.writerow(["=== 详细事件记录 ==="])
-                writer.writerow(["时间戳", "Box名称", "次数序号"])
-                for record in self.stimulator.shock_history:
-                    writer.writerow([record['timestamp'], record['box_id'], record['count_index']])
+            self.engine.write_train_log(filepath)
             self.log_system(f"训练日志已保存: {os.path.basename(filepath)}")
             messagebox.showinfo("成功", "训练日志导出成功！")
         except Exception as e:
@@ -795,43 +4033,7 @@ class UnifiedGUI:
         if not filepath: return
 
         try:
-            with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
-                writer = csv.writer(f)
-                writer.writerow(["=== 行为监测日志 (无电击) ==="])
-                
-                start_str = self.monitor_start_dt.strftime("%Y-%m-%d %H:%M:%S") if self.monitor_start_dt else "N/A"
-                end_dt = self.actual_monitor_end_dt if self.actual_monitor_end_dt else datetime.datetime.now()
-                end_str = end_dt.strftime("%Y-%m-%d %H:%M:%S")
-                duration = str(end_dt - self.monitor_start_dt).split('.')[0] if self.monitor_start_dt else "N/A"
-                
-                writer.writerow(["监测开始", start_str])
-                writer.writerow(["监测结束", end_str])
-                writer.writerow(["总监测时长", duration])
-                writer.writerow([]) 
-
-                writer.writerow(["=== 停留时长统计 (Summary) ==="])
-                writer.writerow(["Box名称", "总停留时间(秒)", "进入次数"])
-                for box in sorted(GPIO_PINS.keys()):
-                    records = self.monitor_records.get(box, [])
-                    total_dur = sum([r['duration'] for r in records])
-                    count = len(records)
-                    writer.writerow([box, f"{total_dur:.2f}", count])
-                writer.writerow([]) 
-
-                writer.writerow(["=== 详细进出记录 (Details) ==="])
-                writer.writerow(["Box名称", "进入时间", "离开时间", "单次停留时长(秒)"])
-                
-                all_records = []
-                for box, recs in self.monitor_records.items():
-                    for r in recs:
-                        all_records.append({**r, 'box': box})
-                all_records.sort(key=lambda x: x['start'])
-                
-                for r in all_records:
-                    s_str = r['start'].strftime("%H:%M:%S.%f")[:-3]
-                    e_str = r['end'].strftime("%H:%M:%S.%f")[:-3]
-                    writer.writerow([r['box'], s_str, e_str, f"{r['duration']:.2f}"])
-                    
+            self.engine.write_monitor_log(filepath)
             self.log_system(f"监测日志已保存: {os.path.basename(filepath)}")
             messagebox.showinfo("成功", "行为监测日志导出成功！")
         except Exception as e:
@@ -875,23 +4077,93 @@ class UnifiedGUI:
         row = tk.Frame(parent, bg="#f0f0f0")
         row.pack(fill=tk.X, padx=5, pady=2)
         tk.Label(row, text=f"{title}:", width=6, anchor="w", bg="#f0f0f0", fg="#666").pack(side=tk.LEFT)
-        val_label = tk.Label(row, text="--", anchor="w", bg="#f0f0f0", font=("Arial", 9, "bold"))
+        # 值过长时在栏内换行 (行高随之增加)，不撑宽"系统状态"栏
+        val_label = tk.Label(row, text="--", anchor="w", justify=tk.LEFT, wraplength=130, bg="#f0f0f0",
+                             font=("Arial", 9, "bold"))
         val_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
         self.hw_labels[key] = val_label
 
     def _init_hw_info(self):
         mode_text = "测试" if IS_TEST_MODE else "多摄实战"
         self.hw_labels["Mode"].config(text=mode_text, fg="blue" if IS_TEST_MODE else "red")
-        gpio_status = "OK" if self.stimulator.gpio_available else "Sim"
+        gpio_status = f"OK ({self.stimulator.backend.name})" if self.stimulator.gpio_available else "Sim"
         self.hw_labels["GPIO"].config(text=gpio_status, fg="green" if self.stimulator.gpio_available else "#888")
 
     def _update_video_info(self, source_name, width, height):
         self.hw_labels["Source"].config(text=str(source_name)[:15])
         self.hw_labels["Res"].config(text=f"{width}x{height}")
 
+    def _update_capture_formats(self):
+        """显示协商出的采集格式，相同格式合并计数 (如 4×MJPG 640x480@30)"""
+        counts = collections.Counter(format_label(fmt) for fmt in self.capture_formats)
+        self.hw_labels["Format"].config(text=" ".join(f"{n}×{label}" for label, n in counts.items()) or "--")
+
+    def _capture_counters(self):
+        """每路 (名称, 丢帧, 重复帧)，采集线程与多进程两种模式通用"""
+        if self.camera_pool is not None:
+            return [(c.source_name, c.dropped, c.duplicates) for c in self.camera_pool.cameras]
+        return [(w.source_name, w.slot.dropped, w.slot.duplicates) for w in self.capture_workers]
+
+    def _update_capture_stats(self):
+        """刷新每个摄像头的丢帧/重复帧计数 (格式: 序号:丢帧/重复帧)"""
+        parts = []
+        for i, (_, dropped, duplicates) in enumerate(self._capture_counters()):
+            parts.append(f"{i}:{dropped}/{duplicates}")
+        self.hw_labels["Frames"].config(text=" ".join(parts) if parts else "--")
+
+        # 实际检测/预览帧率，以及落后跳过的节拍数与无新帧的节拍数
+        c, last = self.loop_counters, self._last_loop_counters
+        self.hw_labels["Loop"].config(text=f"检{c['detect'] - last['detect']}/显{c['display'] - last['display']} "
+                                           f"跳{c['late']} 空{c['stale']}")
+        self._last_loop_counters = dict(c)
+
+        # 录像队列深度 / 平均编码耗时 / 丢帧数
+        rec = self.recorder.stats()
+        if rec:
+            self.hw_labels["Rec"].config(text=f"q{rec['queue_depth']}/{rec['queue_size']} {rec['encode_ms_avg']:.0f}ms 丢{rec['dropped']}")
+        else:
+            self.hw_labels["Rec"].config(text="--")
+
+    def _register_metrics(self):
+        """采集与录像的计数器也一并导出到 /metrics"""
+        METRICS.add_gauge("bbc_capture_dropped_frames", "Frames overwritten before the main loop consumed them.",
+                          lambda: [({'camera': name}, d) for name, d, _ in self._capture_counters()])
+        METRICS.add_gauge("bbc_capture_duplicate_frames", "Main loop iterations that reused the previous frame.",
+                          lambda: [({'camera': name}, d) for name, _, d in self._capture_counters()])
+        def recorder_stat(key):
+            rec = self.recorder.stats()
+            return [({}, rec[key])] if rec else []
+        METRICS.add_gauge("bbc_record_queue_depth", "Frames waiting in the recording encode queue.",
+                          lambda: recorder_stat('queue_depth'))
+        METRICS.add_gauge("bbc_record_dropped_frames", "Frames dropped by the recording queue.",
+                          lambda: recorder_stat('dropped'))
+
+    def toggle_metrics_overlay(self):
+        if not METRICS.enabled:
+            self.log_system("性能探针未启用 (config.json: METRICS_ENABLED)")
+            return
+        self.show_metrics = not self.show_metrics
+        self._update_metrics_overlay()
+
+    def _update_metrics_overlay(self):
+        """画面左上角显示各阶段最近耗时 (p50 / p95 / p99，毫秒)，每秒刷新"""
+        self.canvas.delete("metrics_overlay")
+        if not self.show_metrics:
+            return
+        lines = [f"{name:<11}{st['p50']:6.1f}{st['p95']:6.1f}{st['p99']:6.1f}"
+                 for name, st in sorted(METRICS.summary().items())]
+        if not lines:
+            return
+        text = "stage        p50   p95   p99 ms\n" + "\n".join(lines)
+        self.canvas.create_text(8, 8, text=text, anchor=tk.NW, fill="yellow", font=("Courier", 9),
+                                tags="metrics_overlay")
+
     def update_shock_log_from_thread(self, msg):
         self.root.after(0, lambda: self._write_to_widget(self.shock_log_text, msg))
 
+    def update_system_log_from_thread(self, msg):
+        self.root.after(0, lambda: self.log_system(msg))
+
     def log_system(self, msg):
         time_str = datetime.datetime.now().strftime("%H:%M:%S")
         self._write_to_widget(self.sys_log_text, f"[{time_str}] {msg}")
@@ -911,11 +4183,7 @@ class UnifiedGUI:
         self.stimulator.set_active(box_id, False)
 
     def reset_counts(self):
-        self.stimulator.reset_counts()
-        self.boxes_finished = set() 
-        self.train_start_dt = None 
-        self.monitor_start_dt = None
-        self.monitor_records = {k: [] for k in GPIO_PINS.keys()} 
+        self.engine.reset_counts()
         self.update_stats_display()
         self.log_system("所有计数与记录已重置")
 
@@ -923,12 +4191,12 @@ class UnifiedGUI:
         for box_name, count in self.stimulator.shock_counts.items():
             if box_name in self.count_labels:
                 target_str = "-"
-                if self.is_training and self.train_cfg.get('use_count'):
-                    target = self.train_cfg['targets'].get(box_name, 9999)
+                if self.engine.is_training and self.engine.train_cfg.get('use_count'):
+                    target = self.engine.train_cfg['targets'].get(box_name, 9999)
                     target_str = str(target)
                 text = f"{count} / {target_str}"
                 fg_color = "blue"
-                if box_name in self.boxes_finished:
+                if box_name in self.engine.boxes_finished:
                     fg_color = "#00AA00"
                     text += " (√)"
                 self.count_labels[box_name].config(text=text, fg=fg_color)
@@ -944,22 +4212,17 @@ class UnifiedGUI:
         self.log_system(f"加载视频: {os.path.basename(path)}")
         self._start_capture([path], is_file=True)
 
-    def scan_and_load_cameras(self):
-        self.log_system("正在扫描可用摄像头 (0-20)... 请稍候")
-        self.root.update()
-        
-        available = []
-        # 扫描 0-20 号设备
-        for i in range(21):
-            cap = cv2.VideoCapture(i, cv2.CAP_V4L2)
-            if cap.isOpened():
-                ret, frame = cap.read()
-                if ret:
-                    h, w = frame.shape[:2]
-                    info = f"{w}x{h}"
-                    available.append((i, info))
-                cap.release()
-        
+    def scan_and_load_cameras(self, use_cache=True):
+        self.log_system("正在扫描可用摄像头... 请稍候")
+
+        # 探测在后台线程进行，界面不阻塞；结果回到主线程处理
+        def _scan_task():
+            available = discover_cameras(use_cache=use_cache, log=self.update_system_log_from_thread)
+            self.root.after(0, lambda: self._on_cameras_discovered(available))
+
+        threading.Thread(target=_scan_task, daemon=True).start()
+
+    def _on_cameras_discovered(self, available):
         self.log_system(f"扫描完成，找到 {len(available)} 个设备")
         
         if not available:
@@ -976,76 +4239,72 @@ class UnifiedGUI:
         else:
             self.log_system("用户取消了摄像头选择")
 
-    def _start_capture(self, sources, is_file=False):
+    def _stop_capture(self):
+        """停止主循环与所有采集线程，并释放摄像头"""
         self.stop_event.set()
-        
+        if self._loop_job is not None:
+            self.root.after_cancel(self._loop_job)
+            self._loop_job = None
+        for worker in self.capture_workers:
+            worker.stop()
+        self.capture_workers = []
+        if self.camera_pool is not None:
+            self.camera_pool.stop()
+            self.camera_pool = None
+
+    def _start_capture(self, sources, is_file=False):
         # 释放旧资源
-        for c in self.caps:
-            c.release()
-        self.caps = []
-        
-        # 稍微等待旧线程退出
-        if self.is_playing:
-            self.root.after(200, lambda: self._start_capture(sources, is_file))
+        self._stop_capture()
+
+        self.capture_formats = []
+        caps, cap_names = open_sources(sources, is_file, self.log_system, formats=self.capture_formats)
+        self._update_capture_formats()
+        if not caps:
+            if not is_file:
+                self.log_system("错误: 所有选中的摄像头都无法打开")
             return
+        source_name = "VideoFile" if is_file else f"Multi-Cam ({len(caps)})"
 
-        source_name = ""
-        
-        if is_file:
-            # 文件模式: sources[0] 是路径
-            cap = cv2.VideoCapture(sources[0])
-            if not cap.isOpened():
-                self.log_system("无法打开视频文件")
-                return
-            self.caps.append(cap)
-            source_name = "VideoFile"
+        if CAPTURE_PROCESSES:
+            self._start_camera_pool(sources, caps, cap_names, is_file, source_name)
         else:
-            # 摄像头模式: sources 是索引列表 [0, 2, ...]
-            for idx in sources:
-                cap = cv2.VideoCapture(idx, cv2.CAP_V4L2)
-                # 设置优选分辨率
-                cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                
-                if cap.isOpened():
-                    self.caps.append(cap)
-                else:
-                    self.log_system(f"警告: 无法打开选中摄像头 {idx}")
-            
-            if not self.caps:
-                self.log_system("错误: 所有选中的摄像头都无法打开")
+            # 读取第一帧用于初始化显示
+            self.capture_workers, frames = start_capture_workers(caps, cap_names, is_file)
+
+            if not frames:
                 return
-            source_name = f"Multi-Cam ({len(self.caps)})"
 
-        # 读取第一帧用于初始化显示
-        frames = []
-        for c in self.caps:
-            ret, f = c.read()
-            if ret:
-                frames.append(f)
-            else:
-                # 假如某个坏了，给个黑帧
-                frames.append(np.zeros((480, 640, 3), dtype=np.uint8))
+            # 计算拼接后的总宽高 (统一为第一路的高度)，拼接画面只用于显示
+            native_sizes = [(f.shape[1], f.shape[0]) for f in frames]
+            total_w, base_h = CameraLayout.natural_size(native_sizes)
+            self._init_display_geometry(total_w, base_h)
+            self._update_video_info(source_name, total_w, base_h)
+            self.layout = CameraLayout(native_sizes, CameraLayout.working_sizes_for(native_sizes),
+                                       (self.display_w, self.display_h))
 
-        if not frames:
-            return
+            start_capture_threads(self.capture_workers)
+            self.engine.capture_mode = capture_mode_label(self.capture_workers)
 
-        # 计算拼接后的总宽高
-        # 为了拼接，所有图片高度必须一致。我们以第一张图的高度为基准。
-        base_h = frames[0].shape[0]
-        total_w = 0
-        
-        for f in frames:
-            h, w = f.shape[:2]
-            scale = base_h / h
-            total_w += int(w * scale)
+        self.stop_event.clear()
+        self.is_playing = True
+        self._detect_deadline = self._display_deadline = time.monotonic()
+        self._last_camera_seq = None
+        self.video_loop()
 
+    def _start_camera_pool(self, sources, caps, cap_names, is_file, source_name):
+        """[新增] 多进程模式: 主进程只读取各路首帧尺寸，随后释放设备，由各子进程重新打开并采集/打分"""
+        native_sizes = probe_native_sizes(caps)
+        total_w, base_h = CameraLayout.natural_size(native_sizes)
         self._init_display_geometry(total_w, base_h)
         self._update_video_info(source_name, total_w, base_h)
+        self.layout = CameraLayout(native_sizes, CameraLayout.working_sizes_for(native_sizes),
+                                   (self.display_w, self.display_h))
 
-        self.stop_event.clear()
-        self.is_playing = True
-        self.video_loop()
+        opened = sources[:1] if is_file else [idx for idx in sources if str(idx) in cap_names]
+        self.camera_pool = CameraProcessPool(opened, cap_names, self.layout, is_file, formats=self.capture_formats)
+        self.camera_pool.start()
+        self.engine.capture_mode = capture_mode_label(pool=self.camera_pool)
+        self.log_system(f"多进程采集: {len(opened)} 个子进程")
 
     def _init_display_geometry(self, w, h):
         self.root.update_idletasks()
@@ -1060,240 +4319,171 @@ class UnifiedGUI:
         self.scale_factor = scale
         
         self.canvas.config(width=self.display_w, height=self.display_h)
-        self.background_frame = None
+        self.engine.reset_background()
         self.log_system("视频系统就绪。请画框。")
 
     def video_loop(self):
+        """
+        [修改] 主循环按单调时钟截止时间调度，周期不再是 “30ms + 处理耗时”：
+        - 检测 (取帧 → 检测 → 标注 → 录像) 按 DETECT_FPS 运行，落后时丢弃错过的节拍、只处理最新帧
+        - 画面预览与状态栏按较低的 DISPLAY_FPS 刷新，负载高时先降预览帧率，检测帧率不受影响
+        """
+        self._loop_job = None
         if self.stop_event.is_set(): return
-        self.update_stats_display()
-        
-        # === 状态检查 ===
+
+        # === 状态检查 (结束条件由引擎判断，界面只负责显示) ===
         current_time = time.time()
-        
-        # 1. 监测模式倒计时
-        if self.is_monitoring:
-            remaining = self.monitor_end_ts - current_time
-            if remaining <= 0:
-                self.stop_monitoring("时间到")
-            else:
-                self.lbl_timer.config(text=f"监测剩余: {int(remaining)}秒", fg="blue")
-        
-        # 2. 训练模式倒计时 & 计数
-        elif self.is_training:
-            should_stop = False
-            stop_reason = ""
-            if self.train_cfg['use_time']:
-                remaining = self.train_end_ts - current_time
-                if remaining <= 0:
-                    should_stop = True
-                    stop_reason = "时间到"
-                else:
-                    msg = f"剩余: {int(remaining)}秒"
-                    if self.train_cfg['use_count']: msg = f"计次&{msg}"
-                    self.lbl_timer.config(text=msg, fg="orange")
-            else:
-                self.lbl_timer.config(text="计次训练中", fg="red")
-            
-            if self.train_cfg['use_count']:
-                all_finished = True
-                if not self.rois: all_finished = False 
-                for name in self.rois:
-                    curr = self.stimulator.shock_counts.get(name, 0)
-                    target = self.train_cfg['targets'].get(name, 9999)
-                    if curr >= target:
-                        if name not in self.boxes_finished:
-                            self.boxes_finished.add(name) 
-                            self.stimulator.set_active(name, False) 
-                    else:
-                        all_finished = False 
-                if all_finished and len(self.rois) > 0:
-                    should_stop = True
-                    stop_reason = "所有区域达到次数"
+        status = self.engine.check_session(current_time)
 
-            if should_stop:
-                self.stop_training(stop_reason)
-        else:
-            self.lbl_timer.config(text="空闲", fg="gray")
+        now = time.monotonic()
+        render = now >= self._display_deadline
+        if render:
+            self._display_deadline, _ = next_deadline(self._display_deadline, self.display_period, now)
+            self.update_stats_display()
 
+        if status['stop_reason']:
+            if status['mode'] == 'monitoring':
+                self.stop_monitoring(status['stop_reason'])
+            else:
+                self.stop_training(status['stop_reason'])
+        elif render:
+            self._update_timer_label(status)
 
-        if self.is_playing:
-            # [修改] 动态读取所有摄像头并拼接
-            raw_frames = []
-            valid_read = False
-            
-            for i, cap in enumerate(self.caps):
-                ret, frame = cap.read()
-                if ret:
-                    raw_frames.append(frame)
-                    valid_read = True
-                else:
-                    # 读取失败，如果是在播放文件，可能结束了
-                    if IS_TEST_MODE: 
-                         cap.set(cv2.CAP_PROP_POS_FRAMES, 0) # 循环播放
-                         _, r_frame = cap.read()
-                         raw_frames.append(r_frame)
-                    else:
-                        # 摄像头掉线，补黑帧
-                        raw_frames.append(np.zeros((480, 640, 3), dtype=np.uint8))
+        if current_time - self._last_stats_ts >= 1.0:
+            self._last_stats_ts = current_time
+            self._update_capture_stats()
+            self._update_metrics_overlay()
 
-            if not valid_read and not IS_TEST_MODE:
-                self.log_system("所有摄像头无信号")
+        if self.is_playing:
+            if not self._detect_step(render):
                 return
 
-            # [拼接逻辑] 统一高度
-            if len(raw_frames) > 0:
-                base_h = raw_frames[0].shape[0]
-                resized_list = []
-                for f in raw_frames:
-                    h, w = f.shape[:2]
-                    if h != base_h:
-                        new_w = int(w * (base_h / h))
-                        resized_list.append(cv2.resize(f, (new_w, base_h)))
-                    else:
-                        resized_list.append(f)
-                
-                # 横向拼接
-                final_frame = np.hstack(resized_list)
+        self._detect_deadline, skipped = next_deadline(self._detect_deadline, self.detect_period, time.monotonic())
+        self.loop_counters['late'] += skipped
+        delay_ms = max(1, int(round((self._detect_deadline - time.monotonic()) * 1000)))
+        self._loop_job = self.root.after(delay_ms, self.video_loop)
+
+    def _update_timer_label(self, status):
+        if status['mode'] == 'monitoring':
+            self.lbl_timer.config(text=f"监测剩余: {int(status['remaining'])}秒", fg="blue")
+        elif status['mode'] == 'training':
+            if self.engine.train_cfg['use_time']:
+                msg = f"剩余: {int(status['remaining'])}秒"
+                if self.engine.train_cfg['use_count']: msg = f"计次&{msg}"
+                self.lbl_timer.config(text=msg, fg="orange")
             else:
-                final_frame = np.zeros((480, 640, 3), dtype=np.uint8)
-
-            # 调整为显示大小 (display_w, display_h)
-            frame_resized = cv2.resize(final_frame, (self.display_w, self.display_h))
-            
-            # 转灰度做动态检测
-            gray = cv2.cvtColor(frame_resized, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-            if self.background_frame is None:
-                self.background_frame = gray
-            
-            # --- 绘制 Box 逻辑 ---
-            for name, rect in self.rois.items():
-                x, y, w, h = rect
-                if x+w > self.display_w or y+h > self.display_h: continue
-
-                roi_curr = gray[y:y+h, x:x+w]
-                roi_bg = self.background_frame[y:y+h, x:x+w]
-                
-                diff = cv2.absdiff(roi_curr, roi_bg)
-                _, diff_binary = cv2.threshold(diff, self.pixel_diff_threshold, 255, cv2.THRESH_BINARY)
-                non_zero_count = cv2.countNonZero(diff_binary)
-                
-                total_pixels = w * h
-                score = (non_zero_count / total_pixels) * 100 if total_pixels > 0 else 0
-                is_active = score > self.motion_area_threshold
-                
-                COLOR_PREVIEW_IDLE = (0, 255, 0)   
-                COLOR_PREVIEW_ACT  = (0, 0, 255)   
-                
-                COLOR_TRAIN_IDLE   = (0, 140, 255) 
-                COLOR_TRAIN_ACT    = (0, 0, 255)   
-                
-                COLOR_MONITOR_IDLE = (255, 255, 0) 
-                COLOR_MONITOR_ACT  = (255, 0, 0)   
-
-                thickness = 2
-                label_text = ""
-                box_color = COLOR_PREVIEW_IDLE
-
-                if self.is_training:
-                    now_dt = datetime.datetime.now()
-                    
-                    if self.train_cfg['use_count'] and name in self.boxes_finished:
-                        box_color = (0, 255, 0) 
-                        label_text = f"{name}: DONE"
-                        self.stimulator.set_active(name, False)
-                        
-                        # 如果完成了，也要结算时间（视为离开）
-                        if name in self.train_active_events:
-                            start_time = self.train_active_events.pop(name)
-                            dur = (now_dt - start_time).total_seconds()
-                            self.train_records[name].append(dur)
-
-                    else:
-                        if is_active:
-                            # --- 激活状态 (进入) ---
-                            box_color = COLOR_TRAIN_ACT
-                            label_text = f"{name}:{int(score)}% (SHOCK)"
-                            thickness = 3 
-                            self.stimulator.set_active(name, True)
-                            
-                            if name not in self.train_active_events:
-                                self.train_active_events[name] = now_dt
-                        else:
-                            # --- 非激活状态 (离开/静止) ---
-                            box_color = COLOR_TRAIN_IDLE
-                            label_text = f"{name}:{int(score)}% (TRAIN)"
-                            self.stimulator.set_active(name, False)
-                            
-                            if name in self.train_active_events:
-                                start_time = self.train_active_events.pop(name)
-                                dur = (now_dt - start_time).total_seconds()
-                                if name in self.train_records: 
-                                    self.train_records[name].append(dur)
-
-                elif self.is_monitoring:
-                    now_dt = datetime.datetime.now()
-                    if is_active:
-                        box_color = COLOR_MONITOR_ACT
-                        label_text = f"{name}:{int(score)}% (REC)"
-                        thickness = 3 
-                        if name not in self.monitor_active_events:
-                            self.monitor_active_events[name] = now_dt
-                    else:
-                        box_color = COLOR_MONITOR_IDLE
-                        label_text = f"{name}:{int(score)}% (MONITOR)"
-                        if name in self.monitor_active_events:
-                            start_time = self.monitor_active_events.pop(name)
-                            duration = (now_dt - start_time).total_seconds()
-                            self.monitor_records[name].append({
-                                'start': start_time,
-                                'end': now_dt,
-                                'duration': duration
-                            })
-
-                else:
-                    if is_active:
-                        box_color = COLOR_PREVIEW_ACT
-                        label_text = f"{name}:{int(score)}% (Preview)"
-                    else:
-                        box_color = COLOR_PREVIEW_IDLE
-                        label_text = f"{name}:{int(score)}%"
-                    self.stimulator.set_active(name, False)
-                
-                cv2.rectangle(frame_resized, (x, y), (x+w, y+h), box_color, thickness)
-                cv2.putText(frame_resized, label_text, (x, y-5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, box_color, 1)
+                self.lbl_timer.config(text="计次训练中", fg="red")
+        else:
+            self.lbl_timer.config(text="空闲", fg="gray")
 
-            # 绘制全局时间戳
-            timestamp_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ts_pos = (20, 40)
-            cv2.putText(frame_resized, timestamp_str, ts_pos, cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 4)
-            cv2.putText(frame_resized, timestamp_str, ts_pos, cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    def _detect_step(self, render):
+        """一次检测；render 为 True 时同时刷新预览。所有摄像头掉线时返回 False (停止主循环)"""
+        loop_t0 = time.perf_counter()
+        # [修改] 只从各采集线程的槽位取最新帧 (附带采集时间戳)，不在主线程做任何阻塞 I/O
+        with METRICS.span("capture"):
+            if self.camera_pool is not None:
+                frame_resized, scores, stamp = self.camera_pool.collect(self.engine)
+            else:
+                raw_frames, stamp = collect_latest_frames(self.capture_workers)
+
+        sources = self.camera_pool.cameras if self.camera_pool is not None else self.capture_workers
+        if not IS_TEST_MODE and sources and all(w.signal_lost for w in sources):
+            self.log_system("所有摄像头无信号")
+            return False
+
+        # 没有任何一路出新帧时不重复检测同一帧
+        if stamp['camera_seq'] == self._last_camera_seq:
+            self.loop_counters['stale'] += 1
+            return True
+        self._last_camera_seq = stamp['camera_seq']
+        self.loop_counters['detect'] += 1
+
+        if self.camera_pool is not None:
+            # [新增] 各路已在子进程中缩放、拼入预览帧并完成打分，主进程只推进状态机
+            stamp = self.engine.advance(stamp)
+            with METRICS.span("state"):
+                roi_results, _, _ = self.engine.apply_scores(scores, stamp)
+        else:
+            # [修改] 运动检测在每路自己的检测分辨率上进行，不再作用于拼接缩放后的画面
+            roi_results, _ = self.engine.process_cameras(raw_frames, stamp, self.layout)
+
+        # [修改] 拼接、标注 (及 YUYV 原始帧的颜色转换) 只对要显示或录像的帧做
+        if not render and self.recorder.video_writer is None:
+            METRICS.observe("loop", time.perf_counter() - loop_t0)
+            return True
+        if self.camera_pool is None:
+            # [拼接逻辑] 各路按统一高度缩放进显示大小 (display_w, display_h) 的拼接画面，仅用于显示与总览录像
+            with METRICS.span("stitch"):
+                frame_resized = self.layout.compose(raw_frames)
+        with METRICS.span("annotate"):
+            annotate_frame(frame_resized, roi_results, layout=self.layout)
+
+        # 视频写入逻辑
+        with METRICS.span("record"):
+            self.recorder.write(frame_resized, stamp['t'])
+
+        # UI 显示转换 (按 DISPLAY_FPS 抽帧)
+        if render:
+            self.loop_counters['display'] += 1
+            with METRICS.span("display"):
+                self._render_preview(frame_resized)
+        METRICS.observe("loop", time.perf_counter() - loop_t0)
+        return True
+
+    def _render_preview(self, frame):
+        """
+        [修改] 预览只保留一个画布图像项和一个 PhotoImage，每帧原地更新，不再新建对象：
+        颜色转换写入复用的 RGBA 缓冲区，PIL 图像直接映射该缓冲区 (不复制)，再 paste 进 PhotoImage。
+        图像项放在最底层，画框与叠加层始终在其上方。
+        """
+        h, w = frame.shape[:2]
+        if self._preview_rgba is None or self._preview_rgba.shape[:2] != (h, w):
+            self._preview_rgba = np.empty((h, w, 4), dtype=np.uint8)
+            self._preview_image = Image.frombuffer("RGBA", (w, h), self._preview_rgba, "raw", "RGBA", 0, 1)
+            self._preview_photo = ImageTk.PhotoImage("RGBA", (w, h))
+            if self._preview_item is None:
+                self._preview_item = self.canvas.create_image(0, 0, image=self._preview_photo, anchor=tk.NW)
+            else:
+                self.canvas.itemconfig(self._preview_item, image=self._preview_photo)
+            self.canvas.tag_lower(self._preview_item)
 
-            # 视频写入逻辑
-            if self.video_writer is not None:
-                try:
-                    frame_to_save = cv2.resize(frame_resized, (self.record_w, self.record_h))
-                    self.video_writer.write(frame_to_save)
-                except Exception as e:
-                    print(f"写入帧错误: {e}")
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA, dst=self._preview_rgba)
+        self._preview_photo.paste(self._preview_image)
 
-            # UI 显示转换
-            img = Image.fromarray(cv2.cvtColor(frame_resized, cv2.COLOR_BGR2RGB))
-            photo = ImageTk.PhotoImage(image=img)
-            self.canvas.create_image(0, 0, image=photo, anchor=tk.NW)
-            self.canvas.image = photo
-            
-            if self.drawing and self.current_rect:
-                self.canvas.tag_raise(self.current_rect)
+    def update_pixel_diff_threshold(self, val): self.engine.pixel_diff_threshold = int(val)
+    def update_motion_area_threshold(self, val): self.engine.motion_area_threshold = int(val)
+    def reset_background(self): self.engine.reset_background(); self.log_system("背景重置")
+    def clear_rois(self): self.engine.clear_rois(); self.roi_counter = 1; self.log_system("区域清空")
+    def toggle_pause(self): self.is_playing = not self.is_playing
 
-        self.root.after(30, self.video_loop)
+    def save_rois(self):
+        if not self.engine.rois or self.layout is None:
+            messagebox.showwarning("警告", "当前没有检测区域可保存")
+            return
+        try:
+            # [修改] 保存各区域所属摄像头及该路检测分辨率下的坐标，与窗口大小无关
+            save_rois(ROI_FILE, self.engine.rois, self.engine.roi_cameras, self.layout.working_sizes)
+            sizes = ", ".join(f"{w}x{h}" for w, h in self.layout.working_sizes)
+            self.log_system(f"检测区域已保存: {ROI_FILE} ({sizes})")
+        except Exception as e:
+            messagebox.showerror("错误", str(e))
 
-    def update_pixel_diff_threshold(self, val): self.pixel_diff_threshold = int(val)
-    def update_motion_area_threshold(self, val): self.motion_area_threshold = int(val)
-    def reset_background(self): self.background_frame = None; self.log_system("背景重置")
-    def clear_rois(self): self.rois = {}; self.roi_counter = 1; self.log_system("区域清空")
-    def toggle_pause(self): self.is_playing = not self.is_playing
+    def load_rois(self):
+        if self.layout is None:
+            messagebox.showwarning("警告", "请先打开视频源")
+            return
+        try:
+            rois, roi_cameras, camera_sizes, frame_size = load_rois(ROI_FILE)
+        except Exception as e:
+            messagebox.showerror("错误", f"无法读取 {ROI_FILE}: {e}")
+            return
+        # 区域坐标按保存时各路的检测分辨率 (旧文件: 拼接画面尺寸) 换算到当前各路
+        rois, roi_cameras = self.layout.import_rois(rois, roi_cameras, camera_sizes, frame_size)
+        self.engine.set_rois(rois, roi_cameras)
+        indices = [int(n.split('_')[-1]) for n in rois if n.split('_')[-1].isdigit()]
+        self.roi_counter = max(indices, default=0) + 1
+        self.log_system(f"已载入 {len(rois)} 个检测区域")
+        self.update_stats_display()
 
     def on_mouse_down(self, event):
         self.start_x, self.start_y = event.x, event.y
@@ -1307,25 +4497,763 @@ class UnifiedGUI:
         self.drawing = False
         x1, y1, x2, y2 = self.start_x, self.start_y, event.x, event.y
         x, y, w, h = min(x1, x2), min(y1, y2), abs(x2-x1), abs(y2-y1)
-        if w > 10 and h > 10:
+        if w > 10 and h > 10 and self.layout is not None:
             name = f"Box_{self.roi_counter}"
-            self.rois[name] = (x, y, w, h)
+            # [修改] 画框坐标 (拼接画面) 换算为所在摄像头的检测坐标
+            camera, rect = self.layout.from_display((x, y, w, h))
+            self.engine.add_roi(name, rect, camera)
             self.roi_counter += 1
-            self.log_system(f"添加监测区: {name}")
+            self.log_system(f"添加监测区: {name} (摄像头 {camera})")
             self.update_stats_display()
         self.canvas.delete(self.current_rect)
 
     def on_close(self):
-        self.stop_event.set()
+        # 关闭窗口时结束进行中的会话，事件日志写入结束记录，下次启动不再提示恢复
+        if self.engine.is_training:
+            self.engine.stop_training("程序关闭")
+        if self.engine.is_monitoring:
+            self.engine.stop_monitoring("程序关闭")
+        self._stop_capture()
         self.stimulator.cleanup()
-        if self.video_writer:
-            self.video_writer.release()
-        # [修改] 释放所有摄像头
-        for c in self.caps:
-            c.release()
+        self.recorder.stop()
+        METRICS.shutdown()
         self.root.destroy()
 
+# ==========================================
+# 3. 无界面模式 (--no-gui)
+# ==========================================
+def _headless_log(msg):
+    time_str = datetime.datetime.now().strftime("%H:%M:%S")
+    print(f"[{time_str}] {msg}")
+
+
+def run_headless(mode=None, duration=None, resume=False):
+    """
+    无界面模式：按 config.json 与 ROI_FILE 驱动 MotionEngine，会话结束后自动导出 CSV。
+    resume=True 时若 JOURNAL_DIR 中有异常退出的会话，则从事件日志恢复并继续该会话。
+    """
+    mode = mode or HEADLESS_MODE
+    duration = duration or HEADLESS_DURATION
+
+    try:
+        rois, roi_cameras, camera_sizes, frame_size = load_rois(ROI_FILE)
+    except Exception as e:
+        print(f"[错误] 无法读取检测区域 {ROI_FILE}: {e}")
+        return 1
+    if not rois:
+        print(f"[错误] {ROI_FILE} 中没有检测区域")
+        return 1
+
+    sources = [TEST_VIDEO_PATH] if IS_TEST_MODE else CAMERA_INDICES
+    formats = []
+    caps, names = open_sources(sources, IS_TEST_MODE, _headless_log, formats=formats)
+    if not caps:
+        print("[错误] 没有可用的视频源")
+        return 1
+
+    stimulator = Stimulator(IS_TEST_MODE)
+    engine = MotionEngine(stimulator, PIXEL_DIFF_THRESHOLD, MOTION_AREA_THRESHOLD)
+    recorder = VideoRecorder(_headless_log)
+
+    # 各路检测分辨率与拼接画面 (仅用于总览录像；旧格式区域文件沿用其 frame_size)
+    if CAPTURE_PROCESSES:
+        native_sizes = probe_native_sizes(caps)
+    else:
+        workers, first_frames = start_capture_workers(caps, names, IS_TEST_MODE)
+        native_sizes = [(f.shape[1], f.shape[0]) for f in first_frames]
+    layout = CameraLayout(native_sizes, CameraLayout.working_sizes_for(native_sizes), frame_size)
+    engine.set_rois(*layout.import_rois(rois, roi_cameras, camera_sizes, frame_size))
+
+    pool = None
+    if CAPTURE_PROCESSES:
+        # 每路在子进程中采集并打分，主进程只推进状态机 (见 CameraProcessPool)
+        opened = sources[:1] if IS_TEST_MODE else [idx for idx in sources if str(idx) in names]
+        pool = CameraProcessPool(opened, names, layout, IS_TEST_MODE, formats=formats)
+        pool.start()
+        workers = []
+        _headless_log(f"多进程采集: {len(opened)} 个子进程")
+    else:
+        start_capture_threads(workers)
+    engine.capture_mode = capture_mode_label(workers, pool)
+    capture_sources = pool.cameras if pool is not None else workers
+
+    unfinished = find_unfinished_journal()
+    if unfinished and resume:
+        mode = "train" if engine.resume_session(unfinished) == 'training' else "monitor"
+        _headless_log(f"=== 已从 {unfinished} 恢复{'训练' if mode == 'train' else '监测'}会话 ===")
+    else:
+        if unfinished:
+            _headless_log(f"[提示] {unfinished} 是未正常结束的会话，可用 --resume 继续")
+        cfg = {
+            'duration': duration,
+            'click_time_dt': datetime.datetime.now(),
+            'click_time_epoch': time.time(),
+            'enable_push': False
+        }
+        if mode == "train":
+            targets = {k: int(v) for k, v in HEADLESS_TRAIN_TARGETS.items() if k in rois}
+            cfg.update({'use_time': True, 'use_count': bool(targets), 'targets': targets})
+            engine.start_training(cfg)
+        else:
+            engine.start_monitoring(cfg)
+        _headless_log(f"=== 无界面{'训练' if mode == 'train' else '监测'}开始: {duration}秒, {len(rois)} 个区域 ===")
+    prefix = "Train_Record" if mode == "train" else "Monitor_Record"
+
+    if HEADLESS_RECORD:
+        fps = overview_record_fps([fmt.get('fps') for fmt in formats]) if pool is not None else None
+        recorder.start(prefix, layout.display_size, fps=fps, workers=workers)
+    METRICS.add_gauge("bbc_capture_dropped_frames", "Frames overwritten before the main loop consumed them.",
+                      lambda: [({'camera': w.source_name}, w.dropped if pool else w.slot.dropped) for w in capture_sources])
+    METRICS.serve(log=_headless_log)
+
+    reason = "手动中断"
+    period = 1.0 / max(1, DETECT_FPS)
+    deadline = time.monotonic()
+    last_seq = None
+    try:
+        while True:
+            loop_start = time.monotonic()
+            status = engine.check_session()
+            if status['stop_reason']:
+                reason = status['stop_reason']
+                break
+
+            with METRICS.span("capture"):
+                if pool is not None:
+                    frame, scores, stamp = pool.collect(engine)
+                else:
+                    raw_frames, stamp = collect_latest_frames(workers)
+            if not IS_TEST_MODE and all(w.signal_lost for w in capture_sources):
+                reason = "所有摄像头无信号"
+                break
+            if stamp['camera_seq'] == last_seq:
+                # 没有新帧，等下一个节拍
+                deadline, _ = next_deadline(deadline, period, time.monotonic())
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                continue
+            last_seq = stamp['camera_seq']
+
+            if pool is not None:
+                stamp = engine.advance(stamp)
+                with METRICS.span("state"):
+                    roi_results, events, _ = engine.apply_scores(scores, stamp)
+            else:
+                roi_results, events = engine.process_cameras(raw_frames, stamp, layout)
+            for ev in events:
+                if ev['type'] == 'enter':
+                    _headless_log(f"→ {ev['box']} 进入")
+                else:
+                    _headless_log(f"← {ev['box']} 离开 ({ev['duration']:.2f}秒)")
+
+            if recorder.video_writer is not None:
+                if pool is None:
+                    with METRICS.span("stitch"):
+                        frame = layout.compose(raw_frames)
+                with METRICS.span("annotate"):
+                    annotate_frame(frame, roi_results, layout=layout)
+                with METRICS.span("record"):
+                    recorder.write(frame, stamp['t'])
+            METRICS.observe("loop", time.monotonic() - loop_start)
+
+            deadline, _ = next_deadline(deadline, period, time.monotonic())
+            time.sleep(max(0.0, deadline - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if engine.is_training:
+            engine.stop_training(reason)
+        if engine.is_monitoring:
+            engine.stop_monitoring(reason)
+        recorder.stop()
+        for worker in workers:
+            worker.stop()
+        if pool is not None:
+            pool.stop()
+        stimulator.cleanup()
+        METRICS.shutdown()
+
+    _headless_log(f"=== 会话结束: {reason} ===")
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    if mode == "train":
+        filepath = f"train_log_{timestamp}.csv"
+        engine.write_train_log(filepath)
+    else:
+        filepath = f"monitor_log_{timestamp}.csv"
+        engine.write_monitor_log(filepath)
+    _headless_log(f"日志已保存: {filepath}")
+    return 0
+
+
+# ==========================================
+# 4. 离线重新分析 (--analyze)
+# ==========================================
+def _recording_start_dt(video_path):
+    """录像文件名中带有开始时间 (如 Monitor_Record_20250101_090000.mp4)，否则退回文件修改时间"""
+    m = re.search(r"(\d{8}_\d{6})", os.path.basename(video_path))
+    if m:
+        return datetime.datetime.strptime(m.group(1), "%Y%m%d_%H%M%S")
+    return datetime.datetime.fromtimestamp(os.path.getmtime(video_path))
+
+
+def _decode_frames(cap, out_queue, stop_event):
+    """解码线程：不限速顺序读帧，读完放入 None 作为结束标记"""
+    while not stop_event.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        out_queue.put(frame)
+    out_queue.put(None)
+
+
+def analyze_video(video_path, pixel_thresholds, area_thresholds, out_dir=None, log=_headless_log):
+    """
+    离线重新分析一段录像：不按帧率限速、不循环播放，按 ROI_FILE 中的区域一次解码，
+    同时评估 像素阈值 × 面积阈值 的全部组合。预处理与差分图在所有组合间共用，
+    每个像素阈值只做一次二值化与积分图，面积阈值只是对同一组分数再比较一次。
+    每个组合输出一份与“导出日志”相同格式的监测 CSV，另有 sweep_summary.csv 汇总。
+    自适应背景模型只维护一份背景，任一组合判定为激活的区域都冻结更新。
+    """
+    try:
+        rois, roi_cameras, camera_sizes, frame_size = load_rois(ROI_FILE)
+    except Exception as e:
+        print(f"[错误] 无法读取检测区域 {ROI_FILE}: {e}")
+        return 1
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"[错误] 无法打开视频 {video_path}")
+        return 1
+    if camera_sizes is not None:
+        # 录像按 (总览) 拼接画面处理：区域从各路检测坐标换算到录像画面坐标
+        frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        rois = CameraLayout(camera_sizes, camera_sizes, frame_size).rois_to_display(rois, roi_cameras)
+
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    # 有 .times 文件时按逐帧采集时刻推进，不依赖容器帧率 (补写/丢帧、帧率不符时时间仍然准确)
+    frame_times = load_frame_times(video_path)
+    if frame_times is not None and not np.isfinite(frame_times).any():
+        frame_times = None
+    if frame_times is not None:
+        start_dt = datetime.datetime.fromtimestamp(frame_times[np.isfinite(frame_times)][0])
+    else:
+        start_dt = _recording_start_dt(video_path)
+    out_dir = out_dir or f"analysis_{os.path.splitext(os.path.basename(video_path))[0]}"
+    os.makedirs(out_dir, exist_ok=True)
+
+    stimulator = Stimulator(True)
+    master = MotionEngine(stimulator, pixel_thresholds[0], min(area_thresholds), journal_dir=None)
+    master.set_rois(rois)
+    cfg = {'duration': float('inf'), 'click_time_dt': start_dt, 'click_time_epoch': start_dt.timestamp(),
+           'enable_push': False}
+    combos = {}
+    for px in pixel_thresholds:
+        for area in area_thresholds:
+            engine = MotionEngine(stimulator, px, area, journal_dir=None)
+            engine.set_rois(rois)
+            engine.start_monitoring(dict(cfg))
+            combos[(px, area)] = engine
+    log(f"=== 离线分析 {video_path}: {total} 帧 @ {fps:.1f} fps, {len(rois)} 个区域, {len(combos)} 组阈值"
+        f"{', 按逐帧采集时刻' if frame_times is not None else ''} ===")
+
+    frames = queue.Queue(maxsize=64)
+    stop_event = threading.Event()
+    decoder = threading.Thread(target=_decode_frames, args=(cap, frames, stop_event), daemon=True)
+    decoder.start()
+
+    t0 = time.monotonic()
+    last_report = t0
+    base_t = datetime_to_mono(start_dt)
+    epoch_to_mono = base_t - start_dt.timestamp()
+    t = base_t
+    n = 0
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            if frame_times is not None and n < len(frame_times) and np.isfinite(frame_times[n]):
+                t = float(frame_times[n]) + epoch_to_mono
+            else:
+                t = t + 1.0 / fps if n else base_t
+            stamp = master.advance({'t': t})
+            n += 1
+
+            grays = master.preprocess(cv2.resize(frame, tuple(frame_size)))
+            if not master.background.initialized:
+                master.background.initialize(grays)
+            scores = master.score_rois_multi(grays, pixel_thresholds)
+            for j, px in enumerate(pixel_thresholds):
+                for area in area_thresholds:
+                    engine = combos[(px, area)]
+                    engine.apply_scores(scores[j], engine.advance(stamp))
+            # 任一组合激活的区域都不更新背景
+            master._update_background(grays, np.fmax.reduce(scores, axis=0) > min(area_thresholds))
+
+            now = time.monotonic()
+            if now - last_report >= 5:
+                last_report = now
+                log(f"已处理 {n}/{total} 帧 ({n / fps / (now - t0):.1f}x 实时)")
+    except KeyboardInterrupt:
+        log("分析被中断，导出已处理部分")
+    finally:
+        stop_event.set()
+        while decoder.is_alive():  # 让解码线程在队列满时也能退出
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                time.sleep(0.01)
+        cap.release()
+        stimulator.cleanup()
+
+    elapsed = time.monotonic() - t0
+    end_dt = mono_to_datetime(t + 1.0 / fps) if n else start_dt
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    with open(os.path.join(out_dir, "sweep_summary.csv"), 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(["像素阈值", "面积阈值", "Box名称", "总停留时间(秒)", "进入次数", "日志文件"])
+        for (px, area), engine in combos.items():
+            engine.stop_monitoring("分析结束", end_dt=end_dt)
+            filename = f"{stem}_px{px}_area{area}.csv"
+            engine.write_monitor_log(os.path.join(out_dir, filename))
+            dwells = engine.load_session('monitoring')['dwells']
+            for box in sorted(rois):
+                records = dwells.get(box, [])
+                writer.writerow([px, area, box, f"{sum(r['duration'] for r in records):.2f}", len(records), filename])
+
+    log(f"=== 分析完成: {n} 帧, 耗时 {elapsed:.1f}秒 ({n / fps / max(elapsed, 1e-6):.1f}x 实时), 结果已保存到 {out_dir} ===")
+    return 0
+
+
+def _parse_threshold_list(text):
+    return [float(v) if '.' in v else int(v) for v in text.split(',') if v.strip()]
+
+
+# ==========================================
+# 5. 性能基准 (--benchmark)
+# ==========================================
+class SyntheticCapture:
+    """
+    模拟摄像头 (接口同 cv2.VideoCapture)：噪声背景上移动的亮斑，read() 按帧率阻塞。
+    噪声帧预先生成若干张轮换使用，生成开销不会算到被测流水线上。
+    """
+    def __init__(self, width, height, fps=30.0, blobs=4, seed=0):
+        self.width, self.height, self.fps = width, height, fps
+        rng = np.random.default_rng(seed)
+        self.noise = [rng.integers(40, 80, (height, width, 3), dtype=np.uint8) for _ in range(4)]
+        self.blob_pos = rng.uniform(0, 1, (blobs, 2)) * (width, height)
+        self.blob_vel = rng.uniform(-1, 1, (blobs, 2)) * max(width, height) / fps / 4  # 每秒约移动 1/4 画面
+        self.radius = max(4, min(width, height) // 20)
+        self.index = 0
+        # 各路快门在帧率网格上有随机相位 (相当于互不同步的 USB 摄像头)，同步采集只能把路间偏差压到半个周期以内
+        self.phase = float(rng.uniform(0, 1.0 / fps))
+        self._frame_t = self._latest_exposure()  # 最近取出那一帧的曝光时刻
+        self._opened = True
+
+    def isOpened(self):
+        return self._opened
+
+    def _latest_exposure(self):
+        return float(np.floor((time.monotonic() - self.phase) * self.fps) / self.fps) + self.phase
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def grab(self):
+        """
+        取下一帧：已有比上次更新的帧时立即返回最新一帧，否则阻塞到下一个帧时刻 (相当于驱动只保留最新一个缓冲区)。
+        画面在 retrieve 中生成，对应真实设备 grab 不解码。
+        """
+        if not self._opened:
+            return False
+        latest = self._latest_exposure()
+        if latest > self._frame_t + 1e-9:
+            self._frame_t = latest
+        else:
+            self._frame_t += 1.0 / self.fps
+            time.sleep(max(0.0, self._frame_t - time.monotonic()))
+        return True
+
+    def retrieve(self):
+        frame = self.noise[self.index % len(self.noise)].copy()
+        self.index += 1
+        self.blob_pos += self.blob_vel
+        for axis, limit in enumerate((self.width, self.height)):
+            out = (self.blob_pos[:, axis] < 0) | (self.blob_pos[:, axis] > limit)
+            self.blob_vel[out, axis] *= -1
+            np.clip(self.blob_pos[:, axis], 0, limit, out=self.blob_pos[:, axis])
+        for x, y in self.blob_pos.astype(int).tolist():
+            cv2.circle(frame, (x, y), self.radius, (230, 230, 230), -1)
+        return True, frame
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.width, cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+                cv2.CAP_PROP_FPS: self.fps, cv2.CAP_PROP_POS_MSEC: self._frame_t * 1000}.get(prop, 0)
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        self._opened = False
+
+
+def _grid_rois(n, frame_w, frame_h):
+    """在检测画面上按网格均匀摆放 n 个 ROI (每格内缩 10%)"""
+    cols = int(np.ceil(np.sqrt(n * frame_w / frame_h)))
+    rows = int(np.ceil(n / cols))
+    cw, ch = frame_w // cols, frame_h // rows
+    rois = {}
+    for i in range(n):
+        r, c = divmod(i, cols)
+        rois[f"Box_{i + 1}"] = (c * cw + cw // 10, r * ch + ch // 10, cw * 8 // 10, ch * 8 // 10)
+    return rois
+
+
+def _current_rss_mb():
+    """当前进程常驻内存 (MB)；读不到 /proc 时退回峰值 (resource)，都不可用返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return None
+
+
+def measure_frame_allocations(step, frames=60, warmup=10):
+    """
+    用 tracemalloc 统计稳态下每次 step() (处理一帧) 期间新分配内存的峰值 (字节)，返回逐帧列表。
+    测量时不应有其他线程在分配 (采集线程、录像编码线程需先停止)。
+    """
+    import tracemalloc
+    for _ in range(warmup):
+        step()
+    tracemalloc.start()
+    peaks = []
+    try:
+        for _ in range(frames):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            step()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def synthetic_frame_step(engine, layout, resolution, n_cameras):
+    """
+    返回处理一帧 (检测 → 状态机 → 拼接 → 标注 → 预览) 的 step()，供 measure_frame_allocations 使用。
+    画面是预先生成、循环使用的几组模拟摄像头帧，测量期间没有采集线程分配内存。
+    """
+    width, height = resolution
+    clips = []
+    for i in range(n_cameras):
+        cap = SyntheticCapture(width, height, seed=100 + i)
+        clips.append([cap.read()[1] for _ in range(8)])
+    clip_frames = itertools.cycle(list(zip(*clips)))
+    display_w, display_h = layout.display_size
+    preview_rgba = np.empty((display_h, display_w, 4), dtype=np.uint8)
+
+    def step():
+        raw = next(clip_frames)
+        st = engine.advance({'t': time.monotonic()})
+        scores, grays_list = engine.score_cameras(raw, layout)
+        results, _, active = engine.apply_scores(scores, st)
+        engine.update_camera_backgrounds(grays_list, active)
+        frame = layout.compose(raw)
+        annotate_frame(frame, results, layout=layout)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA, dst=preview_rgba)
+    return step
+
+
+BENCH_STAGES = ("capture", "detect", "state", "stitch", "annotate", "record", "display", "total")
+# --bench-alloc 的逐帧分配上限 (KB，按 p50)：稳态下只有 ROI 结果等小对象 (32 个区域约 12 KB)，
+# 任何一份按帧新建的画面缓冲 (哪怕 320x240 灰度图也有 75 KB) 都会超出
+BENCH_ALLOC_LIMIT_KB = 64
+
+
+def benchmark_pipeline(n_cameras, n_rois, resolution, frames=300, warmup=30, display_size=(800, 600), record=True,
+                       measure_alloc=False, sync=CAPTURE_SYNC):
+    """
+    按 video_loop 的阶段顺序跑一组配置 (不限速，主循环只取最新帧)，返回该组的统计 dict。
+    display 阶段只做到写入预览缓冲区为止 (ImageTk 需要 Tk 窗口)。
+    measure_alloc=True 时，计时结束后再用 tracemalloc 测一遍检测 → 拼接 → 标注 → 预览的逐帧内存分配
+    (采集与录像不计：它们各自持有新帧)。sync=True 时用 SyncCaptureGroup 同步采集。
+    """
+    width, height = resolution
+    caps = [SyntheticCapture(width, height, seed=i) for i in range(n_cameras)]
+    workers, _ = start_capture_workers(caps, [f"synthetic{i}" for i in range(n_cameras)])
+    start_capture_threads(workers, sync)
+
+    stimulator = Stimulator(True)
+    engine = MotionEngine(stimulator, PIXEL_DIFF_THRESHOLD, MOTION_AREA_THRESHOLD, journal_dir=None)
+    native_sizes = [(width, height)] * n_cameras
+    layout = CameraLayout(native_sizes, CameraLayout.working_sizes_for(native_sizes), display_size)
+    placed = {name: layout.from_display(rect) for name, rect in _grid_rois(n_rois, *display_size).items()}
+    engine.set_rois({name: rect for name, (_, rect) in placed.items()}, {name: cam for name, (cam, _) in placed.items()})
+    engine.start_monitoring({'duration': float('inf'), 'click_time_dt': datetime.datetime.now(),
+                             'click_time_epoch': time.time(), 'enable_push': False})
+    recorder = VideoRecorder(lambda msg: None)
+    tmp_dir = tempfile.mkdtemp(prefix="bbc_bench_")
+    if record:
+        recorder.start(os.path.join(tmp_dir, "bench"), display_size)
+
+    # 等每路都出第一帧
+    deadline = time.monotonic() + 5
+    while any(w.slot.peek()[0] is None for w in workers) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    timings = {name: [] for name in BENCH_STAGES}
+    skews = []  # 每帧路间采集偏差 (毫秒)
+    preview_rgba = np.empty((display_size[1], display_size[0], 4), dtype=np.uint8)
+    perf = time.perf_counter
+    t_start = None
+    try:
+        for i in range(warmup + frames):
+            if i == warmup:
+                t_start = perf()
+                for values in timings.values():
+                    values.clear()
+                skews.clear()
+            t0 = perf()
+            raw_frames, stamp = collect_latest_frames(workers)
+            t1 = perf()
+            if stamp['skew'] is not None:
+                skews.append(stamp['skew'] * 1000)
+            stamp = engine.advance(stamp)
+            scores, grays_list = engine.score_cameras(raw_frames, layout)
+            t2 = perf()
+            roi_results, _, active = engine.apply_scores(scores, stamp)
+            engine.update_camera_backgrounds(grays_list, active)
+            t3 = perf()
+            frame_resized = layout.compose(raw_frames)
+            t4 = perf()
+            annotate_frame(frame_resized, roi_results, layout=layout)
+            t5 = perf()
+            recorder.write(frame_resized)
+            t6 = perf()
+            cv2.cvtColor(frame_resized, cv2.COLOR_BGR2RGBA, dst=preview_rgba)
+            t7 = perf()
+            for name, (a, b) in zip(BENCH_STAGES, ((t0, t1), (t1, t2), (t2, t3), (t3, t4), (t4, t5),
+                                                  (t5, t6), (t6, t7), (t0, t7))):
+                timings[name].append((b - a) * 1000)
+        elapsed = perf() - t_start
+        rss = _current_rss_mb()
+        rec_stats = recorder.stats()
+        slot_stats = [(w.slot.dropped, w.slot.duplicates) for w in workers]
+    finally:
+        engine.stop_monitoring("基准结束")
+        recorder.stop()
+        for worker in workers:
+            worker.stop()
+        stimulator.cleanup()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    alloc = None
+    if measure_alloc:
+        peaks = np.asarray(measure_frame_allocations(synthetic_frame_step(engine, layout, resolution, n_cameras))) / 1024
+        alloc = {'p50': round(float(np.percentile(peaks, 50)), 2), 'max': round(float(peaks.max()), 2),
+                 'frame_kb': round(display_size[0] * display_size[1] * 3 / 1024, 1)}
+
+    stages = {}
+    for name, values in timings.items():
+        arr = np.asarray(values)
+        stages[name] = {
+            'mean': round(float(arr.mean()), 3),
+            'p50': round(float(np.percentile(arr, 50)), 3),
+            'p95': round(float(np.percentile(arr, 95)), 3),
+            'p99': round(float(np.percentile(arr, 99)), 3),
+            'max': round(float(arr.max()), 3)
+        }
+    return {
+        'cameras': n_cameras,
+        'rois': n_rois,
+        'resolution': f"{width}x{height}",
+        'frames': frames,
+        'fps': round(frames / elapsed, 2),
+        'stages_ms': stages,
+        'rss_mb': round(rss, 1) if rss is not None else None,
+        'record': {k: rec_stats[k] for k in ('written', 'dropped', 'encode_ms_avg', 'encode_ms_max')} if rec_stats else None,
+        'capture_dropped': sum(d for d, _ in slot_stats),
+        'capture_duplicates': sum(d for _, d in slot_stats),
+        'capture_skew_ms': {'p50': round(float(np.percentile(skews, 50)), 3),
+                            'p99': round(float(np.percentile(skews, 99)), 3),
+                            'max': round(float(max(skews)), 3)} if skews else None,
+        'alloc_kb_per_frame': alloc
+    }
+
+
+def run_benchmark(cameras, rois, resolutions, frames, output, record=True, measure_alloc=False, sync=CAPTURE_SYNC,
+                  alloc_limit_kb=BENCH_ALLOC_LIMIT_KB, log=_headless_log):
+    """
+    遍历 摄像头数 × ROI 数 × 分辨率，结果写为 JSON 报告 (便于不同版本间比较)。
+    measure_alloc 时任一组逐帧分配 p50 超过 alloc_limit_kb 返回 1 (报告照常写出)，否则返回 0。
+    """
+    import platform
+    report = {
+        'meta': {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'config': {'BG_MODEL': BG_MODEL, 'ROI_RESTRICTED_PREPROCESS': ROI_RESTRICTED_PREPROCESS,
+                       'RECORD_DROP_POLICY': RECORD_DROP_POLICY, 'CAPTURE_SYNC': sync, 'record': record},
+            'alloc_limit_kb': alloc_limit_kb if measure_alloc else None
+        },
+        'results': []
+    }
+    over_limit = []
+    for resolution in resolutions:
+        for n_cameras in cameras:
+            for n_rois in rois:
+                result = benchmark_pipeline(n_cameras, n_rois, resolution, frames, record=record,
+                                            measure_alloc=measure_alloc, sync=sync)
+                report['results'].append(result)
+                st = result['stages_ms']
+                log(f"{n_cameras} 路 {result['resolution']}, {n_rois} 个区域: {result['fps']:.1f} fps, "
+                    f"单帧 p50 {st['total']['p50']:.1f}ms / p99 {st['total']['p99']:.1f}ms, 内存 {result['rss_mb']} MB")
+                alloc = result['alloc_kb_per_frame']
+                if alloc:
+                    log(f"    逐帧内存分配 p50 {alloc['p50']:.1f} KB / 最大 {alloc['max']:.1f} KB "
+                        f"(一帧拼接画面 {alloc['frame_kb']:.0f} KB)")
+                    if alloc['p50'] > alloc_limit_kb:
+                        over_limit.append(f"{n_cameras} 路 {result['resolution']}, {n_rois} 个区域: "
+                                          f"{alloc['p50']:.1f} KB")
+                skew = result['capture_skew_ms']
+                if skew:
+                    log(f"    路间采集偏差 p50 {skew['p50']:.1f}ms / p99 {skew['p99']:.1f}ms / 最大 {skew['max']:.1f}ms")
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    log(f"基准报告已保存: {output}")
+    for msg in over_limit:
+        log(f"[失败] 逐帧内存分配超过上限 {alloc_limit_kb:g} KB: {msg}")
+    return 1 if over_limit else 0
+
+
+SHOCK_LATENCY_FIELDS = ('detect_ms', 'dispatch_ms', 'edge_ms', 'total_ms')
+
+
+def run_shock_latency_session(shocks=5):
+    """
+    用 FakeGpioBackend 的模拟刺激器跑一次写入事件日志的训练会话：按检测流程给出采集、判定时刻后触发 shocks 次电击，
+    再触发一次后立即结束会话 (迟到的边沿回调不能让脉冲调度线程退出)。
+    返回 {'records': 日志回放出的电击记录, 'timeline': 后端电平时间线, 'scheduler_alive': 会话后调度线程是否仍在运行}。
+    """
+    box_id = next(iter(GPIO_PINS))
+    stimulator = Stimulator(True)
+    try:
+        with tempfile.TemporaryDirectory() as journal_dir:
+            engine = MotionEngine(stimulator, journal_dir=journal_dir)
+            now = datetime.datetime.now()
+            engine.start_training({'duration': 0, 'use_time': False, 'use_count': False, 'targets': {},
+                                   'click_time_dt': now, 'click_time_epoch': now.timestamp(), 'enable_push': False})
+            # 重新激活时调度器保证与上一个脉冲至少间隔一个周期，每次电击后等满一个周期，下一次的上升沿才会立即写出
+            on_s, off_s = stimulator.pulse_widths(box_id)
+            for i in range(shocks):
+                capture_ts = time.monotonic()
+                stimulator.set_active(box_id, True, capture_ts, i + 1, time.monotonic())
+                time.sleep(min(0.05, on_s))
+                stimulator.set_active(box_id, False)
+                time.sleep(on_s + off_s)
+            stimulator.set_active(box_id, True, time.monotonic(), shocks + 1, time.monotonic())
+            engine.stop_training("延迟自检结束")
+            time.sleep(0.05)
+            records = replay_journal(read_journal(engine.journal_paths['training']))['shock_history']
+        return {'records': records, 'timeline': list(stimulator.backend.timeline),
+                'scheduler_alive': stimulator.scheduler.is_alive()}
+    finally:
+        stimulator.cleanup()
+
+
+def check_shock_latency(shocks=5, log=_headless_log):
+    """
+    电击延迟自检 (--latency-check)：见 run_shock_latency_session。检查前 shocks 条电击记录的
+    detect_ms / dispatch_ms / edge_ms / total_ms 都已补全且非负，全部通过返回 0，否则返回 1。
+    """
+    result = run_shock_latency_session(shocks)
+    records = result['records']
+    failures = []
+    if len(records) != shocks + 1:
+        failures.append(f"日志中有 {len(records)} 条电击记录，应为 {shocks + 1} 条")
+    for r in records[:shocks]:
+        for key in SHOCK_LATENCY_FIELDS:
+            if r.get(key) is None or r[key] < 0:
+                failures.append(f"第 {r['count_index']} 次电击 {key} = {r.get(key)}")
+    if not result['scheduler_alive']:
+        failures.append("脉冲调度线程已退出")
+
+    totals = [r['total_ms'] for r in records[:shocks] if r.get('total_ms') is not None]
+    if totals:
+        log(f"电击延迟自检: {len(totals)} 次, 采集→高电平 p50 {np.percentile(totals, 50):.2f}ms / "
+            f"最大 {max(totals):.2f}ms")
+    for msg in failures:
+        log(f"[失败] {msg}")
+    log("电击延迟自检通过" if not failures else f"电击延迟自检失败 ({len(failures)} 项)")
+    return 0 if not failures else 1
+
+
+def _parse_int_list(text):
+    return [int(v) for v in text.split(',') if v.strip()]
+
+
+def _parse_resolution_list(text):
+    return [tuple(int(x) for x in v.lower().split('x')) for v in text.split(',') if v.strip()]
+
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PyInstaller 打包后的多进程采集子进程从这里进入，须在解析参数之前
+    parser = argparse.ArgumentParser(description="生物行为实验控制台")
+    parser.add_argument("--no-gui", action="store_true", help="无界面模式: 按 config.json 运行检测引擎")
+    parser.add_argument("--mode", choices=["monitor", "train"], default=None, help="无界面模式的会话类型 (默认取 HEADLESS_MODE)")
+    parser.add_argument("--duration", type=int, default=None, help="无界面模式的会话时长/秒 (默认取 HEADLESS_DURATION)")
+    parser.add_argument("--resume", action="store_true", help="无界面模式: 继续上次异常退出的会话 (按事件日志恢复)")
+    parser.add_argument("--analyze", metavar="VIDEO", default=None, help="离线重新分析录像 (不限速, 按 ROI_FILE 的区域)")
+    parser.add_argument("--pixel-thresholds", type=_parse_threshold_list, default=None,
+                        help="离线分析的像素阈值列表, 逗号分隔 (默认取 PIXEL_DIFF_THRESHOLD)")
+    parser.add_argument("--area-thresholds", type=_parse_threshold_list, default=None,
+                        help="离线分析的面积阈值列表, 逗号分隔 (默认取 MOTION_AREA_THRESHOLD)")
+    parser.add_argument("--out-dir", default=None, help="离线分析结果目录 (默认 analysis_<视频名>)")
+    parser.add_argument("--benchmark", action="store_true", help="用模拟摄像头测试流水线性能, 输出 JSON 报告")
+    parser.add_argument("--bench-cameras", type=_parse_int_list, default=[1, 2, 4], help="基准: 摄像头数量列表 (默认 1,2,4)")
+    parser.add_argument("--bench-rois", type=_parse_int_list, default=[4, 16, 32], help="基准: ROI 数量列表 (默认 4,16,32)")
+    parser.add_argument("--bench-resolutions", type=_parse_resolution_list, default=[(640, 480), (1280, 720)],
+                        help="基准: 单路分辨率列表 (默认 640x480,1280x720)")
+    parser.add_argument("--bench-frames", type=int, default=300, help="基准: 每组配置测量的帧数 (默认 300)")
+    parser.add_argument("--bench-no-record", action="store_true", help="基准: 不包含录像阶段")
+    parser.add_argument("--bench-output", default="benchmark_report.json", help="基准报告路径")
+    parser.add_argument("--bench-alloc", action="store_true", help="基准: 另用 tracemalloc 统计稳态下逐帧的内存分配")
+    parser.add_argument("--bench-sync", action="store_true", help="基准: 使用同步 grab/retrieve 采集 (同 CAPTURE_SYNC)")
+    parser.add_argument("--bench-alloc-limit", type=float, default=BENCH_ALLOC_LIMIT_KB,
+                        help=f"基准: 逐帧内存分配 p50 上限/KB, 超出时返回非零 (默认 {BENCH_ALLOC_LIMIT_KB})")
+    parser.add_argument("--latency-check", action="store_true",
+                        help="电击延迟自检: 用模拟 GPIO 后端检查电击记录的各段延迟已补全且非负, 失败时返回非零")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        raise SystemExit(run_benchmark(args.bench_cameras, args.bench_rois, args.bench_resolutions, args.bench_frames,
+                                       args.bench_output, record=not args.bench_no_record,
+                                       measure_alloc=args.bench_alloc, sync=args.bench_sync or CAPTURE_SYNC,
+                                       alloc_limit_kb=args.bench_alloc_limit))
+
+    if args.latency_check:
+        raise SystemExit(check_shock_latency())
+
+    if args.analyze:
+        raise SystemExit(analyze_video(args.analyze, args.pixel_thresholds or [PIXEL_DIFF_THRESHOLD],
+                                       args.area_thresholds or [MOTION_AREA_THRESHOLD], args.out_dir))
+
+    if args.no_gui:
+        raise SystemExit(run_headless(args.mode, args.duration, args.resume))
+
     root = tk.Tk()
     app = UnifiedGUI(root)
     root.protocol("WM_DELETE_WINDOW", app.on_close)
@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def bbc(tmp_path_factory):
+    """
+    bio_behavior_console 在导入时读取 (不存在时生成) 当前目录下的 config.json，
+    在临时目录中导入，测试使用默认配置且不在仓库里留下文件。
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("config"))
+        mp.syspath_prepend(ROOT)
+        import bio_behavior_console
+        yield bio_behavior_console
@@ -0,0 +1,66 @@
+import datetime
+import time
+
+
+def _start_training(engine):
+    now = datetime.datetime.now()
+    engine.start_training({'duration': 0, 'use_time': False, 'use_count': False, 'targets': {},
+                           'click_time_dt': now, 'click_time_epoch': now.timestamp(), 'enable_push': False})
+
+
+def _shock(stimulator, box_id, frame_index):
+    t = time.monotonic()
+    stimulator.set_active(box_id, True, t, frame_index, t)
+    stimulator.set_active(box_id, False)
+
+
+def test_replay_merges_shock_edges_and_session_end(bbc, tmp_path):
+    records = [
+        {'type': 'session_start', 'mode': 'training', 'time': '2025-01-01T09:00:00.000', 'cfg': {'duration': 60},
+         'rois': {'Box_1': [0, 0, 10, 10]}, 'roi_cameras': {'Box_1': 0}},
+        {'type': 'shock', 'box_id': 'Box_1', 'count_index': 1, 'edge_ms': None, 'total_ms': None},
+        {'type': 'shock_edge', 'box_id': 'Box_1', 'count_index': 1, 'edge_ms': 0.5, 'total_ms': 12.0},
+        {'type': 'dwell', 'box': 'Box_1', 'start': '2025-01-01T09:00:01.000', 'end': '2025-01-01T09:00:03.500',
+         'duration': 2.5, 'start_frame': 30, 'end_frame': 105},
+        {'type': 'session_end', 'time': '2025-01-01T09:01:00.000', 'reason': '时间到'},
+    ]
+    path = tmp_path / "training.jsonl"
+    journal = bbc.EventJournal(str(path))
+    for r in records:
+        journal.append(r)
+    journal.close()
+
+    session = bbc.replay_journal(bbc.read_journal(str(path)))
+    assert session['mode'] == 'training'
+    assert session['reason'] == '时间到'
+    assert session['end'] == datetime.datetime(2025, 1, 1, 9, 1)
+    assert session['shock_counts']['Box_1'] == 1
+    assert session['shock_history'][0]['total_ms'] == 12.0
+    assert session['dwells']['Box_1'][0]['duration'] == 2.5
+    assert session['rois'] == {'Box_1': [0, 0, 10, 10]}
+
+
+def test_resume_continues_unfinished_session(bbc, tmp_path):
+    stimulator = bbc.Stimulator(True)
+    try:
+        first = bbc.MotionEngine(stimulator, journal_dir=str(tmp_path))
+        first.set_rois({'Box_1': (0, 0, 10, 10)})
+        _start_training(first)
+        _shock(stimulator, 'Box_1', 1)
+        _shock(stimulator, 'Box_1', 2)
+        first.journal.flush()  # 模拟异常退出：日志没有 session_end
+        path = first.journal_paths['training']
+        assert bbc.find_unfinished_journal(str(tmp_path)) == path
+
+        second = bbc.MotionEngine(stimulator, journal_dir=str(tmp_path))
+        assert second.resume_session(path) == 'training'
+        assert stimulator.shock_counts['Box_1'] == 2
+        _shock(stimulator, 'Box_1', 3)
+        second.stop_training("测试结束")
+    finally:
+        stimulator.cleanup()
+
+    session = bbc.replay_journal(bbc.read_journal(path))
+    assert session['reason'] == "测试结束"
+    assert [r['count_index'] for r in session['shock_history']] == [1, 2, 3]
+    assert bbc.find_unfinished_journal(str(tmp_path)) is None
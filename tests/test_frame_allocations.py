@@ -0,0 +1,31 @@
+import datetime
+import time
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("n_cameras, n_rois", [(1, 4), (2, 32)])
+def test_steady_state_frame_allocations_under_limit(bbc, n_cameras, n_rois):
+    resolution = (640, 480)
+    display_size = (800, 600)
+    stimulator = bbc.Stimulator(True)
+    try:
+        engine = bbc.MotionEngine(stimulator, journal_dir=None)
+        native_sizes = [resolution] * n_cameras
+        layout = bbc.CameraLayout(native_sizes, bbc.CameraLayout.working_sizes_for(native_sizes), display_size)
+        placed = {name: layout.from_display(rect) for name, rect in bbc._grid_rois(n_rois, *display_size).items()}
+        engine.set_rois({name: rect for name, (_, rect) in placed.items()},
+                        {name: cam for name, (cam, _) in placed.items()})
+        engine.start_monitoring({'duration': float('inf'), 'click_time_dt': datetime.datetime.now(),
+                                 'click_time_epoch': time.time(), 'enable_push': False})
+
+        step = bbc.synthetic_frame_step(engine, layout, resolution, n_cameras)
+        peaks_kb = np.asarray(bbc.measure_frame_allocations(step, frames=40, warmup=10)) / 1024
+        engine.stop_monitoring("测试结束")
+    finally:
+        stimulator.cleanup()
+
+    # 画面与中间结果都预分配、原地写入：稳态下每帧只有小对象，远低于一份画面缓冲
+    assert np.percentile(peaks_kb, 50) < bbc.BENCH_ALLOC_LIMIT_KB
+    assert peaks_kb.max() < display_size[0] * display_size[1] / 1024  # 任何一帧都不分配整幅灰度图
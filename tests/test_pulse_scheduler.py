@@ -0,0 +1,51 @@
+import threading
+import time
+
+
+def _run_train(scheduler, seconds, on_s=0.02, off_s=0.03):
+    scheduler.start()
+    scheduler.start_train("Box_1", 3, on_s, off_s)
+    time.sleep(seconds)
+    scheduler.stop_train("Box_1")
+    time.sleep(on_s + 0.02)  # 让最后一个高电平按计划结束
+    scheduler.shutdown()
+
+
+def test_pulse_train_timing_and_jitter_stats(bbc):
+    writes = []
+    lock = threading.Lock()
+
+    def write(pin, value):
+        with lock:
+            writes.append((time.monotonic(), pin, value))
+
+    scheduler = bbc.PulseScheduler(write)
+    _run_train(scheduler, 0.5)
+
+    rises = [t for t, _, v in writes if v == 1]
+    falls = [t for t, _, v in writes if v == 0]
+    assert len(rises) >= 5
+    assert len(falls) == len(rises)  # 每个高电平都被拉低
+    report = scheduler.jitter_report()["Box_1"]
+    assert report['pulses'] == len(rises)
+    # 计划时间按上一个计划时间推算，不累积调度延迟；宽松容差以适应繁忙的 CI
+    assert abs(report['width_mean'] - 20) < 10
+    assert abs(report['period_mean'] - 50) < 10
+    assert report['edge_delay_max'] >= 0
+
+
+def test_scheduler_survives_failing_writes(bbc):
+    calls = []
+
+    def write(pin, value):
+        calls.append(value)
+        if len(calls) <= 2:
+            raise OSError("模拟 GPIO 写入失败")
+
+    scheduler = bbc.PulseScheduler(write)
+    scheduler.start()
+    scheduler.start_train("Box_1", 3, 0.01, 0.02)
+    time.sleep(0.2)
+    assert scheduler.is_alive()
+    assert calls.count(1) >= 3  # 失败之后仍继续输出脉冲
+    scheduler.shutdown()
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def test_v2_roundtrip_with_camera_offsets(bbc, tmp_path):
+    path = str(tmp_path / "monitoring.scores")
+    series = bbc.ScoreSeries(path, ['Box_1', 'Box_2'], n_cameras=2, chunk_rows=4)
+    for i in range(10):  # 跨越多个预分配块
+        series.append(1000.0 + i, i, ['Box_2', 'Box_1'], np.array([i, -i], dtype=np.float64), [0.0, -2.0 * i])
+    series.close()
+
+    header, rows = bbc.open_score_series(path)
+    assert header['version'] == 2
+    assert header['cameras'] == 2
+    assert header['roi_names'] == ['Box_1', 'Box_2']
+    assert len(rows) == 10
+    # 列按文件头顺序存放，与追加时的 ROI 顺序无关
+    assert rows['scores'][3].tolist() == [-3.0, 3.0]
+    assert rows['frame'].tolist() == list(range(10))
+    assert rows['camera_dt'][4].tolist() == [0.0, -8.0]
+    assert bbc.score_series_skew(rows).tolist() == [2.0 * i for i in range(10)]
+
+
+def test_reopen_appends_after_last_valid_row(bbc, tmp_path):
+    path = str(tmp_path / "training.scores")
+    series = bbc.ScoreSeries(path, ['Box_1'], n_cameras=2, chunk_rows=8)
+    for i in range(3):
+        series.append(1000.0 + i, i, ['Box_1'], np.array([1.0]), [0.0, np.nan])
+    series._mm.flush()  # 模拟异常退出：未截断，文件末尾是预分配的空行
+    del series
+
+    resumed = bbc.ScoreSeries(path, ['Box_1'], n_cameras=2)
+    assert resumed.count == 3
+    resumed.append(2000.0, 3, ['Box_1'], np.array([2.0]), [0.0, 1.5])
+    resumed.close()
+
+    _, rows = bbc.open_score_series(path)
+    assert rows['t'].tolist() == [1000.0, 1001.0, 1002.0, 2000.0]
+    # 只有一路有效的帧没有路间偏差
+    assert bbc.score_series_skew(rows).tolist() == [1.5]
+
+
+def test_single_camera_series_has_no_skew(bbc, tmp_path):
+    path = str(tmp_path / "single.scores")
+    series = bbc.ScoreSeries(path, ['Box_1'])
+    series.append(1000.0, 0, ['Box_1'], np.array([1.0]))
+    series.close()
+    header, rows = bbc.open_score_series(path)
+    assert header['cameras'] == 0
+    assert len(bbc.score_series_skew(rows)) == 0
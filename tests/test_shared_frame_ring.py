@@ -0,0 +1,35 @@
+import numpy as np
+
+
+def test_reader_gets_latest_published_frame(bbc):
+    ring = bbc.SharedFrameRing((4, 6, 3), slots=3)
+    reader = bbc.SharedFrameRing.attach(ring.spec())
+    out = np.empty((4, 6, 3), dtype=np.uint8)
+    try:
+        assert reader.read_into(out) is None  # 尚未发布任何帧
+
+        for i in range(1, 6):  # 超过槽数，环形覆盖
+            ring.begin_write()[:] = i
+            ring.publish(100.0 + i, 7, np.array([i, i * 2], dtype=np.float32))
+
+        seq, t, version, scores = reader.read_into(out)
+        assert (seq, t, version) == (5, 105.0, 7)
+        assert scores[:2].tolist() == [5.0, 10.0]
+        assert (out == 5).all()
+    finally:
+        reader.close()
+        ring.close()
+
+
+def test_slot_being_written_is_not_returned_as_valid(bbc):
+    ring = bbc.SharedFrameRing((2, 2, 3), slots=2)
+    out = np.empty((2, 2, 3), dtype=np.uint8)
+    try:
+        ring.begin_write()[:] = 1
+        ring.publish(1.0, 0, np.zeros(0, dtype=np.float32))
+        # 模拟写者回绕后正在改写最新帧所在的槽 (begin_write 会先把槽序号置 -1)：读者复核序号失败，不返回半帧
+        latest_slot = int(ring.header[0]) % ring.slots
+        ring.meta['seq'][latest_slot] = -1
+        assert ring.read_into(out, retries=2) is None
+    finally:
+        ring.close()
@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.fixture
+def fast_pulses(bbc, monkeypatch):
+    """缩短脉冲周期，自检中每次电击之后只需等一个 50ms 的周期"""
+    monkeypatch.setattr(bbc, "PULSE_WIDTHS", {box: (20, 30) for box in bbc.GPIO_PINS})
+
+
+def test_shock_records_carry_latency_on_fake_backend(bbc, fast_pulses):
+    shocks = 3
+    result = bbc.run_shock_latency_session(shocks)
+
+    records = result['records']
+    assert len(records) == shocks + 1
+    for r in records[:shocks]:
+        for key in bbc.SHOCK_LATENCY_FIELDS:
+            assert r[key] is not None, (r['count_index'], key)
+            assert r[key] >= 0, (r['count_index'], key)
+        # 总延迟覆盖 采集→判定→触发→高电平 全程
+        assert r['total_ms'] >= r['edge_ms']
+
+    pin = bbc.GPIO_PINS[records[0]['box_id']]
+    rises = [t for t, p, v in result['timeline'] if p == pin and v == 1]
+    assert len(rises) >= shocks
+    assert result['scheduler_alive']
+
+
+def test_latency_check_exit_code(bbc, fast_pulses):
+    assert bbc.check_shock_latency(shocks=2, log=lambda msg: None) == 0